@@ -5,8 +5,9 @@ import signal
 import sys
 
 from channel import channel_factory
+from common.file_watcher import FileWatcher
 from common.log import logger
-from config import conf, load_config
+from config import conf, load_config, watch_config
 from plugins import *
 
 
@@ -23,10 +24,23 @@ def sigterm_handler_wrap(_signo):
     signal.signal(_signo, func)
 
 
+def watch_plugin_configs():
+    interval = conf().get("config_watch_interval", 3)
+    if not interval:
+        return
+    watcher = FileWatcher(interval)
+    for name, plugincls in PluginManager().list_plugins().items():
+        path = getattr(plugincls, "path", None)
+        if path:
+            watcher.watch(os.path.join(path, "config.json"), lambda _, name=name: PluginManager().reload_plugin(name))
+
+
 def run():
     try:
         # load config
         load_config()
+        # reload config when config.json changes
+        watch_config()
         # ctrl + c
         sigterm_handler_wrap(signal.SIGINT)
         # kill signal
@@ -43,8 +57,9 @@ def run():
             # os.environ['WECHATY_PUPPET_SERVICE_ENDPOINT'] = '127.0.0.1:9001'
 
         channel = channel_factory.create_channel(channel_name)
-        if channel_name in ["wx", "wxy", "terminal", "wechatmp", "wechatmp_service", "wechatcom_app"]:
+        if channel_name in ["wx", "wx_async", "wxy", "terminal", "wechatmp", "wechatmp_service", "wechatcom_app"]:
             PluginManager().load_plugins()
+            watch_plugin_configs()
 
         # startup channel
         channel.startup()
@@ -1,6 +1,7 @@
 # encoding:utf-8
 
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import openai
 import openai.error
@@ -13,16 +14,29 @@ from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
-from common.token_bucket import TokenBucket
-from config import conf, load_config
+from common.token_bucket import rebuild_token_bucket
+from config import conf, reload_config, subscribe_config
+
+
+COMPACT_PROMPT = "请将以下对话内容总结为一段简洁的摘要，保留其中的关键事实、用户的偏好和尚未解决的问题，直接输出摘要内容。"
 
 
 # OpenAI对话模型API (可用)
 class ChatGPTBot(Bot, OpenAIImage):
+    compact_pool = ThreadPoolExecutor(max_workers=2)  # 上下文压缩的后台线程池
+
     def __init__(self):
         logger.debug("[ChatGPTBot] Initializing ChatGPTBot")
         super().__init__()
+        self.tb4chatgpt = None
+
+        logger.debug("[ChatGPTBot] Initializing sessions and model")
+        self.sessions = SessionManager(ChatGPTSession, model=conf().get("model") or "gpt-3.5-turbo")
+        self.load_config()
+        # 配置重载后重新生成请求参数，已创建的会话保持原来的模型
+        subscribe_config(lambda config, old_config: self.load_config())
 
+    def load_config(self):
         logger.debug("[ChatGPTBot] Setting up OpenAI API key and configuration")
         openai.api_key = conf().get("open_ai_api_key")
         if conf().get("open_ai_api_base"):
@@ -30,12 +44,13 @@ class ChatGPTBot(Bot, OpenAIImage):
         proxy = conf().get("proxy")
         if proxy:
             openai.proxy = proxy
-        if conf().get("rate_limit_chatgpt"):
-            self.tb4chatgpt = TokenBucket(conf().get("rate_limit_chatgpt", 20))
+        self.tb4chatgpt = rebuild_token_bucket(self.tb4chatgpt, conf().get("rate_limit_chatgpt"))
+        self.sessions.session_args["model"] = conf().get("model") or "gpt-3.5-turbo"
+        self.args = self.build_args()
+        logger.debug("[ChatGPTBot] ChatGPTBot initialized with args: {}".format(self.args))
 
-        logger.debug("[ChatGPTBot] Initializing sessions and model")
-        self.sessions = SessionManager(ChatGPTSession, model=conf().get("model") or "gpt-3.5-turbo")
-        self.args = {
+    def build_args(self):
+        return {
             "model": conf().get("model") or "gpt-3.5-turbo",
             "temperature": conf().get("temperature", 0.9),
             "top_p": 1,
@@ -44,10 +59,8 @@ class ChatGPTBot(Bot, OpenAIImage):
             "request_timeout": conf().get("request_timeout", None),
             "timeout": conf().get("request_timeout", None),
         }
-        logger.debug("[ChatGPTBot] ChatGPTBot initialized with args: {}".format(self.args))
 
     def reply(self, query, context=None):
-        global group_name
         logger.debug("[CHATGPT] Entering reply function with query: {}".format(query))
 
         # acquire reply content
@@ -64,42 +77,26 @@ class ChatGPTBot(Bot, OpenAIImage):
                 self.sessions.clear_all_session()
                 reply = Reply(ReplyType.INFO, "所有人记忆已清除")
             elif query == "#更新配置":
-                load_config()
-                reply = Reply(ReplyType.INFO, "配置已更新")
+                if reload_config():
+                    reply = Reply(ReplyType.INFO, "配置已更新")
+                else:
+                    reply = Reply(ReplyType.ERROR, "配置有误，未更新")
 
             if reply:
                 return reply
 
             session = self.sessions.session_query(query, session_id)
-            # 保存初始的模板
-            init_system_template = conf().get("character_desc", "")
-            group_system_template = conf().get("group_character_desc", "")
-
-            for message in session.messages:
-                # 在每次循环时重新获取botname和name
-                bot_name = context.kwargs['msg'].to_user_nickname  # 这里需要你自己确定 botname 应该是哪个昵称
-                group_name = ''
-
-                if context.kwargs['isgroup']:  # 如果是群聊
-                    if message['role'] == 'system':  # 如果是system message
-                        message['content'] = group_system_template  # 使用初始的模板
-                    name = context.kwargs['msg'].actual_user_nickname  # 使用实际的用户名
-                    group_name = context.kwargs['msg'].from_user_nickname
-                else:
-                    name = context.kwargs['msg'].from_user_nickname  # 使用发送消息的用户名
-
-                # 如果message['content']中没有 {group_name}，则不需要提供 group_name 的值
-                if '{group_name}' in message['content']:
-                    try:
-                        message['content'] = message['content'].format(group_name=group_name, bot_name=bot_name,
-                                                                       name=name)
-                    except KeyError:
-                        pass
-                else:
-                    try:
-                        message['content'] = message['content'].format(bot_name=bot_name, name=name)
-                    except KeyError:
-                        pass
+            cmsg = context.kwargs['msg']
+            bot_name = cmsg.to_user_nickname  # 这里需要你自己确定 botname 应该是哪个昵称
+            if context.kwargs['isgroup']:  # 如果是群聊，使用群聊的模板
+                session.render_system_prompt(
+                    conf().get("group_character_desc", ""),
+                    group_name=cmsg.from_user_nickname,
+                    bot_name=bot_name,
+                    name=cmsg.actual_user_nickname,  # 使用实际的用户名
+                )
+            else:
+                session.render_system_prompt(group_name="", bot_name=bot_name, name=cmsg.from_user_nickname)
 
             logger.debug("[CHATGPT] session query={}".format(session.messages))
 
@@ -118,7 +115,8 @@ class ChatGPTBot(Bot, OpenAIImage):
             if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
                 reply = Reply(ReplyType.ERROR, reply_content["content"])
             elif reply_content["completion_tokens"] > 0:
-                self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
+                session = self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
+                self.compact_session_if_needed(session, api_key)
                 reply = Reply(ReplyType.TEXT, reply_content["content"])
             else:
                 reply = Reply(ReplyType.ERROR, reply_content["content"])
@@ -153,11 +151,12 @@ class ChatGPTBot(Bot, OpenAIImage):
         logger.debug("[CHATGPT] Entering reply_text function with session: {}".format(session))
 
         try:
-            if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.get_token():
+            tb4chatgpt = self.tb4chatgpt
+            if tb4chatgpt and not tb4chatgpt.get_token():
                 raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
 
             # if api_key == None, the default openai.api_key will be used
-            response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **self.args)
+            response = openai.ChatCompletion.create(api_key=api_key, messages=session.to_openai_messages(), **self.args)
 
             result = {
                 "total_tokens": response["usage"]["total_tokens"],
@@ -197,13 +196,61 @@ class ChatGPTBot(Bot, OpenAIImage):
             else:
                 return result
 
+    def compact_session_if_needed(self, session: ChatGPTSession, api_key=None):
+        """
+        会话超过压缩阈值时，提交后台任务把较早的对话总结为摘要，不阻塞当前请求
+        """
+        if not conf().get("conversation_compact"):
+            return
+        with session.lock:  # 检查和设置compacting需是原子的，避免并发请求重复提交
+            if session.compacting:
+                return
+            try:
+                cur_tokens = session.calc_tokens()
+            except Exception as e:
+                logger.debug("[CHATGPT] Exception when counting tokens for compaction: {}".format(e))
+                return
+            threshold = conf().get("conversation_max_tokens", 1000) * conf().get("conversation_compact_threshold", 0.8)
+            if cur_tokens <= threshold:
+                return
+            compacted = session.compactable_messages(conf().get("conversation_compact_keep", 4))
+            if not compacted:
+                return
+            session.compacting = True
+        self.compact_pool.submit(self._compact_session, session, compacted, api_key)
+
+    def _compact_session(self, session: ChatGPTSession, compacted, api_key=None):
+        try:
+            tb4chatgpt = self.tb4chatgpt
+            if tb4chatgpt and not tb4chatgpt.get_token():
+                raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
+            history = "\n".join("{}: {}".format(message["role"], message["content"]) for message in compacted)
+            args = dict(self.args)
+            args["model"] = conf().get("conversation_compact_model") or self.args["model"]
+            messages = [{"role": "system", "content": COMPACT_PROMPT}, {"role": "user", "content": history}]
+            response = openai.ChatCompletion.create(api_key=api_key, messages=messages, **args)
+            summary = response.choices[0]["message"]["content"]
+            if session.compact(compacted, summary):
+                logger.info("[CHATGPT] session {} compacted, {} messages summarized".format(session.session_id, len(compacted)))
+            else:
+                logger.debug("[CHATGPT] session {} changed during compaction, discard summary".format(session.session_id))
+        except Exception as e:
+            logger.warn("[CHATGPT] compact session {} failed: {}".format(session.session_id, e))
+        finally:
+            with session.lock:
+                session.compacting = False
+
 
 class AzureChatGPTBot(ChatGPTBot):
     def __init__(self):
         super().__init__()
         openai.api_type = "azure"
         openai.api_version = "2023-03-15-preview"
-        self.args["deployment_id"] = conf().get("azure_deployment_id")
+
+    def build_args(self):
+        args = super().build_args()
+        args["deployment_id"] = conf().get("azure_deployment_id")
+        return args
 
     def create_img(self, query, retry_count=0, api_key=None):
         logger.debug(f"create_img called with query: {query}, retry_count: {retry_count}")
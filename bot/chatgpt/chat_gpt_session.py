@@ -1,4 +1,4 @@
-from bot.session_manager import Session
+from bot.session_manager import Message, Session
 from common.log import logger
 
 """
@@ -15,8 +15,50 @@ class ChatGPTSession(Session):
     def __init__(self, session_id, system_prompt=None, model="gpt-3.5-turbo"):
         super().__init__(session_id, system_prompt)
         self.model = model
+        self.summary = None  # 上下文压缩后的摘要消息，固定在system消息之后
+        self.compacting = False  # 是否有后台压缩任务在进行
         self.reset()
 
+    def reset(self):
+        with self.lock:
+            super().reset()
+            self.summary = None
+
+    def __getstate__(self):
+        # 休眠时不保存进行中的压缩任务状态
+        state = super().__getstate__()
+        state["compacting"] = False
+        return state
+
+    def _history_start(self):
+        # 摘要消息不参与丢弃，历史消息从摘要之后开始
+        if len(self.messages) > 1 and self.messages[1] is self.summary:
+            return 2
+        return 1
+
+    def compactable_messages(self, keep):
+        """
+        返回可被总结的较早消息(包含已有的摘要)，保留最近keep条消息不做总结
+        """
+        with self.lock:
+            end = len(self.messages) - keep
+            if end - self._history_start() < 2:
+                return []
+            return self.messages[1:end]
+
+    def compact(self, compacted, summary):
+        """
+        用一条摘要消息替换已被总结的消息，如果这些消息在总结期间已被丢弃或重置，则放弃本次压缩
+        """
+        n = len(compacted)
+        with self.lock:
+            current = self.messages[1 : 1 + n]
+            if n == 0 or len(current) != n or any(a is not b for a, b in zip(current, compacted)):
+                return False
+            self.summary = Message("system", "以下是之前对话的摘要：" + summary)
+            self.messages[1 : 1 + n] = [self.summary]
+            return True
+
     def discard_exceeding(self, max_tokens, cur_tokens=None):
         precise = True
         try:
@@ -27,16 +69,17 @@ class ChatGPTSession(Session):
                 raise e
             logger.debug("Exception when counting tokens precisely for query: {}".format(e))
         while cur_tokens > max_tokens:
-            if len(self.messages) > 2:
-                self.messages.pop(1)
-            elif len(self.messages) == 2 and self.messages[1]["role"] == "assistant":
-                self.messages.pop(1)
+            start = self._history_start()
+            if len(self.messages) > start + 1:
+                self.messages.pop(start)
+            elif len(self.messages) == start + 1 and self.messages[start]["role"] == "assistant":
+                self.messages.pop(start)
                 if precise:
                     cur_tokens = self.calc_tokens()
                 else:
                     cur_tokens = cur_tokens - max_tokens
                 break
-            elif len(self.messages) == 2 and self.messages[1]["role"] == "user":
+            elif len(self.messages) == start + 1 and self.messages[start]["role"] == "user":
                 logger.warn("user message exceed max_tokens. total_tokens={}".format(cur_tokens))
                 break
             else:
@@ -12,7 +12,7 @@ from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
-from config import conf
+from config import conf, subscribe_config
 
 user_session = dict()
 
@@ -21,14 +21,19 @@ user_session = dict()
 class OpenAIBot(Bot, OpenAIImage):
     def __init__(self):
         super().__init__()
+        self.sessions = SessionManager(OpenAISession, model=conf().get("model") or "text-davinci-003")
+        self.load_config()
+        # 配置重载后重新生成请求参数，已创建的会话保持原来的模型
+        subscribe_config(lambda config, old_config: self.load_config())
+
+    def load_config(self):
         openai.api_key = conf().get("open_ai_api_key")
         if conf().get("open_ai_api_base"):
             openai.api_base = conf().get("open_ai_api_base")
         proxy = conf().get("proxy")
         if proxy:
             openai.proxy = proxy
-
-        self.sessions = SessionManager(OpenAISession, model=conf().get("model") or "text-davinci-003")
+        self.sessions.session_args["model"] = conf().get("model") or "text-davinci-003"
         self.args = {
             "model": conf().get("model") or "text-davinci-003",  # 对话模型的名称
             "temperature": conf().get("temperature", 0.9),  # 值在[0,1]之间，越大表示回复越具有不确定性
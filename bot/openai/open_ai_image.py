@@ -4,20 +4,26 @@ import openai
 import openai.error
 
 from common.log import logger
-from common.token_bucket import TokenBucket
-from config import conf
+from common.token_bucket import rebuild_token_bucket
+from config import conf, subscribe_config
 
 
 # OPENAI提供的画图接口
 class OpenAIImage(object):
     def __init__(self):
+        self.tb4dalle = None
+        self.load_image_config()
+        subscribe_config(lambda config, old_config: self.load_image_config())
+
+    # 配置重载后重新读取
+    def load_image_config(self):
         openai.api_key = conf().get("open_ai_api_key")
-        if conf().get("rate_limit_dalle"):
-            self.tb4dalle = TokenBucket(conf().get("rate_limit_dalle", 50))
+        self.tb4dalle = rebuild_token_bucket(self.tb4dalle, conf().get("rate_limit_dalle"))
 
     def create_img(self, query, retry_count=0, api_key=None):
         try:
-            if conf().get("rate_limit_dalle") and not self.tb4dalle.get_token():
+            tb4dalle = self.tb4dalle
+            if tb4dalle and not tb4dalle.get_token():
                 return False, "请求太快了，请休息一下再问我吧"
             logger.info("[OPEN_AI] image_query={}".format(query))
             response = openai.Image.create(
@@ -6,8 +6,40 @@ class OpenAISession(Session):
     def __init__(self, session_id, system_prompt=None, model="text-davinci-003"):
         super().__init__(session_id, system_prompt)
         self.model = model
+        # 每条消息渲染后的片段缓存，id(message) -> [message, content, segment, tokens]
+        # 追加或丢弃消息时只需处理对应的片段
+        self._segments = {}
         self.reset()
 
+    def __getstate__(self):
+        # 缓存以id为key，休眠恢复后失效，不做保存
+        state = self.__dict__.copy()
+        state["_segments"] = {}
+        return state
+
+    def _segment(self, item):
+        entry = self._segments.get(id(item))
+        if entry is None or entry[0] is not item or entry[1] is not item["content"]:
+            if item["role"] == "system":
+                segment = item["content"] + "<|endoftext|>\n\n\n"
+            elif item["role"] == "user":
+                segment = "Q: " + item["content"] + "\n"
+            elif item["role"] == "assistant":
+                segment = "\n\nA: " + item["content"] + "<|endoftext|>\n"
+            else:
+                segment = ""
+            entry = [item, item["content"], segment, None]
+            self._segments[id(item)] = entry
+        return entry
+
+    def _prune_segments(self):
+        # 清理已被丢弃的消息对应的缓存
+        if len(self._segments) > 2 * len(self.messages) + 8:
+            self._segments = {id(item): self._segment(item) for item in self.messages}
+
+    def _waiting_answer(self):
+        return len(self.messages) > 0 and self.messages[-1]["role"] == "user"
+
     def __str__(self):
         # 构造对话模型的输入
         """
@@ -15,19 +47,19 @@ class OpenAISession(Session):
               A: xxx
               Q: xxx
         """
-        prompt = ""
-        for item in self.messages:
-            if item["role"] == "system":
-                prompt += item["content"] + "<|endoftext|>\n\n\n"
-            elif item["role"] == "user":
-                prompt += "Q: " + item["content"] + "\n"
-            elif item["role"] == "assistant":
-                prompt += "\n\nA: " + item["content"] + "<|endoftext|>\n"
-
-        if len(self.messages) > 0 and self.messages[-1]["role"] == "user":
+        prompt = "".join([self._segment(item)[2] for item in self.messages])
+        if self._waiting_answer():
             prompt += "A: "
+        self._prune_segments()
         return prompt
 
+    def prompt_length(self):
+        # 等价于len(str(self))，但不需要拼接字符串
+        length = sum(len(self._segment(item)[2]) for item in self.messages)
+        if self._waiting_answer():
+            length += len("A: ")
+        return length
+
     def discard_exceeding(self, max_tokens, cur_tokens=None):
         precise = True
         try:
@@ -45,7 +77,7 @@ class OpenAISession(Session):
                 if precise:
                     cur_tokens = self.calc_tokens()
                 else:
-                    cur_tokens = len(str(self))
+                    cur_tokens = self.prompt_length()
                 break
             elif len(self.messages) == 1 and self.messages[0]["role"] == "user":
                 logger.warn("user question exceed max_tokens. total_tokens={}".format(cur_tokens))
@@ -56,11 +88,21 @@ class OpenAISession(Session):
             if precise:
                 cur_tokens = self.calc_tokens()
             else:
-                cur_tokens = len(str(self))
+                cur_tokens = self.prompt_length()
         return cur_tokens
 
     def calc_tokens(self):
-        return num_tokens_from_string(str(self), self.model)
+        # 按片段累加缓存的token数，与整体计算相比仅在片段边界处可能有少量误差
+        num_tokens = 0
+        for item in self.messages:
+            entry = self._segment(item)
+            if entry[3] is None:
+                entry[3] = num_tokens_from_string(entry[2], self.model)
+            num_tokens += entry[3]
+        if self._waiting_answer():
+            num_tokens += num_tokens_from_string("A: ", self.model)
+        self._prune_segments()
+        return num_tokens
 
 
 # refer to https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
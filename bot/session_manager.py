@@ -1,6 +1,77 @@
+import os
+import sys
+import threading
+import time
+import weakref
+
+from bot.session_store import SessionStore
 from common.expired_dict import ExpiredDict
 from common.log import logger
-from config import conf
+from config import conf, get_appdata_dir, subscribe_config
+
+SESSION_CLEANUP_INTERVAL = 3600  # 清理磁盘上过期会话的间隔(秒)
+
+
+class Message(object):
+    """
+    会话中的一条消息，使用__slots__减少内存占用，role做字符串驻留
+    兼容dict风格的message["role"]、message["content"]访问，请求时再通过to_dict转换为OpenAI的消息格式
+    """
+
+    __slots__ = ("role", "content")
+    _fields = ("role", "content")
+
+    def __init__(self, role, content):
+        self.role = sys.intern(role)
+        self.content = content
+
+    def __getitem__(self, key):
+        if key not in self._fields:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self._fields:
+            raise KeyError(key)
+        setattr(self, key, sys.intern(value) if key == "role" else value)
+
+    def items(self):
+        return (("role", self.role), ("content", self.content))
+
+    def to_dict(self):
+        return {"role": self.role, "content": self.content}
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+class SystemMessage(Message):
+    """
+    在所有会话间共享的system消息，内容相同的prompt只保存一份，因此不可修改，请通过system_message获取
+    """
+
+    __slots__ = ("__weakref__",)
+
+    def __setitem__(self, key, value):
+        raise TypeError("SystemMessage is shared between sessions and can not be modified")
+
+    def __reduce__(self):
+        # 反序列化时重新从共享池获取，保证去重
+        return system_message, (self.content,)
+
+
+_system_messages = weakref.WeakValueDictionary()
+_system_messages_lock = threading.Lock()
+
+
+def system_message(prompt) -> SystemMessage:
+    """获取内容为prompt的共享system消息"""
+    with _system_messages_lock:
+        message = _system_messages.get(prompt)
+        if message is None:
+            message = SystemMessage("system", prompt)
+            _system_messages[prompt] = message
+        return message
 
 
 class Session(object):
@@ -11,23 +82,73 @@ class Session(object):
             self.system_prompt = conf().get("character_desc", "")
         else:
             self.system_prompt = system_prompt
+        self.system_render_key = None  # 当前system消息渲染时使用的(模板, 参数)
+        self.lock = threading.RLock()  # 处理线程和后台压缩线程都会修改messages，修改时需持有
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("lock", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
 
     # 重置会话
     def reset(self):
-        system_item = {"role": "system", "content": self.system_prompt}
-        self.messages = [system_item]
+        with self.lock:
+            self.messages = [system_message(self.system_prompt)]
+            self.system_render_key = None
+
+    def render_system_prompt(self, template=None, **kwargs):
+        """
+        使用kwargs渲染system prompt模板(默认为会话的system_prompt)，相同的模板和参数只渲染一次
+        只替换system消息，不会修改其它历史消息
+        """
+        if template is None:
+            template = self.system_prompt
+        key = (template, tuple(sorted(kwargs.items())))
+        if key == self.system_render_key:
+            return
+        try:
+            content = template.format(**kwargs)
+        except (KeyError, IndexError, ValueError):
+            content = template
+        with self.lock:
+            self.messages[0] = system_message(content)
+            self.system_render_key = key
 
     def set_system_prompt(self, system_prompt):
-        self.system_prompt = system_prompt
-        self.reset()
+        with self.lock:
+            self.system_prompt = system_prompt
+            self.reset()
 
     def add_query(self, query):
-        user_item = {"role": "user", "content": query}
-        self.messages.append(user_item)
+        with self.lock:
+            self.messages.append(Message("user", query))
 
     def add_reply(self, reply):
-        assistant_item = {"role": "assistant", "content": reply}
-        self.messages.append(assistant_item)
+        with self.lock:
+            self.messages.append(Message("assistant", reply))
+
+    def to_openai_messages(self):
+        """转换为OpenAI接口需要的消息列表"""
+        with self.lock:
+            return [message.to_dict() for message in self.messages]
+
+    def memory_usage(self) -> dict:
+        """
+        估算会话占用的内存(字节)，共享的system消息单独统计，不计入bytes
+        """
+        size = sys.getsizeof(self) + sys.getsizeof(self.__dict__) + sys.getsizeof(self.messages)
+        shared = 0
+        for message in self.messages:
+            message_size = sys.getsizeof(message) + sys.getsizeof(message.content)
+            if isinstance(message, SystemMessage):
+                shared += message_size
+            else:
+                size += message_size
+        return {"session_id": self.session_id, "messages": len(self.messages), "bytes": size, "shared_bytes": shared}
 
     def discard_exceeding(self, max_tokens=None, cur_tokens=None):
         raise NotImplementedError
@@ -38,13 +159,120 @@ class Session(object):
 
 class SessionManager(object):
     def __init__(self, sessioncls, **session_args):
-        if conf().get("expires_in_seconds"):
-            sessions = ExpiredDict(conf().get("expires_in_seconds"))
+        self.store = None
+        self.hibernate_seconds = 0
+        # 会话在sessions、hibernating、hibernated间的移动需在同一把锁下进行，锁内不做文件读写
+        self.lock = threading.RLock()
+        self.hibernating = {}  # 已移出内存、等待后台线程写入磁盘的会话，session_id -> (session, 最后活跃时间)
+        self.hibernated = weakref.WeakValueDictionary()  # 已写入磁盘但仍被其它地方引用的会话，唤醒时直接复用
+        self.waking = {}  # 正在从磁盘唤醒的会话，session_id -> Event
+        expires_in_seconds = conf().get("expires_in_seconds")
+        hibernate_seconds = conf().get("session_hibernate_seconds", 0)
+        if hibernate_seconds and (not expires_in_seconds or hibernate_seconds < expires_in_seconds):
+            # 空闲超过hibernate_seconds的会话保存到磁盘并移出内存，过期时间仍以expires_in_seconds为准
+            self.store = SessionStore(os.path.join(get_appdata_dir(), "sessions"))
+            self.hibernate_seconds = hibernate_seconds
+            sessions = ExpiredDict(hibernate_seconds, on_expire=self._hibernate_session)
+            _thread = threading.Thread(target=self._hibernate_loop, args=(hibernate_seconds,))
+            _thread.setDaemon(True)
+            _thread.start()
+        elif expires_in_seconds:
+            sessions = ExpiredDict(expires_in_seconds, on_expire=self._on_session_expired)
         else:
             sessions = dict()
         self.sessions = sessions
         self.sessioncls = sessioncls
         self.session_args = session_args
+        subscribe_config(self._on_config_changed)
+
+    def _on_config_changed(self, config, old_config):
+        """
+        配置重载后更新会话的过期时间，已在内存中的会话按新的时间重新计算
+        是否开启过期或休眠只在启动时决定，切换需要重启
+        """
+        if not isinstance(self.sessions, ExpiredDict):
+            return
+        with self.lock:
+            if self.store is not None:
+                hibernate_seconds = config.get("session_hibernate_seconds", 0)
+                if hibernate_seconds:
+                    self.hibernate_seconds = hibernate_seconds
+                    self.sessions.set_expires_in(hibernate_seconds)
+            elif config.get("expires_in_seconds"):
+                self.sessions.set_expires_in(config.get("expires_in_seconds"))
+
+    def _on_session_expired(self, session_id, session):
+        logger.debug("[SessionManager] session expired, session_id={}".format(session_id))
+
+    def _hibernate_session(self, session_id, session):
+        # 只登记，由后台线程写入磁盘；会话过期时最后一次访问至少在hibernate_seconds之前
+        with self.lock:
+            self.hibernating[session_id] = (session, time.time() - self.hibernate_seconds)
+
+    def _hibernate_loop(self, hibernate_seconds):
+        # 定期清理，保证没有新消息时空闲会话也能及时移出内存
+        interval = max(1, min(60, hibernate_seconds / 2))
+        next_cleanup = 0
+        while True:
+            try:
+                if time.time() >= next_cleanup and conf().get("expires_in_seconds"):
+                    # 需要遍历整个目录，启动时和之后每隔一段时间执行一次，唤醒时也会检查是否已过期
+                    self.store.cleanup(conf().get("expires_in_seconds"))
+                    next_cleanup = time.time() + SESSION_CLEANUP_INTERVAL
+            except Exception as e:
+                logger.warn("[SessionManager] cleanup hibernated sessions error: {}".format(e))
+            time.sleep(interval)
+            try:
+                with self.lock:
+                    self.sessions.expire()
+                self._flush_hibernating()
+            except Exception as e:
+                logger.warn("[SessionManager] hibernate loop error: {}".format(e))
+
+    def _flush_hibernating(self):
+        """将等待休眠的会话写入磁盘，写入期间被唤醒的会话删除刚写入的文件"""
+        with self.lock:
+            pending = list(self.hibernating.items())
+        for session_id, item in pending:
+            session, last_active = item
+            try:
+                with session.lock:
+                    data = self.store.dumps(session)
+                self.store.write(session_id, data, last_active)
+            except Exception as e:
+                logger.warn("[SessionManager] hibernate session {} error: {}".format(session_id, e))
+                continue
+            with self.lock:
+                # 写入期间会话可能已被唤醒，甚至再次移出内存，此时刚写入的文件已过时
+                written = self.hibernating.get(session_id) is item
+                if written:
+                    del self.hibernating[session_id]
+                    self.hibernated[session_id] = session
+            if written:
+                logger.debug("[SessionManager] session hibernated, session_id={}".format(session_id))
+            else:
+                self.store.delete(session_id)
+
+    def _take_hibernated(self, session_id):
+        """
+        取回还在内存中的已休眠会话，需持有self.lock
+        返回(session, 磁盘上是否有需要删除的文件)
+        """
+        item = self.hibernating.pop(session_id, None)
+        if item is not None:
+            return item[0], False
+        session = self.hibernated.pop(session_id, None)
+        return session, session is not None
+
+    def _wake_session(self, session_id):
+        try:
+            session = self.store.load(session_id, conf().get("expires_in_seconds"))
+        except Exception as e:
+            logger.warn("[SessionManager] wake session {} error: {}".format(session_id, e))
+            return None
+        if session is not None:
+            logger.debug("[SessionManager] session restored, session_id={}".format(session_id))
+        return session
 
     def build_session(self, session_id, system_prompt=None):
         """
@@ -54,39 +282,98 @@ class SessionManager(object):
         if session_id is None:
             return self.sessioncls(session_id, system_prompt, **self.session_args)
 
-        if session_id not in self.sessions:
-            self.sessions[session_id] = self.sessioncls(session_id, system_prompt, **self.session_args)
-        elif system_prompt is not None:  # 如果有新的system_prompt，更新并重置session
-            self.sessions[session_id].set_system_prompt(system_prompt)
-        session = self.sessions[session_id]
+        while True:
+            waking = None
+            stale_file = False
+            with self.lock:
+                # 已过期但还没被清理的会话，get时会同步登记到hibernating，可以直接取回
+                session = self.sessions.get(session_id)
+                if session is None and self.store is not None:
+                    session, stale_file = self._take_hibernated(session_id)
+                    if session is not None:
+                        self.sessions[session_id] = session
+                    else:
+                        waking = self.waking.get(session_id)
+                        if waking is None:
+                            waking = self.waking[session_id] = threading.Event()
+                            break
+                if session is None and waking is None:
+                    session = self.sessioncls(session_id, system_prompt, **self.session_args)
+                    self.sessions[session_id] = session
+                elif session is not None and system_prompt is not None:  # 如果有新的system_prompt，更新并重置session
+                    session.set_system_prompt(system_prompt)
+            if session is not None:
+                if stale_file:
+                    self.store.delete(session_id)
+                return session
+            # 其它线程正在从磁盘唤醒该会话，等待完成后重新获取
+            waking.wait()
+
+        # 在锁外读取磁盘，同一会话只有一个线程在唤醒
+        session = self._wake_session(session_id)
+        with self.lock:
+            if session is None:
+                session = self.sessioncls(session_id, system_prompt, **self.session_args)
+            elif system_prompt is not None:
+                session.set_system_prompt(system_prompt)
+            self.sessions[session_id] = session
+            del self.waking[session_id]
+        waking.set()
         return session
 
     def session_query(self, query, session_id, add_to_history=True):
         session = self.build_session(session_id)
-        if add_to_history:
-            session.add_query(query)
-        try:
-            max_tokens = conf().get("conversation_max_tokens", 1000)
-            total_tokens = session.discard_exceeding(max_tokens, None)
-            logger.debug("prompt tokens used={}".format(total_tokens))
-        except Exception as e:
-            logger.debug("Exception when counting tokens precisely for prompt: {}".format(str(e)))
+        with session.lock:
+            if add_to_history:
+                session.add_query(query)
+            try:
+                max_tokens = conf().get("conversation_max_tokens", 1000)
+                total_tokens = session.discard_exceeding(max_tokens, None)
+                logger.debug("prompt tokens used={}".format(total_tokens))
+            except Exception as e:
+                logger.debug("Exception when counting tokens precisely for prompt: {}".format(str(e)))
         return session
 
     def session_reply(self, reply, session_id, total_tokens=None):
         session = self.build_session(session_id)
-        session.add_reply(reply)
-        try:
-            max_tokens = conf().get("conversation_max_tokens", 1000)
-            tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
-            logger.debug("raw total_tokens={}, savesession tokens={}".format(total_tokens, tokens_cnt))
-        except Exception as e:
-            logger.debug("Exception when counting tokens precisely for session: {}".format(str(e)))
+        with session.lock:
+            session.add_reply(reply)
+            try:
+                max_tokens = conf().get("conversation_max_tokens", 1000)
+                tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
+                logger.debug("raw total_tokens={}, savesession tokens={}".format(total_tokens, tokens_cnt))
+            except Exception as e:
+                logger.debug("Exception when counting tokens precisely for session: {}".format(str(e)))
         return session
 
     def clear_session(self, session_id):
-        if session_id in self.sessions:
-            del self.sessions[session_id]
+        with self.lock:
+            self.sessions.pop(session_id, None)
+            self.hibernating.pop(session_id, None)
+            self.hibernated.pop(session_id, None)
+        if self.store is not None:
+            self.store.delete(session_id)
 
     def clear_all_session(self):
-        self.sessions.clear()
+        with self.lock:
+            self.sessions.clear()
+            self.hibernating.clear()
+            self.hibernated.clear()
+        if self.store is not None:
+            self.store.clear()
+
+    def memory_report(self) -> dict:
+        """
+        统计所有会话的内存占用，用于评估部署规模
+        """
+        reports = [session.memory_usage() for _, session in self.sessions.items()]
+        return {
+            "sessions": len(reports),
+            "hibernated_sessions": self.store.count() if self.store is not None else 0,
+            "hibernating_sessions": len(self.hibernating),
+            "messages": sum(r["messages"] for r in reports),
+            "bytes": sum(r["bytes"] for r in reports),
+            "shared_system_prompts": len(_system_messages),
+            "shared_bytes": sum(sys.getsizeof(m) + sys.getsizeof(m.content) for m in list(_system_messages.values())),
+            "details": reports,
+        }
@@ -0,0 +1,84 @@
+import hashlib
+import os
+import pickle
+import time
+import zlib
+
+from common.log import logger
+
+
+class SessionStore(object):
+    """
+    空闲会话的本地文件存储，每个会话压缩后保存为一个文件，文件修改时间为会话最后活跃的时间
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+
+    def _path(self, session_id):
+        name = hashlib.md5(str(session_id).encode("utf-8")).hexdigest()
+        return os.path.join(self.store_dir, name + ".session")
+
+    @staticmethod
+    def dumps(session):
+        """序列化并压缩会话，不涉及文件读写，调用方可在持有会话锁时调用"""
+        return zlib.compress(pickle.dumps(session, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def save(self, session_id, session, last_active=None):
+        self.write(session_id, self.dumps(session), last_active)
+
+    def write(self, session_id, data, last_active=None):
+        """写入dumps得到的数据"""
+        path = self._path(session_id)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        if last_active is not None:
+            # 过期时间从最后活跃时算起，而不是从休眠时
+            os.utime(tmp_path, (last_active, last_active))
+        os.replace(tmp_path, path)
+
+    def load(self, session_id, max_age=None):
+        """
+        读取并删除休眠的会话，不存在或最后活跃超过max_age秒时返回None
+        """
+        path = self._path(session_id)
+        try:
+            if max_age and time.time() - os.path.getmtime(path) > max_age:
+                os.remove(path)
+                return None
+            with open(path, "rb") as f:
+                data = f.read()
+            os.remove(path)
+        except FileNotFoundError:
+            return None
+        try:
+            return pickle.loads(zlib.decompress(data))
+        except Exception as e:
+            logger.warn("[SessionStore] load session {} error: {}".format(session_id, e))
+            return None
+
+    def delete(self, session_id):
+        try:
+            os.remove(self._path(session_id))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        self.cleanup(0)
+
+    def cleanup(self, max_age):
+        """删除最后活跃超过max_age秒的会话"""
+        now = time.time()
+        for name in os.listdir(self.store_dir):
+            path = os.path.join(self.store_dir, name)
+            try:
+                if now - os.path.getmtime(path) >= max_age:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def count(self):
+        return sum(1 for name in os.listdir(self.store_dir) if name.endswith(".session"))
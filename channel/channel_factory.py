@@ -13,6 +13,10 @@ def create_channel(channel_type):
         from channel.wechat.wechat_channel import WechatChannel
 
         return WechatChannel()
+    elif channel_type == "wx_async":
+        from channel.wechat.wechat_async_channel import WechatAsyncChannel
+
+        return WechatAsyncChannel()
     elif channel_type == "wxy":
         from channel.wechat.wechaty_channel import WechatyChannel
 
@@ -0,0 +1,151 @@
+# encoding:utf-8
+
+"""
+webhook通道(wechatmp, wechatmp_service, wechatcom_app)的http服务
+- 基于cheroot(web.py依赖的WSGI服务器)，线程数、连接队列和超时可配置
+- 收到SIGTERM/SIGINT后就绪检查先失败，等处理中的请求完成后再停止服务
+- 按比例采样记录访问日志，出错的请求总是记录
+- /health 存活检查，/ready 就绪检查，排队的连接或待处理的消息过多时返回503
+"""
+
+import json
+import random
+import signal
+import threading
+import time
+
+from cheroot import wsgi
+
+from common.log import logger
+from config import conf
+
+
+class WebhookServer(object):
+    def __init__(self, app, port, name, backlog_fn=None, stats_fn=None):
+        self.app = app  # web.py生成的WSGI app
+        self.port = port
+        self.name = name
+        self.backlog_fn = backlog_fn  # 返回通道中待处理的消息数
+        self.stats_fn = stats_fn  # 返回通道的状态，附加在检查结果中
+        self.server = None
+        self.cond = threading.Condition()  # 用于控制对计数的访问，请求结束时通知drain线程
+        self.inflight = 0
+        self.requests = 0
+        self.errors = 0
+        self.draining = False
+        self.exit_signal = None  # (原信号处理函数, 信号)，服务停止后再调用
+
+    def serve_forever(self):
+        self.server = wsgi.Server(
+            ("0.0.0.0", self.port),
+            self,
+            numthreads=conf().get("web_server_threads", 30),
+            accepted_queue_size=conf().get("web_server_queue_size", 100),
+            timeout=conf().get("web_server_timeout", 10),
+            shutdown_timeout=conf().get("web_server_drain_timeout", 10),
+            server_name=self.name,
+        )
+        if threading.current_thread() is threading.main_thread():
+            self._handle_signal(signal.SIGTERM)
+            self._handle_signal(signal.SIGINT)
+        logger.info("[{}] http server listening on 0.0.0.0:{}".format(self.name, self.port))
+        self.server.safe_start()
+        logger.info("[{}] http server stopped".format(self.name))
+        if self.exit_signal:
+            old_handler, signo = self.exit_signal
+            if callable(old_handler):
+                old_handler(signo, None)
+
+    # 收到信号后不立即退出，在后台线程中等待处理中的请求完成
+    def _handle_signal(self, signo):
+        old_handler = signal.getsignal(signo)
+
+        def func(_signo, _stack_frame):
+            if self.draining:
+                return
+            logger.info("[{}] signal {} received, draining {} requests...".format(self.name, _signo, self.inflight))
+            self.draining = True
+            self.exit_signal = (old_handler, _signo)
+            threading.Thread(target=self._drain, daemon=True).start()
+
+        signal.signal(signo, func)
+
+    def _drain(self):
+        deadline = time.time() + conf().get("web_server_drain_timeout", 10)
+        with self.cond:
+            while self.inflight > 0 and time.time() < deadline:
+                self.cond.wait(deadline - time.time())
+            if self.inflight > 0:
+                logger.warning("[{}] drain timeout, {} requests still in flight".format(self.name, self.inflight))
+        self.server.stop()
+
+    def status(self):
+        with self.cond:
+            status = {
+                "inflight": self.inflight,
+                "requests": self.requests,
+                "errors": self.errors,
+                "draining": self.draining,
+            }
+        if self.server and self.server.requests:
+            status["idle_threads"] = self.server.requests.idle
+            status["queued_connections"] = self.server.requests.qsize
+        if self.backlog_fn:
+            status["backlog"] = self.backlog_fn()
+        if self.stats_fn:
+            status["channel"] = self.stats_fn()
+        return status
+
+    def is_ready(self, status):
+        if status["draining"]:
+            return False
+        if status.get("queued_connections", 0) > conf().get("web_ready_max_queued", 10):
+            return False
+        return status.get("backlog", 0) <= conf().get("web_ready_max_backlog", 100)
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO", "")
+        if path == "/health":
+            return self._status_response(start_response, False)
+        if path == "/ready":
+            return self._status_response(start_response, True)
+        start_time = time.time()
+        with self.cond:
+            self.inflight += 1
+            self.requests += 1
+        statuses = []
+
+        def _start_response(status, headers, exc_info=None):
+            statuses.append(status)
+            return start_response(status, headers, exc_info)
+
+        failed = True
+        try:
+            # 读完响应体再算请求结束，drain时不会有响应写到一半
+            body = list(self.app(environ, _start_response))
+            failed = not statuses or statuses[-1].startswith("5")
+            return body
+        finally:
+            with self.cond:
+                self.inflight -= 1
+                self.errors += failed
+                self.cond.notify_all()
+            if failed or random.random() < conf().get("web_access_log_sample", 0.1):
+                logger.info(
+                    "[{}] {} {} {} {} {}ms".format(
+                        self.name,
+                        environ.get("REMOTE_ADDR"),
+                        environ.get("REQUEST_METHOD"),
+                        path,
+                        statuses[-1] if statuses else "500",
+                        int((time.time() - start_time) * 1000),
+                    )
+                )
+
+    # 存活检查总是返回200，就绪检查未就绪时返回503
+    def _status_response(self, start_response, check_ready):
+        status = self.status()
+        status["ready"] = self.is_ready(status)
+        ok = status["ready"] or not check_ready
+        start_response("200 OK" if ok else "503 Service Unavailable", [("Content-Type", "application/json")])
+        return [json.dumps(status).encode("utf-8")]
@@ -0,0 +1,257 @@
+# encoding:utf-8
+
+"""
+wechat async channel
+基于lib/itchat/async_components，接收、调度和发送消息都在同一个事件循环中进行，
+只有生成回复(调用插件和bot)在线程池中执行
+回复与同步通道共用发送队列(按接收者保序、全局限速、失败重试)，队列线程把发送协程提交到事件循环
+"""
+
+import asyncio
+import io
+import os
+from collections import deque
+from functools import partial
+
+import requests
+
+from bridge.context import *
+from bridge.reply import *
+from channel.wechat.wechat_channel import MAX_UTF8_LEN, BaseWechatChannel, qrCallback
+from channel.wechat.wechat_message import WechatMessage
+from common.expired_dict import ExpiredDict
+from common.log import logger
+from common.singleton import singleton
+from common.utils import split_string_by_utf8_length
+from config import conf, get_appdata_dir
+from lib import itchat
+from lib.itchat import config as itchat_config
+from lib.itchat.content import *
+from lib.itchat.sending import SendQueue
+from plugins import *
+
+
+@singleton
+class WechatAsyncChannel(BaseWechatChannel):
+    NOT_SUPPORT_REPLYTYPE = []
+
+    def __init__(self):
+        # 不调用ChatChannel.__init__，Context由事件循环调度，不需要consume线程轮询
+        self.receivedMsgs = ExpiredDict(60 * 60 * 24)
+        self.sessions = {}  # session_id -> [排队的Context, 控制并发的信号量, 调度task]
+        self.futures = {}  # session_id -> 正在处理的task
+        self.loop = None
+        self.core = None
+        # 发送函数会等待事件循环执行完成，不能在事件循环中直接执行，至少需要一个发送线程
+        self.send_queue = SendQueue(workers=max(1, itchat_config.SEND_THREADS))
+
+    def startup(self):
+        asyncio.run(self.main())
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.core = itchat.load_async_itchat()
+        self.core.receivingRetryCount = 600  # 修改断线超时时间
+        self.core.receivingRetryTimeout = 600  # 重连间隔逐渐增长，按时间限制，持续断线10分钟后退出
+        self.core.msg_register([TEXT, VOICE, PICTURE, NOTE])(self.handler_single_msg)
+        self.core.msg_register([TEXT, VOICE, PICTURE, NOTE], isGroupChat=True)(self.handler_group_msg)
+        # login by scan QRCode
+        hotReload = conf().get("hot_reload", False)
+        status_path = os.path.join(get_appdata_dir(), "itchat.pkl")
+        await self.core.auto_login(
+            enableCmdQR=2,
+            hotReload=hotReload,
+            statusStorageDir=status_path,
+            qrCallback=self._qr_callback,
+        )
+        self.user_id = self.core.storageClass.userName
+        self.name = self.core.storageClass.nickName
+        logger.info("Wechat login success, user_id: {}, nickname: {}".format(self.user_id, self.name))
+        # start message listener
+        await self.core.run()
+
+    async def _qr_callback(self, uuid, status, qrcode):
+        qrCallback(uuid, status, qrcode)
+
+    async def handler_single_msg(self, msg):
+        try:
+            cmsg = self._wrap_msg(msg, False)
+        except NotImplementedError as e:
+            logger.debug("[WX]single message {} skipped: {}".format(msg["MsgId"], e))
+            return None
+        # 授权检查会读写sqlite，组装Context会调用插件，都放到线程中执行；同一会话的消息由dispatcher保证顺序
+        await self.loop.run_in_executor(None, self.handle_single, cmsg)
+        return None
+
+    async def handler_group_msg(self, msg):
+        try:
+            cmsg = self._wrap_msg(msg, True)
+        except NotImplementedError as e:
+            logger.debug("[WX]group message {} skipped: {}".format(msg["MsgId"], e))
+            return None
+        await self.loop.run_in_executor(None, self.handle_group, cmsg)
+        return None
+
+    def _wrap_msg(self, msg, is_group):
+        cmsg = WechatMessage(msg, is_group, core=self.core)
+        prepare_fn = cmsg._prepare_fn
+        if prepare_fn:
+            # 下载在事件循环中进行，处理线程中调用prepare时等待下载完成
+            cmsg._prepare_fn = lambda: asyncio.run_coroutine_threadsafe(prepare_fn(), self.loop).result()
+        return cmsg
+
+    def _in_loop(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def produce(self, context: Context):
+        if not self._in_loop():
+            self.loop.call_soon_threadsafe(self.produce, context)
+            return
+        session_id = context["session_id"]
+        if session_id not in self.sessions:
+            self.sessions[session_id] = [
+                deque(),
+                asyncio.Semaphore(conf().get("concurrency_in_session", 1)),
+                None,
+            ]
+            self.futures[session_id] = set()
+        session = self.sessions[session_id]
+        if context.type == ContextType.TEXT and context.content.startswith("#"):
+            session[0].appendleft(context)  # 优先处理管理命令
+        else:
+            session[0].append(context)
+        if session[2] is None:
+            session[2] = self.loop.create_task(self.consume_session(session_id))
+
+    # 调度一个会话的消息，同一会话同时最多处理concurrency_in_session个Context
+    async def consume_session(self, session_id):
+        context_queue, semaphore, _ = self.sessions[session_id]
+        while context_queue:
+            await semaphore.acquire()
+            if not context_queue:  # 等待期间会话被重置
+                semaphore.release()
+                break
+            context = context_queue.popleft()
+            logger.debug("[WX] consume context: {}".format(context))
+            task = self.loop.create_task(self._handle_async(context))
+            self.futures[session_id].add(task)
+            task.add_done_callback(self._task_callback(session_id, semaphore))
+        self.sessions[session_id][2] = None
+        self._remove_session_if_idle(session_id)
+
+    def _task_callback(self, session_id, semaphore):
+        def func(task: asyncio.Task):
+            semaphore.release()
+            self.futures[session_id].discard(task)
+            if task.cancelled():
+                logger.info("Worker cancelled, session_id = {}".format(session_id))
+            elif task.exception():
+                logger.exception("Worker return exception: {}".format(task.exception()))
+            else:
+                logger.debug("Worker return success, session_id = {}".format(session_id))
+            self._remove_session_if_idle(session_id)
+
+        return func
+
+    def _remove_session_if_idle(self, session_id):
+        session = self.sessions.get(session_id)
+        if session and not session[0] and not self.futures[session_id] and session[2] is None:
+            del self.sessions[session_id]
+            del self.futures[session_id]
+
+    async def _handle_async(self, context: Context):
+        if context is None or not context.content:
+            return
+        # 生成回复会调用插件和bot，都是阻塞的，放到线程池中执行
+        reply = await self.loop.run_in_executor(self.handler_pool, self._build_reply, context)
+        if reply and reply.type:
+            e_context = PluginManager().emit_event(
+                EventContext(
+                    Event.ON_SEND_REPLY,
+                    {"channel": self, "context": context, "reply": reply},
+                )
+            )
+            reply = e_context["reply"]
+            if not e_context.is_pass() and reply and reply.type:
+                logger.debug("[WX] ready to send reply: {}, context: {}".format(reply, context))
+                self.send(reply, context)
+
+    def _build_reply(self, context: Context):
+        logger.debug("[WX] ready to handle context: {}".format(context))
+        reply = self._generate_reply(context)
+        logger.debug("[WX] ready to decorate reply: {}".format(reply))
+        return self._decorate_reply(context, reply)
+
+    # 排队等待处理的消息数，在事件循环中修改，这里只读长度
+    def pending_count(self):
+        return sum(len(session[0]) for session in list(self.sessions.values()))
+
+    # 只取消排队的消息，正在处理的不会被取消
+    def cancel_session(self, session_id):
+        if not self._in_loop():
+            self.loop.call_soon_threadsafe(self.cancel_session, session_id)
+            return
+        if session_id in self.sessions:
+            cnt = len(self.sessions[session_id][0])
+            if cnt > 0:
+                logger.info("Cancel {} messages in session {}".format(cnt, session_id))
+            self.sessions[session_id][0].clear()
+
+    def cancel_all_session(self):
+        if not self._in_loop():
+            self.loop.call_soon_threadsafe(self.cancel_all_session)
+            return
+        for session_id in list(self.sessions):
+            self.cancel_session(session_id)
+
+    # 在发送队列的线程中调用，把发送协程提交到事件循环执行并等待结果
+    def _call_in_loop(self, fn, *args, **kwargs):
+        return asyncio.run_coroutine_threadsafe(fn(*args, **kwargs), self.loop).result()
+
+    # 回复交给发送队列后立即返回，可以在事件循环或其它线程中调用
+    def send(self, reply: Reply, context: Context):
+        receiver = context["receiver"]
+        if reply.type in [ReplyType.TEXT, ReplyType.ERROR, ReplyType.INFO]:
+            texts = split_string_by_utf8_length(reply.content, MAX_UTF8_LEN)
+            if len(texts) > 1:
+                logger.info("[WX] text too long, split into {} parts".format(len(texts)))
+            for text in texts:
+                self.send_queue.put(receiver, partial(self._call_in_loop, self.core.send, text, toUserName=receiver), "text")
+            logger.info("[WX] queued sendMsg={}, receiver={}".format(reply, receiver))
+        elif reply.type == ReplyType.VOICE:
+            self.send_queue.put(receiver, partial(self._call_in_loop, self.core.send_file, reply.content, toUserName=receiver), "voice")
+            logger.info("[WX] queued sendFile={}, receiver={}".format(reply.content, receiver))
+        elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
+            img_url = reply.content
+
+            def send_image_url():
+                image_storage = _download_image(img_url)
+                return self._call_in_loop(self.core.send_image, image_storage, toUserName=receiver)
+
+            self.send_queue.put(receiver, send_image_url, "image url")
+            logger.info("[WX] queued sendImage url={}, receiver={}".format(img_url, receiver))
+        elif reply.type == ReplyType.IMAGE:  # 从文件读取图片
+            image_storage = reply.content
+
+            def send_image():
+                image_storage.seek(0)  # 重试时从头读取
+                return self._call_in_loop(self.core.send_image, image_storage, toUserName=receiver)
+
+            self.send_queue.put(receiver, send_image, "image")
+            logger.info("[WX] queued sendImage, receiver={}".format(receiver))
+        elif reply.type == ReplyType.FILE:  # 发送文件
+            self.send_queue.put(receiver, partial(self._call_in_loop, self.core.send_file, reply.content, toUserName=receiver), "file")
+            logger.info("[WX] queued sendFile={}, receiver={}".format(reply.content, receiver))
+        logger.debug("[WX] send queue stats: {}".format(self.send_queue.stats()))
+
+
+def _download_image(img_url):
+    pic_res = requests.get(img_url, stream=True)
+    image_storage = io.BytesIO()
+    for block in pic_res.iter_content(1024):
+        image_storage.write(block)
+    image_storage.seek(0)
+    return image_storage
@@ -7,12 +7,13 @@ wechat channel
 import io
 import json
 import os
+import signal
+import sys
 import threading
 import time
-import datetime
+from datetime import datetime
+from functools import partial
 
-from pathlib import Path
-from datetime import datetime, timedelta
 import requests
 from bridge.context import *
 from bridge.reply import *
@@ -22,11 +23,16 @@ from common.expired_dict import ExpiredDict
 from common.log import logger
 from common.singleton import singleton
 from common.time_check import time_checker
+from common.utils import split_string_by_utf8_length
+from common.warrant_store import WarrantStore
 from config import conf, get_appdata_dir
 from lib import itchat
 from lib.itchat.content import *
+from lib.itchat.sending import SendQueue
 from plugins import *
 
+MAX_UTF8_LEN = 4096
+
 
 # 使用itchat库注册消息处理函数，支持处理文本、语音、图片、通知四种消息
 # 这是处理单人聊天消息的函数
@@ -114,32 +120,14 @@ def qrCallback(uuid, status, qrcode):
         qr.print_ascii(invert=True)
 
 
-# 微信聊天通道类，继承了ChatChannel类
-@singleton
-class WechatChannel(ChatChannel):
+# 微信聊天通道的公共部分：消息过滤和构造Context，同步和异步的itchat通道共用
+class BaseWechatChannel(ChatChannel):
     NOT_SUPPORT_REPLYTYPE = []
 
     def __init__(self):
         super().__init__()
         self.receivedMsgs = ExpiredDict(60 * 60 * 24)
 
-    def startup(self):
-        itchat.instance.receivingRetryCount = 600  # 修改断线超时时间
-        # login by scan QRCode
-        hotReload = conf().get("hot_reload", False)
-        status_path = os.path.join(get_appdata_dir(), "itchat.pkl")
-        itchat.auto_login(
-            enableCmdQR=2,
-            hotReload=hotReload,
-            statusStorageDir=status_path,
-            qrCallback=qrCallback,
-        )
-        self.user_id = itchat.instance.storageClass.userName
-        self.name = itchat.instance.storageClass.nickName
-        logger.info("Wechat login success, user_id: {}, nickname: {}".format(self.user_id, self.name))
-        # start message listener
-        itchat.run()
-
     # handle_* 系列函数处理收到的消息后构造Context，然后传入produce函数中处理Context和发送回复
     # Context包含了消息的所有信息，包括以下属性
     #   type 消息类型, 包括TEXT、VOICE、IMAGE_CREATE
@@ -155,176 +143,49 @@ class WechatChannel(ChatChannel):
     @time_checker
     @_check
     def handle_single(self, cmsg: ChatMessage):
-        current_dir = Path(os.getcwd())
-        log_directory = current_dir / 'log'
-        log_directory.mkdir(parents=True, exist_ok=True)
-        warrant_filename = log_directory / 'warrant.json'
-        user_filename = log_directory / 'user.json'
-        if not warrant_filename.is_file():
-            logger.debug("Warrant file does not exist. Creating the file.")
-            with open(warrant_filename, 'w') as file:
-                initial_data = {}
-                json.dump(initial_data, file)
-
-        if not user_filename.is_file():
-            with open(user_filename, 'w') as file:
-                initial_data = [
-                    {
-                        "Signature": "",
-                        "NickName": "",
-                        "Province": "",
-                        "try": 0,
-                        "warrant_code": "",
-                        "value":-1,
-                        "validity_period":""
-                    }
-                ]
-                json.dump(initial_data, file)
-
         content = cmsg._rawmsg["Content"]
-        with open('config.json', 'r', encoding='utf-8') as f:
-            config = json.load(f)
-        max_tries = config['max_tries']
-        warning_message = config['warning_message']
+        user = cmsg._rawmsg["User"]
+        config = conf()
+        max_tries = config.get('max_tries', 10)
+        warning_message = config.get('warning_message', '')
         arrive_message = config.get('arrive_message', 'default_arrive_message')
-
-        if not warrant_filename.is_file():
-            logger.debug("Warrant file does not exist. Creating the file.")
-            with open(warrant_filename, 'w') as file:
-                initial_data = {}
-                json.dump(initial_data, file)
-
-        if not user_filename.is_file():
-            with open(user_filename, 'w') as file:
-                initial_data = [
-                    {
-                        "Signature": "",
-                        "NickName": "",
-                        "Province": "",
-                        "try": 0,
-                        "warrant_code": "",
-                        "value":-1,
-                        "validity_period":""
-                    }
-                ]
-                json.dump(initial_data, file)
+        store = WarrantStore()
 
         if content.startswith("#") and len(content) == 16:
-            logger.debug("Message starts with # and is 11 characters long, potential warrant code.")
+            logger.debug("Message starts with # and is 16 characters long, potential warrant code.")
             warrant_code = content[1:]
             logger.debug(f"Checking if warrant code {warrant_code} is valid and not used yet.")
-
-            # Set the location of your JSON file
-            warrant_filename = 'log/warrant.json'
-
-            with open(warrant_filename, 'r') as file:
-                warrant_data = json.load(file)
-
-            if warrant_code not in warrant_data or warrant_data[warrant_code]["status"] != "未使用":
+            context = {"receiver": cmsg._rawmsg["FromUserName"]}
+            if store.redeem(warrant_code, user) is None:
                 logger.debug("Invalid or already used warrant code.")
-                reply = Reply(type=ReplyType.TEXT, content="授权码无效，请核实或联系管理员")
+                self.send(Reply(type=ReplyType.TEXT, content="授权码无效，请核实或联系管理员"), context)
+            else:
+                self.send(Reply(type=ReplyType.TEXT, content="激活成功"), context)
+                logger.debug(f"Warrant code {warrant_code} used and marked as used.")
+            return
+
+        warrant = True
+        activated_user = store.find_activated(user["Signature"], user["Province"])
+        if activated_user:
+            logger.debug(f'User {activated_user["nickname"]} is an activated user.')
+            activation_date = datetime.strptime(activated_user["activation_time"], '%Y-%m-%d').date()
+            days_since_activation = (datetime.today().date() - activation_date).days
+
+            if days_since_activation == 0:
+                warrant = False
+            elif days_since_activation > abs(activated_user["value"]):
+                reply = Reply(type=ReplyType.TEXT, content=arrive_message)
                 context = {"receiver": cmsg._rawmsg["FromUserName"]}
                 self.send(reply, context)
                 return
-            else:
-                warrant_data[warrant_code]["status"] = "已使用"
-                # Save the updated warrant data
-                with open(warrant_filename, 'w') as file:
-                    json.dump(warrant_data, file, indent=4)
-
-                # Now, update the user info in user.json
-                if os.path.isfile(user_filename):
-                    with open(user_filename, 'r') as file:
-                        data = json.load(file)
-                    # Update the user info
-                    for user in data:
-                        matched = sum(
-                            [user[k] == cmsg._rawmsg["User"][k] for k in ['Signature', 'NickName', 'Province']])
-                        if matched == 3:
-                            user["warrant_code"] = warrant_code
-                            user["value"] = warrant_data[warrant_code]["value"]
-                            user["activation_time"] = datetime.today().date().isoformat()
-                            break
-                    else:  # if no existing user found
-                        data.append({
-                            "Signature": cmsg._rawmsg["User"]["Signature"],
-                            "NickName": cmsg._rawmsg["User"]["NickName"],
-                            "Province": cmsg._rawmsg["User"]["Province"],
-                            "try": 1,
-                            "warrant_code": warrant_code,
-                            "value": warrant_data[warrant_code]["value"],
-                            "activation_time": datetime.date.today().isoformat()
-                        })
-                    # Save the updated user info
-                    with open(user_filename, 'w') as file:
-                        json.dump(data, file, indent=4)
-                else:
-                    logger.error(f"File {user_filename} does not exist.")
-
-                # Send the reply after updating warrant_data and user.json
-                reply = Reply(type=ReplyType.TEXT, content="激活成功")
+
+        if warrant and user["ContactFlag"] not in [1, 2, 3]:
+            logger.debug("Received message from unauthorized user: {}".format(user["NickName"]))
+            if store.add_try(user) > max_tries:
+                reply = Reply(type=ReplyType.TEXT, content=warning_message)
                 context = {"receiver": cmsg._rawmsg["FromUserName"]}
                 self.send(reply, context)
-                logger.debug(f"Warrant code {warrant_code} used and marked as used.")
                 return
-        warrant = True
-        if user_filename.is_file():
-            with open(user_filename, 'r') as file:
-                data = json.load(file)
-
-            for user in data:
-                matched = sum([user[k] == cmsg._rawmsg["User"][k] for k in ['Signature', 'Province']])
-                if matched == 2 and user["warrant_code"] and user["activation_time"]:
-                    logger.debug(f'User {user["NickName"]} is an activated user.')
-
-                    activation_date = datetime.strptime(user["activation_time"], '%Y-%m-%d').date()
-                    days_since_activation = (datetime.today().date() - activation_date).days
-                    print(days_since_activation)
-
-                    if days_since_activation == 0:
-                        warrant = False
-
-                    elif days_since_activation > abs(user["value"]):
-                        reply = Reply(type=ReplyType.TEXT, content=arrive_message)
-                        context = {"receiver": cmsg._rawmsg["FromUserName"]}
-                        self.send(reply, context)
-                        return
-
-
-        if warrant:
-            if cmsg._rawmsg["User"]["ContactFlag"] not in [1, 2, 3]:
-                logger.debug("Received message from unauthorized user: {}".format(cmsg._rawmsg["User"]["NickName"]))
-                user_info = {
-                    "Signature": cmsg._rawmsg["User"]["Signature"],
-                    "NickName": cmsg._rawmsg["User"]["NickName"],
-                    "Province": cmsg._rawmsg["User"]["Province"],
-                    "try": 1,
-                    "warrant_code": "",
-                    "activation_time": ""
-                }
-                if not os.path.exists(user_filename):
-                    with open(user_filename, 'w') as file:
-                        json.dump([user_info], file, indent=4)
-                else:
-                    with open(user_filename, 'r') as file:
-                        data = json.load(file)
-                    for user in data:
-                        if all([user_info[k] == user[k] for k in ['Signature', 'NickName', 'Province']]):
-                            user["try"] += 1
-                            if user["try"] > max_tries:
-                                # Create a new reply
-                                reply = Reply(type=ReplyType.TEXT, content=warning_message)
-                                # Create context for the reply
-                                context = {"receiver": cmsg._rawmsg["FromUserName"]}
-                                # Send the reply
-                                self.send(reply, context)
-                                return
-                            break
-                    else:  # This is executed only if the loop ended normally, i.e., no 'break' was encountered.
-                        data.append(user_info)
-
-                    with open(user_filename, 'w') as file:
-                        json.dump(data, file, indent=4)
 
         if cmsg.ctype == ContextType.VOICE:
             if conf().get("speech_recognition") != True:
@@ -363,29 +224,86 @@ class WechatChannel(ChatChannel):
         if context:
             self.produce(context)
 
+
+# 微信聊天通道类，使用同步的itchat
+@singleton
+class WechatChannel(BaseWechatChannel):
+    def __init__(self):
+        super().__init__()
+        self.send_queue = SendQueue()
+
+    def startup(self):
+        itchat.instance.receivingRetryCount = 600  # 修改断线超时时间
+        itchat.instance.receivingRetryTimeout = 600  # 重连间隔逐渐增长，按时间限制，持续断线10分钟后退出
+        # login by scan QRCode
+        hotReload = conf().get("hot_reload", False)
+        status_path = os.path.join(get_appdata_dir(), "itchat.pkl")
+        itchat.auto_login(
+            enableCmdQR=2,
+            hotReload=hotReload,
+            statusStorageDir=status_path,
+            qrCallback=qrCallback,
+        )
+        self.user_id = itchat.instance.storageClass.userName
+        self.name = itchat.instance.storageClass.nickName
+        logger.info("Wechat login success, user_id: {}, nickname: {}".format(self.user_id, self.name))
+        if threading.current_thread() is threading.main_thread():
+            self._flush_on_signal(signal.SIGTERM)
+            self._flush_on_signal(signal.SIGINT)
+        # start message listener
+        itchat.run()
+
+    # 退出前先把发送队列中已接受的回复发出去，再调用原来的信号处理函数
+    def _flush_on_signal(self, signo):
+        old_handler = signal.getsignal(signo)
+
+        def func(_signo, _stack_frame):
+            logger.info("[WX] flushing send queue before exit, stats: {}".format(self.send_queue.stats()))
+            if not self.send_queue.flush():
+                logger.warning("[WX] send queue not flushed, {} messages dropped".format(self.send_queue.stats()["depth"]))
+            if callable(old_handler):
+                return old_handler(_signo, _stack_frame)
+            sys.exit(0)
+
+        signal.signal(signo, func)
+
     # 统一的发送函数，每个Channel自行实现，根据reply的type字段发送不同类型的消息
+    # 回复交给发送队列后立即返回，由发送队列按接收者保序、全局限速并失败重试
     def send(self, reply: Reply, context: Context):
         receiver = context["receiver"]
-        if reply.type == ReplyType.TEXT:
-            itchat.send(reply.content, toUserName=receiver)
-            logger.info("[WX] sendMsg={}, receiver={}".format(reply, receiver))
-        elif reply.type == ReplyType.ERROR or reply.type == ReplyType.INFO:
-            itchat.send(reply.content, toUserName=receiver)
-            logger.info("[WX] sendMsg={}, receiver={}".format(reply, receiver))
+        if reply.type in [ReplyType.TEXT, ReplyType.ERROR, ReplyType.INFO]:
+            texts = split_string_by_utf8_length(reply.content, MAX_UTF8_LEN)
+            if len(texts) > 1:
+                logger.info("[WX] text too long, split into {} parts".format(len(texts)))
+            for text in texts:
+                self.send_queue.put(receiver, partial(itchat.send, text, toUserName=receiver), "text")
+            logger.info("[WX] queued sendMsg={}, receiver={}".format(reply, receiver))
         elif reply.type == ReplyType.VOICE:
-            itchat.send_file(reply.content, toUserName=receiver)
-            logger.info("[WX] sendFile={}, receiver={}".format(reply.content, receiver))
+            self.send_queue.put(receiver, partial(itchat.send_file, reply.content, toUserName=receiver), "voice")
+            logger.info("[WX] queued sendFile={}, receiver={}".format(reply.content, receiver))
         elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
             img_url = reply.content
-            pic_res = requests.get(img_url, stream=True)
-            image_storage = io.BytesIO()
-            for block in pic_res.iter_content(1024):
-                image_storage.write(block)
-            image_storage.seek(0)
-            itchat.send_image(image_storage, toUserName=receiver)
-            logger.info("[WX] sendImage url={}, receiver={}".format(img_url, receiver))
+
+            def send_image_url():
+                pic_res = requests.get(img_url, stream=True)
+                image_storage = io.BytesIO()
+                for block in pic_res.iter_content(1024):
+                    image_storage.write(block)
+                image_storage.seek(0)
+                return itchat.send_image(image_storage, toUserName=receiver)
+
+            self.send_queue.put(receiver, send_image_url, "image url")
+            logger.info("[WX] queued sendImage url={}, receiver={}".format(img_url, receiver))
         elif reply.type == ReplyType.IMAGE:  # 从文件读取图片
             image_storage = reply.content
-            image_storage.seek(0)
-            itchat.send_image(image_storage, toUserName=receiver)
-            logger.info("[WX] sendImage, receiver={}".format(receiver))
+
+            def send_image():
+                image_storage.seek(0)  # 重试时从头读取
+                return itchat.send_image(image_storage, toUserName=receiver)
+
+            self.send_queue.put(receiver, send_image, "image")
+            logger.info("[WX] queued sendImage, receiver={}".format(receiver))
+        elif reply.type == ReplyType.FILE:  # 发送文件
+            self.send_queue.put(receiver, partial(itchat.send_file, reply.content, toUserName=receiver), "file")
+            logger.info("[WX] queued sendFile={}, receiver={}".format(reply.content, receiver))
+        logger.debug("[WX] send queue stats: {}".format(self.send_queue.stats()))
@@ -9,7 +9,7 @@ from lib.itchat.content import *
 
 
 class WechatMessage(ChatMessage):
-    def __init__(self, itchat_msg, is_group=False):
+    def __init__(self, itchat_msg, is_group=False, core=None):
         super().__init__(itchat_msg)
         self.msg_id = itchat_msg["MsgId"]
         self.create_time = itchat_msg["CreateTime"]
@@ -48,8 +48,9 @@ class WechatMessage(ChatMessage):
         self.from_user_id = itchat_msg["FromUserName"]
         self.to_user_id = itchat_msg["ToUserName"]
 
-        user_id = itchat.instance.storageClass.userName
-        nickname = itchat.instance.storageClass.nickName
+        core = core or itchat.instance  # 异步通道使用自己的itchat实例
+        user_id = core.storageClass.userName
+        nickname = core.storageClass.nickName
 
         # 虽然from_user_id和to_user_id用的少，但是为了保持一致性，还是要填充一下
         # 以下很繁琐，一句话总结：能填的都填了。
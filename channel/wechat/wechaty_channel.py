@@ -30,7 +30,7 @@ except Exception as e:
 
 @singleton
 class WechatyChannel(ChatChannel):
-    NOT_SUPPORT_REPLYTYPE = []
+    NOT_SUPPORT_REPLYTYPE = [ReplyType.FILE]
 
     def __init__(self):
         super().__init__()
@@ -13,6 +13,7 @@ from wechatpy.exceptions import InvalidSignatureException, WeChatClientException
 from bridge.context import Context
 from bridge.reply import Reply, ReplyType
 from channel.chat_channel import ChatChannel
+from channel.http_server import WebhookServer
 from channel.wechatcom.wechatcomapp_client import WechatComAppClient
 from channel.wechatcom.wechatcomapp_message import WechatComAppMessage
 from common.log import logger
@@ -26,7 +27,7 @@ MAX_UTF8_LEN = 2048
 
 @singleton
 class WechatComAppChannel(ChatChannel):
-    NOT_SUPPORT_REPLYTYPE = []
+    NOT_SUPPORT_REPLYTYPE = [ReplyType.FILE]
 
     def __init__(self):
         super().__init__()
@@ -47,7 +48,7 @@ class WechatComAppChannel(ChatChannel):
         urls = ("/wxcomapp", "channel.wechatcom.wechatcomapp_channel.Query")
         app = web.application(urls, globals(), autoreload=False)
         port = conf().get("wechatcomapp_port", 9898)
-        web.httpserver.runsimple(app.wsgifunc(), ("0.0.0.0", port))
+        WebhookServer(app.wsgifunc(), port, "wechatcom", backlog_fn=self.pending_count).serve_forever()
 
     def send(self, reply: Reply, context: Context):
         receiver = context["receiver"]
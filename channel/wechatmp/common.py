@@ -6,6 +6,8 @@ from wechatpy.utils import check_signature
 from config import conf
 
 MAX_UTF8_LEN = 2048
+RUNNING_EXPIRES_IN = 600  # 超过该时间还没生成回复，视为处理丢失
+REQUEST_CNT_EXPIRES_IN = 60  # 微信服务器对同一消息的重试在15秒内完成
 
 
 class WeChatAPIException(Exception):
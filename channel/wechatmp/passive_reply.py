@@ -62,7 +62,7 @@ class Query:
                     logger.debug("[wechatmp] context: {} {} {}".format(context, wechatmp_msg, supported))
 
                     if supported and context:
-                        channel.running.add(from_user)
+                        channel.start_running(from_user)
                         channel.produce(context)
                     else:
                         trigger_prefix = conf().get("single_chat_prefix", [""])[0]
@@ -100,14 +100,8 @@ class Query:
                     )
                 )
 
-                task_running = True
-                waiting_until = request_time + 4
-                while time.time() < waiting_until:
-                    if from_user in channel.running:
-                        time.sleep(0.1)
-                    else:
-                        task_running = False
-                        break
+                # wake up as soon as the reply is generated
+                task_running = not channel.wait_reply(from_user, max(0, request_time + 4 - time.time()))
 
                 reply_text = ""
                 if task_running:
@@ -123,7 +117,7 @@ class Query:
                         return encrypt_func(replyPost.render())
 
                 # reply is ready
-                channel.request_cnt.pop(message_id)
+                channel.request_cnt.pop(message_id, None)
 
                 # no return because of bandwords or other reasons
                 if from_user not in channel.cache_dict and from_user not in channel.running:
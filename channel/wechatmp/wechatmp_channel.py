@@ -14,8 +14,10 @@ from wechatpy.exceptions import WeChatClientException
 from bridge.context import *
 from bridge.reply import *
 from channel.chat_channel import ChatChannel
+from channel.http_server import WebhookServer
 from channel.wechatmp.common import *
 from channel.wechatmp.wechatmp_client import WechatMPClient
+from common.expired_dict import ExpiredDict
 from common.log import logger
 from common.singleton import singleton
 from common.utils import split_string_by_utf8_length
@@ -35,7 +37,7 @@ class WechatMPChannel(ChatChannel):
     def __init__(self, passive_reply=True):
         super().__init__()
         self.passive_reply = passive_reply
-        self.NOT_SUPPORT_REPLYTYPE = []
+        self.NOT_SUPPORT_REPLYTYPE = [ReplyType.FILE]
         appid = conf().get("wechatmp_app_id")
         secret = conf().get("wechatmp_app_secret")
         token = conf().get("wechatmp_token")
@@ -45,12 +47,15 @@ class WechatMPChannel(ChatChannel):
         if aes_key:
             self.crypto = WeChatCrypto(token, aes_key, appid)
         if self.passive_reply:
-            # Cache the reply to the user's first message
-            self.cache_dict = dict()
-            # Record whether the current message is being processed
-            self.running = set()
+            max_size = conf().get("wechatmp_cache_max_size", 10000)
+            self.expired_cnt = {"cache_dict": 0, "running": 0, "request_cnt": 0}
+            self.expired_lock = threading.Lock()
+            # Cache the reply to the user's first message, each page of a long reply is cached with its own expiry
+            self.cache_dict = ExpiredDict(conf().get("wechatmp_reply_expires_in", 3600), max_size, self._on_expire("cache_dict"))
+            # Record whether the current message is being processed, the event is set when the reply is generated
+            self.running = ExpiredDict(RUNNING_EXPIRES_IN, max_size, self._on_expire("running"))
             # Count the request from wechat official server by message_id
-            self.request_cnt = dict()
+            self.request_cnt = ExpiredDict(REQUEST_CNT_EXPIRES_IN, max_size, self._on_expire("request_cnt"))
             # The permanent media need to be deleted to avoid media number limit
             self.delete_media_loop = asyncio.new_event_loop()
             t = threading.Thread(target=self.start_loop, args=(self.delete_media_loop,))
@@ -64,7 +69,8 @@ class WechatMPChannel(ChatChannel):
             urls = ("/wx", "channel.wechatmp.active_reply.Query")
         app = web.application(urls, globals(), autoreload=False)
         port = conf().get("wechatmp_port", 8080)
-        web.httpserver.runsimple(app.wsgifunc(), ("0.0.0.0", port))
+        stats_fn = self.stats if self.passive_reply else None
+        WebhookServer(app.wsgifunc(), port, "wechatmp", backlog_fn=self.pending_count, stats_fn=stats_fn).serve_forever()
 
     def start_loop(self, loop):
         asyncio.set_event_loop(loop)
@@ -204,13 +210,48 @@ class WechatMPChannel(ChatChannel):
                 logger.info("[wechatmp] Do send image to {}".format(receiver))
         return
 
+    def start_running(self, from_user):
+        self.running[from_user] = threading.Event()
+
+    def _finish_running(self, session_id):
+        event = self.running.pop(session_id, None)
+        if event:
+            event.set()
+
+    def wait_reply(self, from_user, timeout):
+        """等待用户的回复生成完毕，返回是否已完成"""
+        event = self.running.peek(from_user)  # 不刷新过期时间
+        if event is None:
+            return True
+        return event.wait(timeout)
+
+    def _on_expire(self, name):
+        def func(key, value):
+            with self.expired_lock:
+                self.expired_cnt[name] += 1
+            logger.info("[wechatmp] {} of {} expired".format(name, key))
+            if name == "running":
+                value.set()  # 唤醒等待的请求
+
+        return func
+
+    def stats(self):
+        with self.expired_lock:
+            expired_cnt = dict(self.expired_cnt)
+        return {
+            "cache_dict": len(self.cache_dict),
+            "running": len(self.running),
+            "request_cnt": len(self.request_cnt),
+            "expired": expired_cnt,
+        }
+
     def _success_callback(self, session_id, context, **kwargs):  # 线程异常结束时的回调函数
         logger.debug("[wechatmp] Success to generate reply, msgId={}".format(context["msg"].msg_id))
         if self.passive_reply:
-            self.running.remove(session_id)
+            self._finish_running(session_id)
 
     def _fail_callback(self, session_id, exception, context, **kwargs):  # 线程异常结束时的回调函数
         logger.exception("[wechatmp] Fail to generate reply to user, msgId={}, exception={}".format(context["msg"].msg_id, exception))
         if self.passive_reply:
             assert session_id not in self.cache_dict
-            self.running.remove(session_id)
+            self._finish_running(session_id)
@@ -1,22 +1,53 @@
-from datetime import datetime, timedelta
+import threading
+from collections import OrderedDict
+from time import monotonic
 
+from common.log import logger
 
-class ExpiredDict(dict):
-    def __init__(self, expires_in_seconds):
-        super().__init__()
+
+class ExpiredDict(object):
+    """
+    带过期时间的字典
+    - 使用单调时钟计时，数据按过期时间先后保存，写入时顺带清理已过期的数据，均摊O(1)
+    - 读取(get/[])会刷新过期时间，peek/in/keys/items/迭代 不会刷新过期时间
+    - max_size大于0时，超出容量会淘汰最久未访问的数据(LRU)
+    - on_expire(key, value)在数据过期或被淘汰时回调，主动删除不会回调
+    """
+
+    def __init__(self, expires_in_seconds, max_size=0, on_expire=None):
         self.expires_in_seconds = expires_in_seconds
+        self.max_size = max_size
+        self.on_expire = on_expire
+        self._data = OrderedDict()  # key -> (value, expiry_time)，越靠前越早过期
+        self._lock = threading.RLock()
 
     def __getitem__(self, key):
-        value, expiry_time = super().__getitem__(key)
-        if datetime.now() > expiry_time:
-            del self[key]
+        evicted = []
+        with self._lock:
+            value, expiry_time = self._data[key]
+            now = monotonic()
+            if now > expiry_time:
+                del self._data[key]
+                evicted.append((key, value))
+            else:
+                self._data[key] = (value, now + self.expires_in_seconds)
+                self._data.move_to_end(key)
+        if evicted:
+            self._notify(evicted)
             raise KeyError("expired {}".format(key))
-        self.__setitem__(key, value)
         return value
 
     def __setitem__(self, key, value):
-        expiry_time = datetime.now() + timedelta(seconds=self.expires_in_seconds)
-        super().__setitem__(key, (value, expiry_time))
+        with self._lock:
+            now = monotonic()
+            self._data[key] = (value, now + self.expires_in_seconds)
+            self._data.move_to_end(key)
+            evicted = self._sweep(now)
+        self._notify(evicted)
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
 
     def get(self, key, default=None):
         try:
@@ -24,19 +55,88 @@ class ExpiredDict(dict):
         except KeyError:
             return default
 
+    def peek(self, key, default=None):
+        now = monotonic()
+        with self._lock:
+            item = self._data.get(key)
+        if item is None or now > item[1]:
+            return default
+        return item[0]
+
+    def pop(self, key, *default):
+        with self._lock:
+            item = self._data.pop(key, None)
+        if item is not None and monotonic() > item[1]:
+            self._notify([(key, item[0])])
+            item = None
+        if item is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        return item[0]
+
     def __contains__(self, key):
-        try:
-            self[key]
-            return True
-        except KeyError:
-            return False
+        with self._lock:
+            item = self._data.get(key)
+        return item is not None and monotonic() <= item[1]
+
+    def __len__(self):
+        self.expire()
+        return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def expire(self):
+        """清理所有已过期的数据"""
+        with self._lock:
+            evicted = self._sweep(monotonic())
+        self._notify(evicted)
+
+    def set_expires_in(self, expires_in_seconds):
+        """修改过期时间，已有数据按新的过期时间重新计算并排序"""
+        with self._lock:
+            delta = expires_in_seconds - self.expires_in_seconds
+            self.expires_in_seconds = expires_in_seconds
+            items = sorted(self._data.items(), key=lambda item: item[1][1])
+            self._data = OrderedDict((key, (value, expiry_time + delta)) for key, (value, expiry_time) in items)
+            evicted = self._sweep(monotonic())
+        self._notify(evicted)
 
     def keys(self):
-        keys = list(super().keys())
-        return [key for key in keys if key in self]
+        return [key for key, _ in self.items()]
+
+    def values(self):
+        return [value for _, value in self.items()]
 
     def items(self):
-        return [(key, self[key]) for key in self.keys()]
+        now = monotonic()
+        with self._lock:
+            return [(key, value) for key, (value, expiry_time) in self._data.items() if now <= expiry_time]
 
     def __iter__(self):
-        return self.keys().__iter__()
+        return iter(self.keys())
+
+    def __repr__(self):
+        return "{}({}, expires_in_seconds={}, max_size={})".format(type(self).__name__, dict(self.items()), self.expires_in_seconds, self.max_size)
+
+    def _sweep(self, now):
+        # 过期时间按插入顺序单调递增，只需从头部开始清理
+        evicted = []
+        while self._data:
+            key, (value, expiry_time) = next(iter(self._data.items()))
+            if expiry_time >= now and (self.max_size <= 0 or len(self._data) <= self.max_size):
+                break
+            del self._data[key]
+            evicted.append((key, value))
+        return evicted
+
+    def _notify(self, evicted):
+        if not self.on_expire:
+            return
+        for key, value in evicted:
+            try:
+                self.on_expire(key, value)
+            except Exception as e:
+                logger.warning("[ExpiredDict] on_expire callback error, key={}: {}".format(key, e))
@@ -0,0 +1,58 @@
+import os
+import threading
+import time
+
+from common.log import logger
+from common.singleton import singleton
+
+
+@singleton
+class FileWatcher(object):
+    """
+    基于修改时间轮询的文件监听，文件创建、修改或删除时调用callback(path)
+    所有文件共用一个后台线程
+    """
+
+    def __init__(self, interval=3):
+        self.interval = interval
+        self.watches = {}  # path -> [mtime, [callback, ...]]
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def watch(self, path, callback):
+        path = os.path.abspath(path)
+        with self.lock:
+            if path not in self.watches:
+                self.watches[path] = [self._mtime(path), []]
+            self.watches[path][1].append(callback)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.setDaemon(True)
+                self.thread.start()
+
+    def unwatch(self, path):
+        with self.lock:
+            self.watches.pop(os.path.abspath(path), None)
+
+    def _mtime(self, path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                watches = list(self.watches.items())
+            for path, watch in watches:
+                mtime = self._mtime(path)
+                if mtime == watch[0]:
+                    continue
+                watch[0] = mtime
+                logger.info("[FileWatcher] file changed: {}".format(path))
+                for callback in list(watch[1]):
+                    try:
+                        callback(path)
+                    except Exception as e:
+                        logger.exception("[FileWatcher] callback error for {}: {}".format(path, e))
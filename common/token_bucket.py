@@ -36,6 +36,15 @@ class TokenBucket:
         self.is_running = False
 
 
+def rebuild_token_bucket(bucket, tpm):
+    """配置变化后调用，速率不变时沿用原令牌桶，tpm为空时关闭限流返回None"""
+    if bucket is not None and tpm and bucket.capacity == int(tpm):
+        return bucket
+    if bucket is not None:
+        bucket.close()
+    return TokenBucket(tpm) if tpm else None
+
+
 if __name__ == "__main__":
     token_bucket = TokenBucket(20, None)  # 创建一个每分钟生产20个tokens的令牌桶
     # token_bucket = TokenBucket(20, 0.1)
@@ -0,0 +1,151 @@
+import os
+import pickle
+import sqlite3
+import threading
+import weakref
+
+from common.expired_dict import ExpiredDict
+from common.log import logger
+
+
+class UserData(dict):
+    """
+    单个用户的数据，修改后立即写入存储
+    """
+
+    def __init__(self, store, user, data=None):
+        super().__init__(data or {})
+        self._store = store
+        self._user = user
+
+    def _save(self):
+        self._store.save(self._user, dict(self))
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._save()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._save()
+
+    def pop(self, key, *args):
+        value = super().pop(key, *args)
+        self._save()
+        return value
+
+    def popitem(self):
+        item = super().popitem()
+        self._save()
+        return item
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        self[key] = default
+        return default
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._save()
+
+    def __ior__(self, other):
+        super().__ior__(other)
+        self._save()
+        return self
+
+    def clear(self):
+        super().clear()
+        self._save()
+
+
+class UserDataStore(object):
+    """
+    按用户保存的数据(私有api_key、模型等)，基于sqlite，每个用户一行
+    - get时按需加载单个用户，近期访问的用户缓存在内存中
+    - 同一用户只有一个UserData实例，缓存过期时仍被持有的实例会被继续使用，避免两个实例互相覆盖
+    - 修改单个用户的数据只写该用户的一行
+    """
+
+    def __init__(self, db_path, cache_seconds=3600):
+        self.db_path = db_path
+        self.lock = threading.RLock()
+        self.cache = ExpiredDict(cache_seconds)  # 保持近期访问用户的强引用
+        self.instances = weakref.WeakValueDictionary()  # 所有仍被持有的UserData
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS user_datas (user TEXT PRIMARY KEY, data BLOB NOT NULL)")
+
+    def get(self, user) -> UserData:
+        with self.lock:
+            data = self.cache.get(user)
+            if data is None:
+                data = self.instances.get(user)
+                if data is None:
+                    row = self.conn.execute("SELECT data FROM user_datas WHERE user = ?", (user,)).fetchone()
+                    data = UserData(self, user, pickle.loads(row[0]) if row else None)
+                    self.instances[user] = data
+                self.cache[user] = data
+            return data
+
+    def save(self, user, data: dict):
+        with self.lock:
+            if data:
+                self.conn.execute("INSERT OR REPLACE INTO user_datas (user, data) VALUES (?, ?)", (user, pickle.dumps(data)))
+            else:
+                self.conn.execute("DELETE FROM user_datas WHERE user = ?", (user,))
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM user_datas").fetchone()[0]
+
+    def import_pickle(self, path):
+        """导入旧版本的user_datas.pkl，已存在的用户会被覆盖"""
+        with open(path, "rb") as f:
+            user_datas = {user: data for user, data in pickle.load(f).items() if data}
+        with self.lock:
+            try:
+                self.conn.execute("BEGIN")
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO user_datas (user, data) VALUES (?, ?)",
+                    [(user, pickle.dumps(dict(data))) for user, data in user_datas.items()],
+                )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            # 已加载的用户直接更新为导入的数据，保证每个用户仍只有一个实例
+            for user, data in user_datas.items():
+                instance = self.instances.get(user)
+                if instance is not None:
+                    dict.clear(instance)
+                    dict.update(instance, data)
+        logger.info("[UserDataStore] imported {} users from {}".format(len(user_datas), path))
+        return len(user_datas)
+
+    def export_pickle(self, path):
+        """导出为旧版本user_datas.pkl的格式"""
+        with self.lock:
+            user_datas = {user: pickle.loads(data) for user, data in self.conn.execute("SELECT user, data FROM user_datas")}
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(user_datas, f)
+        os.replace(tmp_path, path)
+        logger.info("[UserDataStore] exported {} users to {}".format(len(user_datas), path))
+        return len(user_datas)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from config import get_appdata_dir, load_config, user_data_store
+
+    parser = argparse.ArgumentParser(description="import or export user_datas.pkl")
+    parser.add_argument("action", choices=["import", "export"])
+    parser.add_argument("path", nargs="?", default=None)
+    args = parser.parse_args()
+    load_config()
+    path = args.path or os.path.join(get_appdata_dir(), "user_datas.pkl")
+    if args.action == "import":
+        user_data_store().import_pickle(path)
+    else:
+        user_data_store().export_pickle(path)
@@ -0,0 +1,305 @@
+import atexit
+import csv
+import json
+import os
+import random
+import sqlite3
+import string
+import threading
+import time
+from datetime import date
+
+from common.expired_dict import ExpiredDict
+from common.log import logger
+from common.singleton import singleton
+
+WARRANT_UNUSED = "未使用"
+WARRANT_USED = "已使用"
+
+_MISSING = object()
+
+
+def _random_code():
+    return "".join(random.choices(string.ascii_letters + string.digits, k=15))
+
+
+def user_key(user: dict) -> str:
+    """用户的唯一标识，itchat中用户名每次登录都会变化，使用签名、昵称和省份"""
+    return "\x1f".join([user.get("Signature", ""), user.get("NickName", ""), user.get("Province", "")])
+
+
+@singleton
+class WarrantStore(object):
+    """
+    授权码和用户试用次数的存储，基于sqlite
+    - 用户按key索引，读取经过内存缓存，缓存有过期时间和数量上限(LRU)
+    - 试用次数的更新先写入缓存并记录在dirty中，由后台线程批量写回(write-behind)，写回前不会丢失
+    - 授权码的兑换在事务中完成，多线程下同一授权码只能被使用一次
+    首次创建数据库时会导入log/warrant.json和log/user.json
+    """
+
+    def __init__(self, db_path=None, flush_interval=1, cache_seconds=3600, cache_max_size=10000):
+        log_directory = os.path.join(os.getcwd(), "log")
+        os.makedirs(log_directory, exist_ok=True)
+        self.db_path = db_path or os.path.join(log_directory, "warrant.db")
+        self.flush_interval = flush_interval
+        self.lock = threading.RLock()
+        self.users = ExpiredDict(cache_seconds, cache_max_size)  # user_key -> 用户数据，None表示不存在
+        self.activated = ExpiredDict(cache_seconds, cache_max_size)  # (signature, province) -> 已激活的用户数据或None
+        self.dirty = {}  # 待写回试用次数的user_key -> 用户数据，写回前即使被缓存淘汰也从这里读取
+        is_new = not os.path.exists(self.db_path)
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self._create_tables()
+        if is_new:
+            self._import_json(log_directory)
+        atexit.register(self.flush)
+        _thread = threading.Thread(target=self._flush_loop)
+        _thread.setDaemon(True)
+        _thread.start()
+
+    def _create_tables(self):
+        with self.lock:
+            self.conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS warrants (
+                    code TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL,
+                    status TEXT NOT NULL,
+                    created_at REAL,
+                    used_at REAL
+                );
+                CREATE INDEX IF NOT EXISTS idx_warrants_status ON warrants (status);
+                CREATE TABLE IF NOT EXISTS users (
+                    user_key TEXT PRIMARY KEY,
+                    signature TEXT NOT NULL,
+                    nickname TEXT NOT NULL,
+                    province TEXT NOT NULL,
+                    tries INTEGER NOT NULL DEFAULT 0,
+                    warrant_code TEXT NOT NULL DEFAULT '',
+                    value INTEGER NOT NULL DEFAULT -1,
+                    activation_time TEXT NOT NULL DEFAULT ''
+                );
+                CREATE INDEX IF NOT EXISTS idx_users_signature_province ON users (signature, province);
+                CREATE INDEX IF NOT EXISTS idx_users_warrant_code ON users (warrant_code);
+                """
+            )
+
+    def _import_json(self, log_directory):
+        warrant_filename = os.path.join(log_directory, "warrant.json")
+        user_filename = os.path.join(log_directory, "user.json")
+        try:
+            with self.lock:
+                self.conn.execute("BEGIN")
+                if os.path.isfile(warrant_filename):
+                    with open(warrant_filename, "r") as file:
+                        warrants = json.load(file)
+                    self.conn.executemany(
+                        "INSERT OR IGNORE INTO warrants (code, value, status, created_at) VALUES (?, ?, ?, ?)",
+                        [(code, w["value"], w["status"], time.time()) for code, w in warrants.items()],
+                    )
+                if os.path.isfile(user_filename):
+                    with open(user_filename, "r") as file:
+                        users = json.load(file)
+                    self.conn.executemany(
+                        "INSERT OR IGNORE INTO users (user_key, signature, nickname, province, tries, warrant_code, value, activation_time) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        [
+                            (
+                                user_key(u),
+                                u.get("Signature", ""),
+                                u.get("NickName", ""),
+                                u.get("Province", ""),
+                                u.get("try", 0),
+                                u.get("warrant_code", ""),
+                                u.get("value", -1),
+                                u.get("activation_time", ""),
+                            )
+                            for u in users
+                            if any([u.get("Signature"), u.get("NickName"), u.get("Province")])
+                        ],
+                    )
+                self.conn.execute("COMMIT")
+            logger.info("[WarrantStore] imported warrant.json and user.json into {}".format(self.db_path))
+        except Exception as e:
+            self.conn.execute("ROLLBACK")
+            logger.warning("[WarrantStore] import json files error: {}".format(e))
+
+    def _row_to_user(self, row):
+        if row is None:
+            return None
+        return dict(row)
+
+    def get_user(self, user: dict):
+        """按签名、昵称和省份查找用户，返回用户数据dict或None"""
+        key = user_key(user)
+        with self.lock:
+            data = self.dirty.get(key, _MISSING)
+            if data is _MISSING:
+                data = self.users.get(key, _MISSING)
+            if data is _MISSING:
+                row = self.conn.execute("SELECT * FROM users WHERE user_key = ?", (key,)).fetchone()
+                data = self._row_to_user(row)
+                self.users[key] = data
+            return data
+
+    def find_activated(self, signature, province):
+        """查找签名和省份匹配的已激活用户"""
+        key = (signature, province)
+        with self.lock:
+            data = self.activated.get(key, _MISSING)
+            if data is _MISSING:
+                row = self.conn.execute(
+                    "SELECT * FROM users WHERE signature = ? AND province = ? AND warrant_code != '' AND activation_time != '' LIMIT 1",
+                    (signature, province),
+                ).fetchone()
+                data = self._row_to_user(row)
+                self.activated[key] = data
+            return data
+
+    def add_try(self, user: dict) -> int:
+        """试用次数加1，返回加1后的次数，新用户为1"""
+        key = user_key(user)
+        with self.lock:
+            data = self.get_user(user)
+            if data is None:
+                data = {
+                    "user_key": key,
+                    "signature": user.get("Signature", ""),
+                    "nickname": user.get("NickName", ""),
+                    "province": user.get("Province", ""),
+                    "tries": 0,
+                    "warrant_code": "",
+                    "value": -1,
+                    "activation_time": "",
+                }
+                self.users[key] = data
+            data["tries"] += 1
+            self.dirty[key] = data
+            return data["tries"]
+
+    def redeem(self, code, user: dict):
+        """
+        兑换授权码并激活用户，成功返回授权码的有效天数，授权码无效或已使用返回None
+        """
+        key = user_key(user)
+        activation_time = date.today().isoformat()
+        with self.lock:
+            self.flush()
+            try:
+                self.conn.execute("BEGIN IMMEDIATE")
+                row = self.conn.execute("SELECT value FROM warrants WHERE code = ? AND status = ?", (code, WARRANT_UNUSED)).fetchone()
+                if row is None:
+                    self.conn.execute("ROLLBACK")
+                    return None
+                value = row["value"]
+                self.conn.execute("UPDATE warrants SET status = ?, used_at = ? WHERE code = ?", (WARRANT_USED, time.time(), code))
+                self.conn.execute(
+                    "INSERT INTO users (user_key, signature, nickname, province, tries, warrant_code, value, activation_time) VALUES (?, ?, ?, ?, 1, ?, ?, ?) "
+                    "ON CONFLICT(user_key) DO UPDATE SET warrant_code = excluded.warrant_code, value = excluded.value, activation_time = excluded.activation_time",
+                    (key, user.get("Signature", ""), user.get("NickName", ""), user.get("Province", ""), code, value, activation_time),
+                )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.users.pop(key, None)
+            self.activated.clear()
+            return value
+
+    def create_warrant(self, value) -> str:
+        """生成一个新的授权码"""
+        return self.create_warrants(value, 1)[0]
+
+    def create_warrants(self, value, count) -> list:
+        """
+        批量生成count个互不重复的授权码，先用集合去重并批量排除已存在的授权码，再在一个事务中写入
+        """
+        with self.lock:
+            codes = set()
+            while len(codes) < count:
+                batch = {_random_code() for _ in range(count - len(codes))} - codes
+                batch_list = list(batch)
+                for i in range(0, len(batch_list), 500):  # sqlite单条语句的参数个数有限制
+                    chunk = batch_list[i : i + 500]
+                    rows = self.conn.execute("SELECT code FROM warrants WHERE code IN ({})".format(",".join("?" * len(chunk))), chunk)
+                    batch.difference_update(row["code"] for row in rows)
+                codes.update(batch)
+            codes = list(codes)
+            now = time.time()
+            try:
+                self.conn.execute("BEGIN")
+                self.conn.executemany("INSERT INTO warrants (code, value, status, created_at) VALUES (?, ?, ?, ?)", [(code, value, WARRANT_UNUSED, now) for code in codes])
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            return codes
+
+    def export_warrants(self, codes, value, export_dir=None) -> str:
+        """把授权码导出为csv文件，返回文件路径"""
+        export_dir = export_dir or os.path.join(os.path.dirname(self.db_path), "warrants")
+        os.makedirs(export_dir, exist_ok=True)
+        filename = "warrants_{}d_{}_{}.csv".format(value, len(codes), time.strftime("%Y%m%d%H%M%S"))
+        path = os.path.join(export_dir, filename)
+        with open(path, "w", newline="", encoding="utf-8-sig") as f:
+            writer = csv.writer(f)
+            writer.writerow(["warrant_code", "value", "status"])
+            writer.writerows(["#" + code, value, WARRANT_UNUSED] for code in codes)
+        return path
+
+    def warrant_stats(self) -> dict:
+        """统计授权码和用户的使用情况，在数据库中聚合，不加载全部数据"""
+        with self.lock:
+            self.flush()
+            stats = {"total": 0, "used": 0, "unused": 0}
+            for row in self.conn.execute("SELECT status, COUNT(*) AS cnt FROM warrants GROUP BY status"):
+                stats["total"] += row["cnt"]
+                if row["status"] == WARRANT_USED:
+                    stats["used"] += row["cnt"]
+                elif row["status"] == WARRANT_UNUSED:
+                    stats["unused"] += row["cnt"]
+            row = self.conn.execute("SELECT COUNT(*) AS users, COALESCE(SUM(warrant_code != ''), 0) AS activated FROM users").fetchone()
+            stats["users"] = row["users"]
+            stats["activated_users"] = row["activated"]
+            return stats
+
+    def delete_user_warrant(self, code) -> bool:
+        """清除使用该授权码的用户的授权"""
+        with self.lock:
+            self.flush()
+            cursor = self.conn.execute(
+                "UPDATE users SET warrant_code = '' WHERE user_key = (SELECT user_key FROM users WHERE warrant_code = ? LIMIT 1)",
+                (code,),
+            )
+            if cursor.rowcount == 0:
+                return False
+            self.users.clear()
+            self.activated.clear()
+            return True
+
+    def flush(self):
+        """把缓存中的试用次数写回数据库"""
+        with self.lock:
+            if not self.dirty:
+                return
+            rows = list(self.dirty.values())
+            try:
+                self.conn.execute("BEGIN")
+                self.conn.executemany(
+                    "INSERT INTO users (user_key, signature, nickname, province, tries) VALUES (:user_key, :signature, :nickname, :province, :tries) "
+                    "ON CONFLICT(user_key) DO UPDATE SET tries = excluded.tries",
+                    rows,
+                )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.dirty.clear()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning("[WarrantStore] flush error: {}".format(e))
@@ -3,7 +3,6 @@
 import json
 import logging
 import os
-import pickle
 
 from common.log import logger
 
@@ -35,8 +34,13 @@ available_setting = {
     "image_create_size": "256x256",  # 图片大小,可选有 256x256, 512x512, 1024x1024
     # chatgpt会话参数
     "expires_in_seconds": 3600,  # 无操作会话的过期时间
+    "session_hibernate_seconds": 0,  # 会话空闲超过该时间后压缩保存到磁盘并移出内存，再次对话时自动恢复，0表示不开启
     "character_desc": "你是ChatGPT, 一个由OpenAI训练的大型语言模型, 你旨在回答并解决人们的任何问题，并且可以使用多种语言与人交流。",  # 人格描述
     "conversation_max_tokens": 1000,  # 支持上下文记忆的最多字符数
+    "conversation_compact": False,  # 是否开启上下文压缩，超过阈值后在后台把较早的对话总结为一条摘要，而不是直接丢弃
+    "conversation_compact_threshold": 0.8,  # 触发上下文压缩的阈值，为conversation_max_tokens的比例
+    "conversation_compact_keep": 4,  # 压缩时保留不做总结的最近消息条数
+    "conversation_compact_model": "",  # 用于总结的模型，可以使用更便宜的模型，为空则使用model
     # chatgpt限流配置
     "rate_limit_chatgpt": 20,  # chatgpt的调用频率限制
     "rate_limit_dalle": 50,  # openai dalle的调用频率限制
@@ -82,6 +86,8 @@ available_setting = {
     "wechatmp_app_id": "",  # 微信公众平台的appID
     "wechatmp_app_secret": "",  # 微信公众平台的appsecret
     "wechatmp_aes_key": "",  # 微信公众平台的EncodingAESKey，加密模式需要
+    "wechatmp_reply_expires_in": 3600,  # 被动回复模式下，未取走的回复(含长回复的后续页)保存的时间(秒)
+    "wechatmp_cache_max_size": 10000,  # 被动回复模式下，缓存的回复、处理中的用户、请求计数各自的数量上限
     # wechatcom的通用配置
     "wechatcom_corp_id": "",  # 企业微信公司的corpID
     # wechatcomapp的配置
@@ -90,13 +96,22 @@ available_setting = {
     "wechatcomapp_secret": "",  # 企业微信app的secret
     "wechatcomapp_agent_id": "",  # 企业微信app的agent_id
     "wechatcomapp_aes_key": "",  # 企业微信app的aes_key
+    # webhook通道(wechatmp, wechatmp_service, wechatcom_app)http服务的配置
+    "web_server_threads": 30,  # 处理请求的线程数，被动回复模式每个请求最多占用线程6秒
+    "web_server_queue_size": 100,  # 等待线程处理的连接数上限
+    "web_server_timeout": 10,  # 连接读写和keep-alive空闲超时(秒)
+    "web_server_drain_timeout": 10,  # 退出时等待处理中请求完成的最长时间(秒)
+    "web_access_log_sample": 0.1,  # 访问日志的采样比例，出错的请求总是记录
+    "web_ready_max_queued": 10,  # 排队的连接超过该值时就绪检查失败
+    "web_ready_max_backlog": 100,  # 待处理的消息超过该值时就绪检查失败
     # chatgpt指令自定义触发词
     "clear_memory_commands": ["#清除记忆"],  # 重置会话指令，必须以#开头
     # channel配置
-    "channel_type": "wx",  # 通道类型，支持：{wx,wxy,terminal,wechatmp,wechatmp_service,wechatcom_app}
+    "channel_type": "wx",  # 通道类型，支持：{wx,wx_async,wxy,terminal,wechatmp,wechatmp_service,wechatcom_app}
     "subscribe_msg": "",  # 订阅消息, 支持: wechatmp, wechatmp_service, wechatcom_app
     "debug": False,  # 是否开启debug模式，开启后会打印更多日志
     "appdata_dir": "",  # 数据目录
+    "config_watch_interval": 3,  # 检查config.json和插件配置文件变化的间隔(秒)，文件变化后自动重载，0表示不开启
     # 插件配置
     "plugin_trigger_prefix": "$",  # 规范插件提供聊天相关指令的前缀，建议不要和管理员指令前缀"#"冲突
     "max_tries": 10,   #试用次数
@@ -106,75 +121,129 @@ available_setting = {
 }
 
 
+def _check_type(key, value):
+    """
+    按available_setting中默认值的类型校验配置项，能安全转换的会做转换，否则抛出ValueError
+    字符串类型的配置项不做校验
+    """
+    default = available_setting[key]
+    if value is None or isinstance(default, str):
+        return value
+    if isinstance(default, bool):
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, str) and value.lower() in ["true", "false"]:
+            return value.lower() == "true"
+    elif isinstance(default, (int, float)):
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return value
+        if isinstance(value, str):
+            for convert in [type(default), float]:
+                try:
+                    return convert(value)
+                except ValueError:
+                    pass
+    elif isinstance(default, list):
+        if isinstance(value, (list, tuple)):
+            return list(value)
+    else:
+        return value
+    raise ValueError("config {} should be {}, got {!r}".format(key, type(default).__name__, value))
+
+
 class Config(dict):
+    """
+    编译后的只读配置快照，加载完成后不可修改，重新加载时整体替换
+    - conf().get(key, default)和conf()[key]为普通的字典查找
+    - 也可以通过属性访问，如conf().model，配置文件中没有的项返回available_setting中的默认值
+    处理一条消息时可以持有同一个快照，保证读取到的配置一致
+    """
+
     def __init__(self, d=None):
-        super().__init__()
         if d is None:
             d = {}
+        values = {}
         for k, v in d.items():
-            self[k] = v
-        # user_datas: 用户数据，key为用户名，value为用户数据，也是dict
-        self.user_datas = {}
+            if k not in available_setting:
+                raise Exception("key {} not in available_setting".format(k))
+            values[k] = _check_type(k, v)
+        super().__init__(values)
+        for k, default in available_setting.items():
+            self.__dict__[k] = values.get(k, default)
 
-    def __getitem__(self, key):
-        if key not in available_setting:
-            raise Exception("key {} not in available_setting".format(key))
-        return super().__getitem__(key)
+    def __setattr__(self, key, value):
+        if key in available_setting:
+            self._readonly()
+        super().__setattr__(key, value)
 
-    def __setitem__(self, key, value):
-        if key not in available_setting:
-            raise Exception("key {} not in available_setting".format(key))
-        return super().__setitem__(key, value)
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("Config is read-only, modify config.json and reload instead")
 
-    def get(self, key, default=None):
-        try:
-            return self[key]
-        except KeyError as e:
-            return default
-        except Exception as e:
-            raise e
+    __setitem__ = _readonly
+    __delitem__ = _readonly
+    clear = _readonly
+    pop = _readonly
+    popitem = _readonly
+    setdefault = _readonly
+    update = _readonly
 
     # Make sure to return a dictionary to ensure atomic
     def get_user_data(self, user) -> dict:
-        if self.user_datas.get(user) is None:
-            self.user_datas[user] = {}
-        return self.user_datas[user]
+        # 返回的dict修改后会立即持久化
+        return user_data_store().get(user)
 
     def load_user_datas(self):
-        try:
-            with open(os.path.join(get_appdata_dir(), "user_datas.pkl"), "rb") as f:
-                self.user_datas = pickle.load(f)
-                logger.info("[Config] User datas loaded.")
-        except FileNotFoundError as e:
-            logger.info("[Config] User datas file not found, ignore.")
-        except Exception as e:
-            logger.info("[Config] User datas error: {}".format(e))
-            self.user_datas = {}
+        user_data_store()
 
     def save_user_datas(self):
-        try:
-            with open(os.path.join(get_appdata_dir(), "user_datas.pkl"), "wb") as f:
-                pickle.dump(self.user_datas, f)
-                logger.info("[Config] User datas saved.")
-        except Exception as e:
-            logger.info("[Config] User datas error: {}".format(e))
+        # 用户数据在修改时已经保存，这里无需处理
+        pass
 
 
 config = Config()
+config_subscribers = []  # 配置变更的订阅者
+_user_data_store = None
 
 
-def load_config():
-    global config
+def user_data_store():
+    """
+    用户数据存储，key为用户名，value为用户数据dict，首次使用时导入旧版本的user_datas.pkl
+    """
+    global _user_data_store
+    if _user_data_store is None:
+        from common.user_data_store import UserDataStore
+
+        db_path = os.path.join(get_appdata_dir(), "user_datas.db")
+        pkl_path = os.path.join(get_appdata_dir(), "user_datas.pkl")
+        is_new = not os.path.exists(db_path)
+        store = UserDataStore(db_path)
+        if is_new and os.path.exists(pkl_path):
+            try:
+                store.import_pickle(pkl_path)
+            except Exception as e:
+                logger.info("[Config] User datas import error: {}".format(e))
+        _user_data_store = store
+        logger.info("[Config] User datas store opened: {}".format(db_path))
+    return _user_data_store
+
+
+def get_config_path():
     config_path = "./config.json"
     if not os.path.exists(config_path):
         logger.info("配置文件不存在，将使用config-template.json模板")
         config_path = "./config-template.json"
+    return config_path
+
+
+def load_config():
+    global config
+    config_path = get_config_path()
 
     config_str = read_file(config_path)
     logger.debug("[INIT] config str: {}".format(config_str))
 
     # 将json字符串反序列化为dict类型
-    config = Config(json.loads(config_str))
+    values = json.loads(config_str)
 
     # override config with environment variables.
     # Some online deployment platforms (e.g. Railway) deploy project from github directly. So you shouldn't put your secrets like api key in a config file, instead use environment variables to override the default config.
@@ -183,14 +252,19 @@ def load_config():
         if name in available_setting:
             logger.info("[INIT] override config by environ args: {}={}".format(name, value))
             try:
-                config[name] = eval(value)
+                values[name] = eval(value)
             except:
                 if value == "false":
-                    config[name] = False
+                    values[name] = False
                 elif value == "true":
-                    config[name] = True
+                    values[name] = True
                 else:
-                    config[name] = value
+                    values[name] = value
+
+    # 编译为只读快照后整体替换，读取中的线程仍持有旧的快照
+    new_config = Config(values)
+    old_config = config
+    config = new_config
 
     if config.get("debug", False):
         logger.setLevel(logging.DEBUG)
@@ -200,6 +274,46 @@ def load_config():
 
     config.load_user_datas()
 
+    for callback in list(config_subscribers):
+        try:
+            callback(config, old_config)
+        except Exception as e:
+            logger.exception("[INIT] config subscriber error: {}".format(e))
+
+
+def reload_config():
+    """
+    重新加载配置，新配置校验失败时保留当前配置
+    """
+    try:
+        load_config()
+        return True
+    except Exception as e:
+        logger.error("[INIT] reload config failed, keep current config: {}".format(e))
+        return False
+
+
+def subscribe_config(callback):
+    """
+    订阅配置变更，每次加载配置后调用callback(new_config, old_config)
+    """
+    config_subscribers.append(callback)
+
+
+def watch_config():
+    """
+    监听配置文件变化，变化后自动重新加载
+    """
+    interval = conf().get("config_watch_interval", 3)
+    if not interval:
+        return
+    from common.file_watcher import FileWatcher
+
+    watcher = FileWatcher(interval)
+    watcher.watch("./config.json", lambda path: reload_config())
+    if not os.path.exists("./config.json"):
+        watcher.watch("./config-template.json", lambda path: reload_config())
+
 
 def get_root():
     return os.path.dirname(os.path.abspath(__file__))
@@ -13,6 +13,10 @@ __version__ = VERSION
 
 instanceList = []
 
+class AsyncCore(Core):
+    """Core with async components, so that loading them leaves sync Core untouched"""
+
+
 def load_async_itchat() -> Core:
     """load async-based itchat instance
 
@@ -20,8 +24,8 @@ def load_async_itchat() -> Core:
         Core: the abstract interface of itchat
     """
     from .async_components import load_components
-    load_components(Core)
-    return Core()
+    load_components(AsyncCore)
+    return AsyncCore()
 
 
 def load_sync_itchat() -> Core:
@@ -1,4 +1,4 @@
-import time, re, io
+import time, re
 import json, copy
 import logging
 
@@ -115,8 +115,8 @@ def update_local_chatrooms(core, l):
             if 'RemarkName' in member:
                 utils.emoji_formatter(member, 'RemarkName')
         # update it to old chatrooms
-        oldChatroom = utils.search_dict_list(
-            core.chatroomList, 'UserName', chatroom['UserName'])
+        # members are looked up by the UserName index of MemberList
+        oldChatroom = core.chatroomList.search_user_name(chatroom['UserName'])
         if oldChatroom:
             update_info_dict(oldChatroom, chatroom)
             #  - update other values
@@ -124,31 +124,26 @@ def update_local_chatrooms(core, l):
             oldMemberList = oldChatroom['MemberList']
             if memberList:
                 for member in memberList:
-                    oldMember = utils.search_dict_list(
-                        oldMemberList, 'UserName', member['UserName'])
+                    oldMember = oldMemberList.search_user_name(member['UserName'])
                     if oldMember:
                         update_info_dict(oldMember, member)
                     else:
                         oldMemberList.append(member)
         else:
             core.chatroomList.append(chatroom)
-            oldChatroom = utils.search_dict_list(
-                core.chatroomList, 'UserName', chatroom['UserName'])
+            oldChatroom = core.chatroomList.search_user_name(chatroom['UserName'])
         # delete useless members
         if len(chatroom['MemberList']) != len(oldChatroom['MemberList']) and \
                 chatroom['MemberList']:
-            existsUserNames = [member['UserName'] for member in chatroom['MemberList']]
-            delList = []
-            for i, member in enumerate(oldChatroom['MemberList']):
-                if member['UserName'] not in existsUserNames:
-                    delList.append(i)
-            delList.sort(reverse=True)
-            for i in delList:
-                del oldChatroom['MemberList'][i]
+            existsUserNames = set(member['UserName']
+                                  for member in chatroom['MemberList'])
+            oldChatroom['MemberList'][:] = [member
+                for member in oldChatroom['MemberList']
+                if member['UserName'] in existsUserNames]
         #  - update OwnerUin
         if oldChatroom.get('ChatRoomOwner') and oldChatroom.get('MemberList'):
-            owner = utils.search_dict_list(oldChatroom['MemberList'],
-                'UserName', oldChatroom['ChatRoomOwner'])
+            owner = oldChatroom['MemberList'].search_user_name(
+                oldChatroom['ChatRoomOwner'])
             oldChatroom['OwnerUin'] = (owner or {}).get('Uin', 0)
         #  - update IsAdmin
         if 'OwnerUin' in oldChatroom and oldChatroom['OwnerUin'] != 0:
@@ -157,9 +152,10 @@ def update_local_chatrooms(core, l):
         else:
             oldChatroom['IsAdmin'] = None
         #  - update Self
-        newSelf = utils.search_dict_list(oldChatroom['MemberList'],
-            'UserName', core.storageClass.userName)
+        newSelf = oldChatroom['MemberList'].search_user_name(
+            core.storageClass.userName)
         oldChatroom['Self'] = newSelf or copy.deepcopy(core.loginInfo['User'])
+        core.storageClass.mark_dirty(chatroom['UserName'])
     return {
         'Type'         : 'System',
         'Text'         : [chatroom['UserName'] for chatroom in l],
@@ -172,7 +168,6 @@ def update_local_friends(core, l):
     '''
         get a list of friends or mps for updating local contact
     '''
-    fullList = core.memberList + core.mpList
     for friend in l:
         if 'NickName' in friend:
             utils.emoji_formatter(friend, 'NickName')
@@ -180,8 +175,8 @@ def update_local_friends(core, l):
             utils.emoji_formatter(friend, 'DisplayName')
         if 'RemarkName' in friend:
             utils.emoji_formatter(friend, 'RemarkName')
-        oldInfoDict = utils.search_dict_list(
-            fullList, 'UserName', friend['UserName'])
+        oldInfoDict = core.memberList.search_user_name(friend['UserName']) or \
+            core.mpList.search_user_name(friend['UserName'])
         if oldInfoDict is None:
             oldInfoDict = copy.deepcopy(friend)
             if oldInfoDict['VerifyFlag'] & 8 == 0:
@@ -190,6 +185,7 @@ def update_local_friends(core, l):
                 core.mpList.append(oldInfoDict)
         else:
             update_info_dict(oldInfoDict, friend)
+        core.storageClass.mark_dirty(friend['UserName'])
 
 @contact_change
 def update_local_uin(core, msg):
@@ -212,13 +208,14 @@ def update_local_uin(core, msg):
         if 0 < len(uins) == len(usernames):
             for uin, username in zip(uins, usernames):
                 if not '@' in username: continue
-                fullContact = core.memberList + core.chatroomList + core.mpList
-                userDicts = utils.search_dict_list(fullContact,
-                    'UserName', username)
+                userDicts = core.memberList.search_user_name(username) or \
+                    core.chatroomList.search_user_name(username) or \
+                    core.mpList.search_user_name(username)
                 if userDicts:
                     if userDicts.get('Uin', 0) == 0:
                         userDicts['Uin'] = uin
                         usernameChangedList.append(username)
+                        core.storageClass.mark_dirty(username)
                         logger.debug('Uin fetched: %s, %s' % (username, uin))
                     else:
                         if userDicts['Uin'] != uin:
@@ -253,6 +250,7 @@ def update_local_uin(core, msg):
                         else:
                             newFriendDict['Uin'] = uin
                     usernameChangedList.append(username)
+                    core.storageClass.mark_dirty(username)
                     logger.debug('Uin fetched: %s, %s' % (username, uin))
         else:
             logger.debug('Wrong length of uins & usernames: %s, %s' % (
@@ -337,6 +335,8 @@ def set_alias(self, userName, alias):
     r = ReturnValue(rawResponse=r)
     if r:
         oldFriendInfo['RemarkName'] = alias
+        self.storageClass.reset_name_index()
+        self.storageClass.mark_dirty(userName)
     return r
 
 def set_pinned(self, userName, isPinned=True):
@@ -404,18 +404,13 @@ def get_head_img(self, userName=None, chatroomUserName=None, picDir=None):
             params['chatroomid'] =  params.get('chatroomid') or chatroom['UserName']
     headers = { 'User-Agent' : config.USER_AGENT}
     r = self.s.get(url, params=params, stream=True, headers=headers)
-    tempStorage = io.BytesIO()
-    for block in r.iter_content(1024):
-        tempStorage.write(block)
     if picDir is None:
-        return tempStorage.getvalue()
-    with open(picDir, 'wb') as f:
-        f.write(tempStorage.getvalue())
-    tempStorage.seek(0)
+        return utils.stream_download(r)
+    head = utils.stream_download(r, picDir)
     return ReturnValue({'BaseResponse': {
         'ErrMsg': 'Successfully downloaded',
         'Ret': 0, },
-        'PostFix': utils.get_image_postfix(tempStorage.read(20)), })
+        'PostFix': utils.get_image_postfix(head), })
 
 def create_chatroom(self, memberList, topic=''):
     url = '%s/webwxcreatechatroom?pass_ticket=%s&r=%s' % (
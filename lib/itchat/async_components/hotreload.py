@@ -6,8 +6,10 @@ import requests  # type: ignore
 from ..config import VERSION
 from ..returnvalues import ReturnValue
 from ..storage import templates
+from ..storage.checkpoint import ContactCheckpoint
+from ..components.hotreload import dump_login_status as _dump_login_status, start_checkpoint
 from .contact import update_local_chatrooms, update_local_friends
-from .messages import produce_msg
+from .messages import produce_msg, run_blocking
 
 logger = logging.getLogger('itchat')
 
@@ -16,21 +18,7 @@ def load_hotreload(core):
     core.load_login_status = load_login_status
 
 async def dump_login_status(self, fileDir=None):
-    fileDir = fileDir or self.hotReloadDir
-    try:
-        with open(fileDir, 'w') as f:
-            f.write('itchat - DELETE THIS')
-        os.remove(fileDir)
-    except:
-        raise Exception('Incorrect fileDir')
-    status = {
-        'version'   : VERSION,
-        'loginInfo' : self.loginInfo,
-        'cookies'   : self.s.cookies.get_dict(),
-        'storage'   : self.storageClass.dumps()}
-    with open(fileDir, 'wb') as f:
-        pickle.dump(status, f)
-    logger.debug('Dump login status for hot reload successfully.')
+    _dump_login_status(self, fileDir)
 
 async def load_login_status(self, fileDir,
         loginCallback=None, exitCallback=None):
@@ -54,9 +42,19 @@ async def load_login_status(self, fileDir,
     self.loginInfo['User'] = templates.User(self.loginInfo['User'])
     self.loginInfo['User'].core = self
     self.s.cookies = requests.utils.cookiejar_from_dict(j['cookies'])
-    self.storageClass.loads(j['storage'])
+    if 'contacts' in j: # chatrooms are loaded in background
+        contactsDir = os.path.join(os.path.dirname(fileDir), j['contacts'])
+        try:
+            self.storageClass.restore(j['storage'], ContactCheckpoint(contactsDir))
+        except Exception as e:
+            logger.debug('Loading contacts failed: %s' % e)
+            return ReturnValue({'BaseResponse': {
+                'ErrMsg': 'Loading contacts failed.',
+                'Ret': -1002, }})
+    else: # status dumped by older versions
+        self.storageClass.loads(j['storage'])
     try:
-        msgList, contactList = self.get_msg()
+        msgList, contactList = await run_blocking(self.get_msg)
     except:
         msgList = contactList = None
     if (msgList or contactList) is None:
@@ -77,6 +75,7 @@ async def load_login_status(self, fileDir,
             msgList = produce_msg(self, msgList)
             for msg in msgList: self.msgList.put(msg)
         await self.start_receiving(exitCallback)
+        start_checkpoint(self, fileDir)
         logger.debug('loading login status succeeded.')
         if hasattr(loginCallback, '__call__'):
             await loginCallback(self.storageClass.userName)
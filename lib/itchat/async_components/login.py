@@ -1,14 +1,9 @@
 import asyncio
 import os, time, re, io
-import threading
 import json
 import random
 import traceback
 import logging
-try:
-    from httplib import BadStatusLine
-except ImportError:
-    from http.client import BadStatusLine
 
 import requests  # type: ignore
 from pyqrcode import QRCode
@@ -17,7 +12,8 @@ from .. import config, utils
 from ..returnvalues import ReturnValue
 from ..storage.templates import wrap_user_dict
 from .contact import update_local_chatrooms, update_local_friends
-from .messages import produce_msg
+from .messages import produce_msg, run_blocking
+from ..components.login import sync_check, get_msg
 
 logger = logging.getLogger('itchat')
 
@@ -35,84 +31,71 @@ def load_login(core):
 
 async def login(self, enableCmdQR=False, picDir=None, qrCallback=None, EventScanPayload=None,ScanStatus=None,event_stream=None,
         loginCallback=None, exitCallback=None):
+    ''' log in by scanning qrcode
+        * scanning status is emitted to event_stream if given (wechaty puppet)
+        * otherwise qrcode is shown or passed to qrCallback like sync itchat
+    '''
     if self.alive or self.isLogging:
         logger.warning('itchat has already logged in.')
         return
     self.isLogging = True
 
+    async def emit_scan(status):
+        if event_stream is None:
+            return
+        payload = EventScanPayload(
+            status=getattr(ScanStatus, status),
+            qrcode=f"https://login.weixin.qq.com/l/{self.uuid}"
+        )
+        event_stream.emit('scan', payload)
+        await asyncio.sleep(0.1)
+
     while self.isLogging:
         uuid = await push_login(self)
+        qrStorage = io.BytesIO()
         if uuid:
-            payload = EventScanPayload(
-                status=ScanStatus.Waiting,
-                qrcode=f"qrcode/https://login.weixin.qq.com/l/{uuid}"
-            )
-            event_stream.emit('scan', payload)
-            await asyncio.sleep(0.1)
+            await emit_scan('Waiting')
         else:
             logger.info('Getting uuid of QR code.')
-            self.get_QRuuid()
-            payload = EventScanPayload(
-                status=ScanStatus.Waiting,
-                qrcode=f"https://login.weixin.qq.com/l/{self.uuid}"
-            )
-            print(f"https://wechaty.js.org/qrcode/https://login.weixin.qq.com/l/{self.uuid}")
-            event_stream.emit('scan', payload)
-            await asyncio.sleep(0.1)
+            while not await run_blocking(self.get_QRuuid):
+                await asyncio.sleep(1)
+            if event_stream is None:
+                qrStorage = await self.get_QR(enableCmdQR=enableCmdQR,
+                    picDir=picDir, qrCallback=qrCallback)
+            else:
+                print(f"https://wechaty.js.org/qrcode/https://login.weixin.qq.com/l/{self.uuid}")
+                await emit_scan('Waiting')
             # logger.info('Please scan the QR code to log in.')
         isLoggedIn = False
         while not isLoggedIn:
             status = await self.check_login()
-            # if hasattr(qrCallback, '__call__'):
-                # await qrCallback(uuid=self.uuid, status=status, qrcode=self.qrStorage.getvalue())
+            if event_stream is None and hasattr(qrCallback, '__call__'):
+                await qrCallback(uuid=self.uuid, status=status, qrcode=qrStorage.getvalue())
             if status == '200':
                 isLoggedIn = True
-                payload = EventScanPayload(
-                    status=ScanStatus.Scanned,
-                    qrcode=f"https://login.weixin.qq.com/l/{self.uuid}"
-                )
-                event_stream.emit('scan', payload)
-                await asyncio.sleep(0.1)
+                await emit_scan('Scanned')
             elif status == '201':
                 if isLoggedIn is not None:
                     logger.info('Please press confirm on your phone.')
                     isLoggedIn = None
-                    payload = EventScanPayload(
-                        status=ScanStatus.Waiting,
-                        qrcode=f"https://login.weixin.qq.com/l/{self.uuid}"
-                    )
-                    event_stream.emit('scan', payload)
-                    await asyncio.sleep(0.1)
+                    await emit_scan('Waiting')
+                await asyncio.sleep(0.5)
             elif status != '408':
-                payload = EventScanPayload(
-                    status=ScanStatus.Cancel,
-                    qrcode=f"https://login.weixin.qq.com/l/{self.uuid}"
-                )
-                event_stream.emit('scan', payload)
-                await asyncio.sleep(0.1)
+                await emit_scan('Cancel')
                 break
         if isLoggedIn:
-            payload = EventScanPayload(
-                status=ScanStatus.Confirmed,
-                qrcode=f"https://login.weixin.qq.com/l/{self.uuid}"
-            )
-            event_stream.emit('scan', payload)
-            await asyncio.sleep(0.1)
+            await emit_scan('Confirmed')
             break
         elif self.isLogging:
             logger.info('Log in time out, reloading QR code.')
-            payload = EventScanPayload(
-                status=ScanStatus.Timeout,
-                qrcode=f"https://login.weixin.qq.com/l/{self.uuid}"
-            )
-            event_stream.emit('scan', payload)
-            await asyncio.sleep(0.1)
+            await emit_scan('Timeout')
     else:
         return
     logger.info('Loading the contact, this may take a little while.')
     await self.web_init()
     await self.show_mobile_login()
-    self.get_contact(True)
+    await run_blocking(self.get_contact, True)
+    self.chatroomPrefetcher.prefetch()
     if hasattr(loginCallback, '__call__'):
         r = await loginCallback(self.storageClass.userName)
     else:
@@ -129,7 +112,7 @@ async def push_login(core):
         url = '%s/cgi-bin/mmwebwx-bin/webwxpushloginurl?uin=%s' % (
             config.BASE_URL, cookiesDict['wxuin'])
         headers = { 'User-Agent' : config.USER_AGENT}
-        r = core.s.get(url, headers=headers).json()
+        r = (await run_blocking(core.s.get, url, headers=headers)).json()
         if 'uuid' in r and r.get('ret') in (0, '0'):
             core.uuid = r['uuid']
             return r['uuid']
@@ -174,7 +157,7 @@ async def check_login(self, uuid=None):
     params = 'loginicon=true&uuid=%s&tip=1&r=%s&_=%s' % (
         uuid, int(-localTime / 1579), localTime)
     headers = { 'User-Agent' : config.USER_AGENT}
-    r = self.s.get(url, params=params, headers=headers)
+    r = await run_blocking(self.s.get, url, params=params, headers=headers)
     regx = r'window.code=(\d+)'
     data = re.search(regx, r.text)
     if data and data.group(1) == '200':
@@ -200,7 +183,7 @@ async def process_login_info(core, loginContent):
                 'extspam' : config.UOS_PATCH_EXTSPAM,
                 'referer' : 'https://wx.qq.com/?&lang=zh_CN&target=t'
               }
-    r = core.s.get(core.loginInfo['url'], headers=headers, allow_redirects=False)
+    r = await run_blocking(core.s.get, core.loginInfo['url'], headers=headers, allow_redirects=False)
     core.loginInfo['url'] = core.loginInfo['url'][:core.loginInfo['url'].rfind('/')]
     for indexUrl, detailedUrl in (
             ("wx2.qq.com"      , ("file.wx2.qq.com", "webpush.wx2.qq.com")),
@@ -254,7 +237,7 @@ async def web_init(self):
     headers = {
         'ContentType': 'application/json; charset=UTF-8',
         'User-Agent' : config.USER_AGENT, }
-    r = self.s.post(url, params=params, data=json.dumps(data), headers=headers)
+    r = await run_blocking(self.s.post, url, params=params, data=json.dumps(data), headers=headers)
     dic = json.loads(r.content.decode('utf-8', 'replace'))
     # deal with login info
     utils.emoji_formatter(dic['User'], 'NickName')
@@ -296,24 +279,34 @@ async def show_mobile_login(self):
     headers = {
         'ContentType': 'application/json; charset=UTF-8',
         'User-Agent' : config.USER_AGENT, }
-    r = self.s.post(url, data=json.dumps(data), headers=headers)
+    r = await run_blocking(self.s.post, url, data=json.dumps(data), headers=headers)
     return ReturnValue(rawResponse=r)
 
 async def start_receiving(self, exitCallback=None, getReceivingFnOnly=False):
+    ''' receive messages in a task of the running event loop
+        * blocking sync check and sync run in the default executor
+        * msgReady is set when messages are put into msgList
+    '''
     self.alive = True
-    def maintain_loop():
-        retryCount = 0
+    self.msgReady = asyncio.Event()
+    async def maintain_loop():
+        retryCount, failingSince = 0, None
+        stats = self.receivingStats
         while self.alive:
             try:
-                i = sync_check(self)
+                start = time.time()
+                i = await run_blocking(sync_check, self)
+                stats.sync_checked(time.time() - start)
                 if i is None:
                     self.alive = False
                 elif i == '0':
                     pass
                 else:
-                    msgList, contactList = self.get_msg()
+                    msgList, contactList = await run_blocking(self.get_msg)
+                    stats.synced(msgList)
                     if msgList:
-                        msgList = produce_msg(self, msgList)
+                        # may fetch unknown chatroom members, keep it off the loop
+                        msgList = await run_blocking(produce_msg, self, msgList)
                         for msg in msgList:
                             self.msgList.put(msg)
                     if contactList:
@@ -327,17 +320,24 @@ async def start_receiving(self, exitCallback=None, getReceivingFnOnly=False):
                         chatroomMsg['User'] = self.loginInfo['User']
                         self.msgList.put(chatroomMsg)
                         update_local_friends(self, otherList)
-                retryCount = 0
+                    self.msgReady.set()
+                retryCount, failingSince = 0, None
             except requests.exceptions.ReadTimeout:
-                pass
+                stats.timed_out()
+            except asyncio.CancelledError:
+                raise
             except:
                 retryCount += 1
+                failingSince = failingSince or time.time()
+                stats.failed()
                 logger.error(traceback.format_exc())
-                if self.receivingRetryCount < retryCount:
+                if self.receivingRetryCount < retryCount or (self.receivingRetryTimeout
+                        and self.receivingRetryTimeout < time.time() - failingSince):
                     self.alive = False
                 else:
-                    time.sleep(1)
-        self.logout()
+                    await asyncio.sleep(stats.backoff(retryCount))
+        self.msgReady.set()
+        await run_blocking(self.logout)
         if hasattr(exitCallback, '__call__'):
             exitCallback(self.storageClass.userName)
         else:
@@ -345,62 +345,7 @@ async def start_receiving(self, exitCallback=None, getReceivingFnOnly=False):
     if getReceivingFnOnly:
         return maintain_loop
     else:
-        maintainThread = threading.Thread(target=maintain_loop)
-        maintainThread.setDaemon(True)
-        maintainThread.start()
-
-def sync_check(self):
-    url = '%s/synccheck' % self.loginInfo.get('syncUrl', self.loginInfo['url'])
-    params = {
-        'r'        : int(time.time() * 1000),
-        'skey'     : self.loginInfo['skey'],
-        'sid'      : self.loginInfo['wxsid'],
-        'uin'      : self.loginInfo['wxuin'],
-        'deviceid' : self.loginInfo['deviceid'],
-        'synckey'  : self.loginInfo['synckey'],
-        '_'        : self.loginInfo['logintime'], }
-    headers = { 'User-Agent' : config.USER_AGENT}
-    self.loginInfo['logintime'] += 1
-    try:
-        r = self.s.get(url, params=params, headers=headers, timeout=config.TIMEOUT)
-    except requests.exceptions.ConnectionError as e:
-        try:
-            if not isinstance(e.args[0].args[1], BadStatusLine):
-                raise
-            # will return a package with status '0 -'
-            # and value like:
-            # 6f:00:8a:9c:09:74:e4:d8:e0:14:bf:96:3a:56:a0:64:1b:a4:25:5d:12:f4:31:a5:30:f1:c6:48:5f:c3:75:6a:99:93
-            # seems like status of typing, but before I make further achievement code will remain like this
-            return '2'
-        except:
-            raise
-    r.raise_for_status()
-    regx = r'window.synccheck={retcode:"(\d+)",selector:"(\d+)"}'
-    pm = re.search(regx, r.text)
-    if pm is None or pm.group(1) != '0':
-        logger.debug('Unexpected sync check result: %s' % r.text)
-        return None
-    return pm.group(2)
-
-def get_msg(self):
-    self.loginInfo['deviceid'] = 'e' + repr(random.random())[2:17]
-    url = '%s/webwxsync?sid=%s&skey=%s&pass_ticket=%s' % (
-        self.loginInfo['url'], self.loginInfo['wxsid'],
-        self.loginInfo['skey'],self.loginInfo['pass_ticket'])
-    data = {
-        'BaseRequest' : self.loginInfo['BaseRequest'],
-        'SyncKey'     : self.loginInfo['SyncKey'],
-        'rr'          : ~int(time.time()), }
-    headers = {
-        'ContentType': 'application/json; charset=UTF-8',
-        'User-Agent' : config.USER_AGENT }
-    r = self.s.post(url, data=json.dumps(data), headers=headers, timeout=config.TIMEOUT)
-    dic = json.loads(r.content.decode('utf-8', 'replace'))
-    if dic['BaseResponse']['Ret'] != 0: return None, None
-    self.loginInfo['SyncKey'] = dic['SyncKey']
-    self.loginInfo['synckey'] = '|'.join(['%s_%s' % (item['Key'], item['Val'])
-        for item in dic['SyncCheckKey']['List']])
-    return dic['AddMsgList'], dic['ModContactList']
+        self.receivingTask = asyncio.ensure_future(maintain_loop())
 
 def logout(self):
     if self.alive:
@@ -414,9 +359,8 @@ def logout(self):
         self.alive = False
     self.isLogging = False
     self.s.cookies.clear()
-    del self.chatroomList[:]
-    del self.memberList[:]
-    del self.mpList[:]
+    self.storageClass.clear()
+    self.chatroomPrefetcher.clear()
     return ReturnValue({'BaseResponse': {
         'ErrMsg': 'logout successfully.',
         'Ret': 0, }})
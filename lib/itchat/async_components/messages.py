@@ -1,17 +1,24 @@
-import os, time, re, io
+import os, time, re, copy
 import json
-import mimetypes, hashlib
+import asyncio, functools
 import logging
-from collections import OrderedDict
 
 
 from .. import config, utils
 from ..returnvalues import ReturnValue
 from ..storage import templates
 from .contact import update_local_uin
+from ..components.messages import _prepare_file, upload_file, upload_chunk_file
 
 logger = logging.getLogger('itchat')
 
+# a sync batch may have hundreds of messages, so patterns are compiled once
+groupChatRegex = re.compile('(@[0-9a-z]*?):<br/>(.*)$')
+mapRegex = re.compile(r'(.+?\(.+?\))')
+appNoteRegex = re.compile(r'\[CDATA\[(.+?)\][\s\S]+?\[CDATA\[(.+?)\]')
+systemNoteRegex = re.compile(r'\[CDATA\[(.+?)\]\]')
+USELESS_MSG_TYPES = (40, 50, 52, 53, 9999)
+
 def load_messages(core):
     core.send_raw_msg = send_raw_msg
     core.send_msg     = send_msg
@@ -22,63 +29,69 @@ def load_messages(core):
     core.send         = send
     core.revoke       = revoke
 
-async def get_download_fn(core, url, msgId):
-    async def download_fn(downloadDir=None):
+async def run_blocking(fn, *args, **kwargs):
+    ''' run a blocking call (requests, file io) in the default executor
+        so the event loop keeps receiving and sending meanwhile '''
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, functools.partial(fn, *args, **kwargs))
+
+def get_download_fn(core, url, msgId):
+    async def download_fn(downloadDir=None, memoryView=False):
         params = {
             'msgid': msgId,
             'skey': core.loginInfo['skey'],}
         headers = { 'User-Agent' : config.USER_AGENT}
-        r = core.s.get(url, params=params, stream=True, headers = headers)
-        tempStorage = io.BytesIO()
-        for block in r.iter_content(1024):
-            tempStorage.write(block)
+        r = await run_blocking(core.s.get, url, params=params, stream=True, headers = headers)
         if downloadDir is None:
-            return tempStorage.getvalue()
-        with open(downloadDir, 'wb') as f:
-            f.write(tempStorage.getvalue())
-        tempStorage.seek(0)
+            return await run_blocking(utils.stream_download, r, memoryView=memoryView)
+        head = await run_blocking(utils.stream_download, r, downloadDir)
         return ReturnValue({'BaseResponse': {
             'ErrMsg': 'Successfully downloaded',
             'Ret': 0, },
-            'PostFix': utils.get_image_postfix(tempStorage.read(20)), })
+            'PostFix': utils.get_image_postfix(head), })
     return download_fn
 
 def produce_msg(core, msgList):
-    ''' for messages types
+    ''' produce messages of a sync batch
+     * useless messages are dropped first unless a function is registered for them
+     * users of all the messages are looked up in one pass
+    for messages types
      * 40 msg, 43 videochat, 50 VOIPMSG, 52 voipnotifymsg
      * 53 webwxvoipnotifymsg, 9999 sysnotice
     '''
-    rl = []
-    srl = [40, 43, 50, 52, 53, 9999]
+    myUserName = core.storageClass.userName
+    if not any('Useless' in fns for fns in core.functionDict.values()):
+        # nobody replies useless messages, drop them before any work
+        msgList = [m for m in msgList if m['MsgType'] not in USELESS_MSG_TYPES]
+    # produce basic messages, chatroom members may be fetched here
+    opposites = []
     for m in msgList:
-        # get actual opposite
-        if m['FromUserName'] == core.storageClass.userName:
-            actualOpposite = m['ToUserName']
-        else:
-            actualOpposite = m['FromUserName']
-        # produce basic message
         if '@@' in m['FromUserName'] or '@@' in m['ToUserName']:
             produce_group_chat(core, m)
         else:
             utils.msg_formatter(m, 'Content')
-        # set user of msg
-        if '@@' in actualOpposite:
-            m['User'] = core.search_chatrooms(userName=actualOpposite) or \
-                        templates.Chatroom({'UserName': actualOpposite})
-            # we don't need to update chatroom here because we have
-            # updated once when producing basic message
+        opposites.append(m['ToUserName']
+            if m['FromUserName'] == myUserName else m['FromUserName'])
+    # set users of messages, looked up once for the whole batch
+    users = core.storageClass.search_users(set(opposites) - {'filehelper', 'fmessage'})
+    timestamp = time.strftime('%y%m%d-%H%M%S', time.localtime())
+    rl = []
+    for m, actualOpposite in zip(msgList, opposites):
+        if actualOpposite in users:
+            # every message gets its own copy, handlers may change it
+            m['User'] = copy.copy(users[actualOpposite])
+        elif '@@' in actualOpposite:
+            m['User'] = templates.Chatroom({'UserName': actualOpposite})
         elif actualOpposite in ('filehelper', 'fmessage'):
             m['User'] = templates.User({'UserName': actualOpposite})
         else:
-            m['User'] = core.search_mps(userName=actualOpposite) or \
-                        core.search_friends(userName=actualOpposite) or \
-                        templates.User(userName=actualOpposite)
             # by default we think there may be a user missing not a mp
-        m['User'].core = core
+            m['User'] = templates.User(userName=actualOpposite)
+        if m['User'].core is not core:
+            m['User'].core = core
         if m['MsgType'] == 1: # words
             if m['Url']:
-                regx = r'(.+?\(.+?\))'
-                data = re.search(regx, m['Content'])
+                data = mapRegex.search(m['Content'])
                 data = 'Map' if data is None else data.group(1)
                 msg = {
                     'Type': 'Map',
@@ -92,7 +105,7 @@ def produce_msg(core, msgList):
                 '%s/webwxgetmsgimg' % core.loginInfo['url'], m['NewMsgId'])
             msg = {
                 'Type'     : 'Picture',
-                'FileName' : '%s.%s' % (time.strftime('%y%m%d-%H%M%S', time.localtime()),
+                'FileName' : '%s.%s' % (timestamp,
                     'png' if m['MsgType'] == 3 else 'gif'),
                 'Text'     : download_fn, }
         elif m['MsgType'] == 34: # voice
@@ -100,7 +113,7 @@ def produce_msg(core, msgList):
                 '%s/webwxgetvoice' % core.loginInfo['url'], m['NewMsgId'])
             msg = {
                 'Type': 'Recording',
-                'FileName' : '%s.mp3' % time.strftime('%y%m%d-%H%M%S', time.localtime()),
+                'FileName' : '%s.mp3' % timestamp,
                 'Text': download_fn,}
         elif m['MsgType'] == 37: # friends
             m['User']['UserName'] = m['RecommendInfo']['UserName']
@@ -118,26 +131,22 @@ def produce_msg(core, msgList):
                 'Text': m['RecommendInfo'], }
         elif m['MsgType'] in (43, 62): # tiny video
             msgId = m['MsgId']
-            async def download_video(videoDir=None):
+            async def download_video(videoDir=None, memoryView=False):
                 url = '%s/webwxgetvideo' % core.loginInfo['url']
                 params = {
                     'msgid': msgId,
                     'skey': core.loginInfo['skey'],}
                 headers = {'Range': 'bytes=0-', 'User-Agent' : config.USER_AGENT}
-                r = core.s.get(url, params=params, headers=headers, stream=True)
-                tempStorage = io.BytesIO()
-                for block in r.iter_content(1024):
-                    tempStorage.write(block)
+                r = await run_blocking(core.s.get, url, params=params, headers=headers, stream=True)
                 if videoDir is None:
-                    return tempStorage.getvalue()
-                with open(videoDir, 'wb') as f:
-                    f.write(tempStorage.getvalue())
+                    return await run_blocking(utils.stream_download, r, memoryView=memoryView)
+                await run_blocking(utils.stream_download, r, videoDir)
                 return ReturnValue({'BaseResponse': {
                     'ErrMsg': 'Successfully downloaded',
                     'Ret': 0, }})
             msg = {
                 'Type': 'Video',
-                'FileName' : '%s.mp4' % time.strftime('%y%m%d-%H%M%S', time.localtime()),
+                'FileName' : '%s.mp4' % timestamp,
                 'Text': download_video, }
         elif m['MsgType'] == 49: # sharing
             if m['AppMsgType'] == 0: # chat history
@@ -147,7 +156,7 @@ def produce_msg(core, msgList):
             elif m['AppMsgType'] == 6:
                 rawMsg = m
                 cookiesList = {name:data for name,data in core.s.cookies.items()}
-                async def download_atta(attaDir=None):
+                async def download_atta(attaDir=None, memoryView=False):
                     url = core.loginInfo['fileUrl'] + '/webwxgetmedia'
                     params = {
                         'sender': rawMsg['FromUserName'],
@@ -157,14 +166,10 @@ def produce_msg(core, msgList):
                         'pass_ticket': 'undefined',
                         'webwx_data_ticket': cookiesList['webwx_data_ticket'],}
                     headers = { 'User-Agent' : config.USER_AGENT}
-                    r = core.s.get(url, params=params, stream=True, headers=headers)
-                    tempStorage = io.BytesIO()
-                    for block in r.iter_content(1024):
-                        tempStorage.write(block)
+                    r = await run_blocking(core.s.get, url, params=params, stream=True, headers=headers)
                     if attaDir is None:
-                        return tempStorage.getvalue()
-                    with open(attaDir, 'wb') as f:
-                        f.write(tempStorage.getvalue())
+                        return await run_blocking(utils.stream_download, r, memoryView=memoryView)
+                    await run_blocking(utils.stream_download, r, attaDir)
                     return ReturnValue({'BaseResponse': {
                         'ErrMsg': 'Successfully downloaded',
                         'Ret': 0, }})
@@ -177,15 +182,14 @@ def produce_msg(core, msgList):
                 msg = {
                     'Type'     : 'Picture',
                     'FileName' : '%s.gif' % (
-                        time.strftime('%y%m%d-%H%M%S', time.localtime())),
+                        timestamp),
                     'Text'     : download_fn, }
             elif m['AppMsgType'] == 17:
                 msg = {
                     'Type': 'Note',
                     'Text': m['FileName'], }
             elif m['AppMsgType'] == 2000:
-                regx = r'\[CDATA\[(.+?)\][\s\S]+?\[CDATA\[(.+?)\]'
-                data = re.search(regx, m['Content'])
+                data = appNoteRegex.search(m['Content'])
                 if data:
                     data = data.group(2).split(u'\u3002')[0]
                 else:
@@ -204,13 +208,12 @@ def produce_msg(core, msgList):
                 'Type': 'Note',
                 'Text': m['Content'],}
         elif m['MsgType'] == 10002:
-            regx = r'\[CDATA\[(.+?)\]\]'
-            data = re.search(regx, m['Content'])
+            data = systemNoteRegex.search(m['Content'])
             data = 'System message' if data is None else data.group(1).replace('\\', '')
             msg = {
                 'Type': 'Note',
                 'Text': data, }
-        elif m['MsgType'] in srl:
+        elif m['MsgType'] in USELESS_MSG_TYPES:
             msg = {
                 'Type': 'Useless',
                 'Text': 'UselessMsg', }
@@ -219,12 +222,12 @@ def produce_msg(core, msgList):
             msg = {
                 'Type': 'Useless',
                 'Text': 'UselessMsg', }
-        m = dict(m, **msg)
+        m.update(msg) # messages are ours, no need to copy
         rl.append(m)
     return rl
 
 def produce_group_chat(core, msg):
-    r = re.match('(@[0-9a-z]*?):<br/>(.*)$', msg['Content'])
+    r = groupChatRegex.match(msg['Content'])
     if r:
         actualUserName, content = r.groups()
         chatroomUserName = msg['FromUserName']
@@ -242,9 +245,12 @@ def produce_group_chat(core, msg):
     member = utils.search_dict_list((chatroom or {}).get(
         'MemberList') or [], 'UserName', actualUserName)
     if member is None:
-        chatroom = core.update_chatroom(chatroomUserName)
+        # members unknown, fetch now or wait for the prefetch in flight
+        chatroom = core.chatroomPrefetcher.fetch(chatroomUserName)
         member = utils.search_dict_list((chatroom or {}).get(
             'MemberList') or [], 'UserName', actualUserName)
+    else:
+        core.chatroomPrefetcher.refresh(chatroomUserName)
     if member is None:
         logger.debug('chatroom member fetch failed with %s' % actualUserName)
         msg['ActualNickName'] = ''
@@ -273,7 +279,7 @@ async def send_raw_msg(self, msgType, content, toUserName):
             },
         'Scene': 0, }
     headers = { 'ContentType': 'application/json; charset=UTF-8', 'User-Agent' : config.USER_AGENT}
-    r = self.s.post(url, headers=headers,
+    r = await run_blocking(self.s.post, url, headers=headers,
         data=json.dumps(data, ensure_ascii=False).encode('utf8'))
     return ReturnValue(rawResponse=r)
 
@@ -282,89 +288,6 @@ async def send_msg(self, msg='Test Message', toUserName=None):
     r = await self.send_raw_msg(1, msg, toUserName)
     return r
 
-def _prepare_file(fileDir, file_=None):
-    fileDict = {}
-    if file_:
-        if hasattr(file_, 'read'):
-            file_ = file_.read()
-        else:
-            return ReturnValue({'BaseResponse': {
-                'ErrMsg': 'file_ param should be opened file',
-                'Ret': -1005, }})
-    else:
-        if not utils.check_file(fileDir):
-            return ReturnValue({'BaseResponse': {
-                'ErrMsg': 'No file found in specific dir',
-                'Ret': -1002, }})
-        with open(fileDir, 'rb') as f:
-            file_ = f.read()
-    fileDict['fileSize'] = len(file_)
-    fileDict['fileMd5'] = hashlib.md5(file_).hexdigest()
-    fileDict['file_'] = io.BytesIO(file_)
-    return fileDict
-
-def upload_file(self, fileDir, isPicture=False, isVideo=False,
-        toUserName='filehelper', file_=None, preparedFile=None):
-    logger.debug('Request to upload a %s: %s' % (
-        'picture' if isPicture else 'video' if isVideo else 'file', fileDir))
-    if not preparedFile:
-        preparedFile = _prepare_file(fileDir, file_)
-        if not preparedFile:
-            return preparedFile
-    fileSize, fileMd5, file_ = \
-        preparedFile['fileSize'], preparedFile['fileMd5'], preparedFile['file_']
-    fileSymbol = 'pic' if isPicture else 'video' if isVideo else'doc'
-    chunks = int((fileSize - 1) / 524288) + 1
-    clientMediaId = int(time.time() * 1e4)
-    uploadMediaRequest = json.dumps(OrderedDict([
-        ('UploadType', 2),
-        ('BaseRequest', self.loginInfo['BaseRequest']),
-        ('ClientMediaId', clientMediaId),
-        ('TotalLen', fileSize),
-        ('StartPos', 0),
-        ('DataLen', fileSize),
-        ('MediaType', 4),
-        ('FromUserName', self.storageClass.userName),
-        ('ToUserName', toUserName),
-        ('FileMd5', fileMd5)]
-        ), separators = (',', ':'))
-    r = {'BaseResponse': {'Ret': -1005, 'ErrMsg': 'Empty file detected'}}
-    for chunk in range(chunks):
-        r = upload_chunk_file(self, fileDir, fileSymbol, fileSize,
-            file_, chunk, chunks, uploadMediaRequest)
-    file_.close()
-    if isinstance(r, dict):
-        return ReturnValue(r)
-    return ReturnValue(rawResponse=r)
-
-def upload_chunk_file(core, fileDir, fileSymbol, fileSize,
-        file_, chunk, chunks, uploadMediaRequest):
-    url = core.loginInfo.get('fileUrl', core.loginInfo['url']) + \
-        '/webwxuploadmedia?f=json'
-    # save it on server
-    cookiesList = {name:data for name,data in core.s.cookies.items()}
-    fileType = mimetypes.guess_type(fileDir)[0] or 'application/octet-stream'
-    fileName = utils.quote(os.path.basename(fileDir))
-    files = OrderedDict([
-        ('id', (None, 'WU_FILE_0')),
-        ('name', (None, fileName)),
-        ('type', (None, fileType)),
-        ('lastModifiedDate', (None, time.strftime('%a %b %d %Y %H:%M:%S GMT+0800 (CST)'))),
-        ('size', (None, str(fileSize))),
-        ('chunks', (None, None)),
-        ('chunk', (None, None)),
-        ('mediatype', (None, fileSymbol)),
-        ('uploadmediarequest', (None, uploadMediaRequest)),
-        ('webwx_data_ticket', (None, cookiesList['webwx_data_ticket'])),
-        ('pass_ticket', (None, core.loginInfo['pass_ticket'])),
-        ('filename' , (fileName, file_.read(524288), 'application/octet-stream'))])
-    if chunks == 1:
-        del files['chunk']; del files['chunks']
-    else:
-        files['chunk'], files['chunks'] = (None, str(chunk)), (None, str(chunks))
-    headers = { 'User-Agent' : config.USER_AGENT}
-    return core.s.post(url, files=files, headers=headers, timeout=config.TIMEOUT)
-
 async def send_file(self, fileDir, toUserName=None, mediaId=None, file_=None):
     logger.debug('Request to send a file(mediaId: %s) to %s: %s' % (
         mediaId, toUserName, fileDir))
@@ -374,12 +297,14 @@ async def send_file(self, fileDir, toUserName=None, mediaId=None, file_=None):
             'Ret': -1005, }})
     if toUserName is None:
         toUserName = self.storageClass.userName
-    preparedFile = _prepare_file(fileDir, file_)
+    preparedFile = await run_blocking(_prepare_file, fileDir, file_)
     if not preparedFile:
         return preparedFile
     fileSize = preparedFile['fileSize']
-    if mediaId is None:
-        r = self.upload_file(fileDir, preparedFile=preparedFile)
+    if mediaId is not None:
+        preparedFile['file_'].close()
+    else:
+        r = await run_blocking(self.upload_file, fileDir, preparedFile=preparedFile)
         if r:
             mediaId = r['MediaId']
         else:
@@ -401,7 +326,7 @@ async def send_file(self, fileDir, toUserName=None, mediaId=None, file_=None):
     headers = {
         'User-Agent': config.USER_AGENT,
         'Content-Type': 'application/json;charset=UTF-8', }
-    r = self.s.post(url, headers=headers,
+    r = await run_blocking(self.s.post, url, headers=headers,
         data=json.dumps(data, ensure_ascii=False).encode('utf8'))
     return ReturnValue(rawResponse=r)
 
@@ -420,7 +345,8 @@ async def send_image(self, fileDir=None, toUserName=None, mediaId=None, file_=No
     if toUserName is None:
         toUserName = self.storageClass.userName
     if mediaId is None:
-        r = self.upload_file(fileDir, isPicture=not fileDir[-4:] == '.gif', file_=file_)
+        r = await run_blocking(self.upload_file, fileDir,
+            isPicture=not fileDir[-4:] == '.gif', file_=file_)
         if r:
             mediaId = r['MediaId']
         else:
@@ -443,7 +369,7 @@ async def send_image(self, fileDir=None, toUserName=None, mediaId=None, file_=No
     headers = {
         'User-Agent': config.USER_AGENT,
         'Content-Type': 'application/json;charset=UTF-8', }
-    r = self.s.post(url, headers=headers,
+    r = await run_blocking(self.s.post, url, headers=headers,
         data=json.dumps(data, ensure_ascii=False).encode('utf8'))
     return ReturnValue(rawResponse=r)
 
@@ -462,7 +388,7 @@ async def send_video(self, fileDir=None, toUserName=None, mediaId=None, file_=No
     if toUserName is None:
         toUserName = self.storageClass.userName
     if mediaId is None:
-        r = self.upload_file(fileDir, isVideo=True, file_=file_)
+        r = await run_blocking(self.upload_file, fileDir, isVideo=True, file_=file_)
         if r:
             mediaId = r['MediaId']
         else:
@@ -482,7 +408,7 @@ async def send_video(self, fileDir=None, toUserName=None, mediaId=None, file_=No
     headers = {
         'User-Agent' : config.USER_AGENT,
         'Content-Type': 'application/json;charset=UTF-8', }
-    r = self.s.post(url, headers=headers,
+    r = await run_blocking(self.s.post, url, headers=headers,
         data=json.dumps(data, ensure_ascii=False).encode('utf8'))
     return ReturnValue(rawResponse=r)
 
@@ -522,6 +448,6 @@ async def revoke(self, msgId, toUserName, localId=None):
     headers = {
         'ContentType': 'application/json; charset=UTF-8',
         'User-Agent' : config.USER_AGENT }
-    r = self.s.post(url, headers=headers,
+    r = await run_blocking(self.s.post, url, headers=headers,
         data=json.dumps(data, ensure_ascii=False).encode('utf8'))
     return ReturnValue(rawResponse=r)
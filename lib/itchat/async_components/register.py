@@ -1,4 +1,4 @@
-import logging, traceback, sys, threading
+import asyncio, logging, traceback, sys
 try:
     import Queue
 except ImportError:
@@ -7,6 +7,7 @@ except ImportError:
 from ..log import set_logging
 from ..utils import test_connect
 from ..storage import templates
+from ..dispatcher import AsyncMessageDispatcher
 
 logger = logging.getLogger('itchat')
 
@@ -36,19 +37,24 @@ async def auto_login(self, EventScanPayload=None,ScanStatus=None,event_stream=No
         await self.login(enableCmdQR=enableCmdQR, picDir=picDir, qrCallback=qrCallback, EventScanPayload=EventScanPayload, ScanStatus=ScanStatus, event_stream=event_stream,
             loginCallback=loginCallback, exitCallback=exitCallback)
 
-async def configured_reply(self, event_stream, payload, message_container):
+async def configured_reply(self, event_stream=None, payload=None, message_container=None):
     ''' determine the type of message and reply if its method is defined
         however, I use a strange way to determine whether a msg is from massive platform
         I haven't found a better solution here
         The main problem I'm worrying about is the mismatching of new friends added on phone
         If you have any good idea, pleeeease report an issue. I will be more than grateful.
+        * waits for msgReady instead of blocking the event loop on msgList
     '''
     try:
-        msg = self.msgList.get(timeout=1)
-        if 'MsgId' in msg.keys():
+        msg = self.msgList.get_nowait()
+        if message_container is not None and 'MsgId' in msg.keys():
             message_container[msg['MsgId']] = msg
     except Queue.Empty:
-        pass
+        self.msgReady.clear()
+        try:
+            await asyncio.wait_for(self.msgReady.wait(), 1)
+        except asyncio.TimeoutError:
+            pass
     else:
         if isinstance(msg['User'], templates.User):
             replyFn = self.functionDict['FriendChat'].get(msg['Type'])
@@ -59,12 +65,18 @@ async def configured_reply(self, event_stream, payload, message_container):
         if replyFn is None:
             r = None
         else:
-            try:
+            async def reply():
                 r = await replyFn(msg)
                 if r is not None:
                     await self.send(r, msg.get('FromUserName'))
-            except:
-                logger.warning(traceback.format_exc())
+            if self.dispatcher is None:
+                try:
+                    await reply()
+                except:
+                    logger.warning(traceback.format_exc())
+            else:
+                # messages of the same conversation are replied in order
+                self.dispatcher.dispatch(msg['User'].get('UserName'), reply)
 
 def msg_register(self, msgType, isFriendChat=False, isGroupChat=False, isMpChat=False):
     ''' a decorator constructor
@@ -85,22 +97,28 @@ def msg_register(self, msgType, isFriendChat=False, isGroupChat=False, isMpChat=
     return _msg_register
 
 async def run(self, debug=False, blockThread=True):
+    ''' reply messages in the running event loop
+        * blockThread: return only after logout, otherwise replying runs in a task
+    '''
     logger.info('Start auto replying.')
     if debug:
         set_logging(loggingLevel=logging.DEBUG)
+    if self.dispatcher is None:
+        self.dispatcher = AsyncMessageDispatcher()
     async def reply_fn():
         try:
             while self.alive:
                 await self.configured_reply()
-        except KeyboardInterrupt:
+        except (KeyboardInterrupt, asyncio.CancelledError):
             if self.useHotReload:
                 await self.dump_login_status()
             self.alive = False
             logger.debug('itchat received an ^C and exit.')
             logger.info('Bye~')
+        if self.dispatcher is not None:
+            await self.dispatcher.shutdown(wait=False)
+            self.dispatcher = None
     if blockThread:
         await reply_fn()
     else:
-        replyThread = threading.Thread(target=reply_fn)
-        replyThread.setDaemon(True)
-        replyThread.start()
+        self.replyTask = asyncio.ensure_future(reply_fn())
@@ -1,36 +1,87 @@
-import pickle, os
-import logging
+import pickle, os, time
+import logging, threading, traceback
 
 import requests
 
+from .. import config
 from ..config import VERSION
 from ..returnvalues import ReturnValue
 from ..storage import templates
+from ..storage.checkpoint import ContactCheckpoint, write_atomic
 from .contact import update_local_chatrooms, update_local_friends
 from .messages import produce_msg
 
 logger = logging.getLogger('itchat')
 
+dumpLock = threading.Lock()
+
 def load_hotreload(core):
     core.dump_login_status = dump_login_status
     core.load_login_status = load_login_status
 
 def dump_login_status(self, fileDir=None):
+    ''' login status is dumped to fileDir, contacts to fileDir + '.contacts'
+        * both are replaced atomically, so a crash never leaves a broken status
+        * only contacts changed since last dump are written if the contacts
+          file is in sync with storage, otherwise all contacts are written
+    '''
     fileDir = fileDir or self.hotReloadDir
-    try:
-        with open(fileDir, 'w') as f:
-            f.write('itchat - DELETE THIS')
-        os.remove(fileDir)
-    except:
-        raise Exception('Incorrect fileDir')
-    status = {
-        'version'   : VERSION,
-        'loginInfo' : self.loginInfo,
-        'cookies'   : self.s.cookies.get_dict(),
-        'storage'   : self.storageClass.dumps()}
-    with open(fileDir, 'wb') as f:
-        pickle.dump(status, f)
-    logger.debug('Dump login status for hot reload successfully.')
+    with dumpLock:
+        storage = self.storageClass
+        contactsDir = fileDir + '.contacts'
+        checkpoint = storage.checkpoint
+        incremental = checkpoint is not None and \
+            checkpoint.path == os.path.abspath(contactsDir)
+        if not incremental:
+            try:
+                with open(fileDir, 'w') as f:
+                    f.write('itchat - DELETE THIS')
+                os.remove(fileDir)
+            except:
+                raise Exception('Incorrect fileDir')
+            storage.wait_lazy_loading()
+            checkpoint = ContactCheckpoint(contactsDir)
+        rows = storage.checkpoint_rows(incremental)
+        try:
+            checkpoint.save(rows, full=not incremental)
+        except:
+            for row in rows:
+                storage.mark_dirty(row[0])
+            raise
+        if not incremental:
+            if storage.checkpoint is not None:
+                storage.checkpoint.close()
+            storage.checkpoint = checkpoint
+        status = {
+            'version'   : VERSION,
+            'loginInfo' : self.loginInfo,
+            'cookies'   : self.s.cookies.get_dict(),
+            'storage'   : {
+                'userName'          : storage.userName,
+                'nickName'          : storage.nickName,
+                'lastInputUserName' : storage.lastInputUserName, },
+            'contacts'  : os.path.basename(contactsDir), }
+        write_atomic(fileDir, status)
+    logger.debug('Dump login status for hot reload successfully, %s contacts written.' % len(rows))
+    start_checkpoint(self, fileDir)
+
+def start_checkpoint(core, fileDir):
+    ''' dump login status every config.CHECKPOINT_INTERVAL seconds while alive '''
+    if not core.useHotReload or getattr(core, 'checkpointThread', None) is not None:
+        return
+    def checkpoint_loop():
+        while core.alive:
+            time.sleep(config.CHECKPOINT_INTERVAL)
+            if not core.alive:
+                break
+            try:
+                dump_login_status(core, fileDir)
+            except:
+                logger.warning('Dump login status failed: %s' % traceback.format_exc())
+        core.checkpointThread = None
+    core.checkpointThread = threading.Thread(target=checkpoint_loop)
+    core.checkpointThread.setDaemon(True)
+    core.checkpointThread.start()
 
 def load_login_status(self, fileDir,
         loginCallback=None, exitCallback=None):
@@ -54,7 +105,17 @@ def load_login_status(self, fileDir,
     self.loginInfo['User'] = templates.User(self.loginInfo['User'])
     self.loginInfo['User'].core = self
     self.s.cookies = requests.utils.cookiejar_from_dict(j['cookies'])
-    self.storageClass.loads(j['storage'])
+    if 'contacts' in j: # chatrooms are loaded in background
+        contactsDir = os.path.join(os.path.dirname(fileDir), j['contacts'])
+        try:
+            self.storageClass.restore(j['storage'], ContactCheckpoint(contactsDir))
+        except Exception as e:
+            logger.debug('Loading contacts failed: %s' % e)
+            return ReturnValue({'BaseResponse': {
+                'ErrMsg': 'Loading contacts failed.',
+                'Ret': -1002, }})
+    else: # status dumped by older versions
+        self.storageClass.loads(j['storage'])
     try:
         msgList, contactList = self.get_msg()
     except:
@@ -77,6 +138,7 @@ def load_login_status(self, fileDir,
             msgList = produce_msg(self, msgList)
             for msg in msgList: self.msgList.put(msg)
         self.start_receiving(exitCallback)
+        start_checkpoint(self, fileDir)
         logger.debug('loading login status succeeded.')
         if hasattr(loginCallback, '__call__'):
             loginCallback()
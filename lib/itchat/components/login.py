@@ -82,6 +82,7 @@ def login(self, enableCmdQR=False, picDir=None, qrCallback=None,
     self.web_init()
     self.show_mobile_login()
     self.get_contact(True)
+    self.chatroomPrefetcher.prefetch()
     if hasattr(loginCallback, '__call__'):
         r = loginCallback()
     else:
@@ -289,16 +290,20 @@ def start_receiving(self, exitCallback=None, getReceivingFnOnly=False):
     self.alive = True
 
     def maintain_loop():
-        retryCount = 0
+        retryCount, failingSince = 0, None
+        stats = self.receivingStats
         while self.alive:
             try:
+                start = time.time()
                 i = sync_check(self)
+                stats.sync_checked(time.time() - start)
                 if i is None:
                     self.alive = False
                 elif i == '0':
                     pass
                 else:
                     msgList, contactList = self.get_msg()
+                    stats.synced(msgList)
                     if msgList:
                         msgList = produce_msg(self, msgList)
                         for msg in msgList:
@@ -315,18 +320,21 @@ def start_receiving(self, exitCallback=None, getReceivingFnOnly=False):
                         chatroomMsg['User'] = self.loginInfo['User']
                         self.msgList.put(chatroomMsg)
                         update_local_friends(self, otherList)
-                retryCount = 0
+                retryCount, failingSince = 0, None
             except requests.exceptions.ReadTimeout:
-                pass
+                stats.timed_out()
             except:
                 retryCount += 1
+                failingSince = failingSince or time.time()
+                stats.failed()
                 logger.error(traceback.format_exc())
-                if self.receivingRetryCount < retryCount:
+                if self.receivingRetryCount < retryCount or (self.receivingRetryTimeout
+                        and self.receivingRetryTimeout < time.time() - failingSince):
                     logger.error("Having tried %s times, but still failed. " % (
                         retryCount) + "Stop trying...")
                     self.alive = False
                 else:
-                    time.sleep(1)
+                    time.sleep(stats.backoff(retryCount))
         self.logout()
         if hasattr(exitCallback, '__call__'):
             exitCallback()
@@ -353,8 +361,9 @@ def sync_check(self):
     headers = {'User-Agent': config.USER_AGENT}
     self.loginInfo['logintime'] += 1
     try:
+        # server holds sync check until messages come, so read timeout follows its rtt
         r = self.s.get(url, params=params, headers=headers,
-                       timeout=config.TIMEOUT)
+                       timeout=(config.TIMEOUT[0], self.receivingStats.read_timeout()))
     except requests.exceptions.ConnectionError as e:
         try:
             if not isinstance(e.args[0].args[1], BadStatusLine):
@@ -376,7 +385,6 @@ def sync_check(self):
 
 
 def get_msg(self):
-    self.loginInfo['deviceid'] = 'e' + repr(random.random())[2:17]
     url = '%s/webwxsync?sid=%s&skey=%s&pass_ticket=%s' % (
         self.loginInfo['url'], self.loginInfo['wxsid'],
         self.loginInfo['skey'], self.loginInfo['pass_ticket'])
@@ -393,8 +401,10 @@ def get_msg(self):
     if dic['BaseResponse']['Ret'] != 0:
         return None, None
     self.loginInfo['SyncKey'] = dic['SyncKey']
-    self.loginInfo['synckey'] = '|'.join(['%s_%s' % (item['Key'], item['Val'])
-                                          for item in dic['SyncCheckKey']['List']])
+    if dic['SyncCheckKey'] != self.loginInfo.get('SyncCheckKey'):
+        self.loginInfo['SyncCheckKey'] = dic['SyncCheckKey']
+        self.loginInfo['synckey'] = '|'.join(['%s_%s' % (item['Key'], item['Val'])
+                                              for item in dic['SyncCheckKey']['List']])
     return dic['AddMsgList'], dic['ModContactList']
 
 
@@ -410,9 +420,8 @@ def logout(self):
         self.alive = False
     self.isLogging = False
     self.s.cookies.clear()
-    del self.chatroomList[:]
-    del self.memberList[:]
-    del self.mpList[:]
+    self.storageClass.clear()
+    self.chatroomPrefetcher.clear()
     return ReturnValue({'BaseResponse': {
         'ErrMsg': 'logout successfully.',
         'Ret': 0, }})
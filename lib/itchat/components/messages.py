@@ -1,8 +1,9 @@
-import os, time, re, io
-import json
+import os, time, re, io, copy
+import json, mmap
 import mimetypes, hashlib
-import logging
+import logging, threading
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 
@@ -13,6 +14,15 @@ from .contact import update_local_uin
 
 logger = logging.getLogger('itchat')
 
+# a sync batch may have hundreds of messages, so patterns are compiled once
+groupChatRegex = re.compile('(@[0-9a-z]*?):<br/>(.*)$')
+mapRegex = re.compile(r'(.+?\(.+?\))')
+appNoteRegex = re.compile(r'\[CDATA\[(.+?)\][\s\S]+?\[CDATA\[(.+?)\]')
+systemNoteRegex = re.compile(r'\[CDATA\[(.+?)\]\]')
+USELESS_MSG_TYPES = (40, 50, 52, 53, 9999)
+
+_mediaIdLock = threading.Lock()
+
 def load_messages(core):
     core.send_raw_msg = send_raw_msg
     core.send_msg     = send_msg
@@ -24,62 +34,62 @@ def load_messages(core):
     core.revoke       = revoke
 
 def get_download_fn(core, url, msgId):
-    def download_fn(downloadDir=None):
+    def download_fn(downloadDir=None, memoryView=False):
         params = {
             'msgid': msgId,
             'skey': core.loginInfo['skey'],}
         headers = { 'User-Agent' : config.USER_AGENT }
         r = core.s.get(url, params=params, stream=True, headers = headers)
-        tempStorage = io.BytesIO()
-        for block in r.iter_content(1024):
-            tempStorage.write(block)
         if downloadDir is None:
-            return tempStorage.getvalue()
-        with open(downloadDir, 'wb') as f:
-            f.write(tempStorage.getvalue())
-        tempStorage.seek(0)
+            return utils.stream_download(r, memoryView=memoryView)
+        head = utils.stream_download(r, downloadDir)
         return ReturnValue({'BaseResponse': {
             'ErrMsg': 'Successfully downloaded',
             'Ret': 0, },
-            'PostFix': utils.get_image_postfix(tempStorage.read(20)), })
+            'PostFix': utils.get_image_postfix(head), })
     return download_fn
 
 def produce_msg(core, msgList):
-    ''' for messages types
+    ''' produce messages of a sync batch
+     * useless messages are dropped first unless a function is registered for them
+     * users of all the messages are looked up in one pass
+    for messages types
      * 40 msg, 43 videochat, 50 VOIPMSG, 52 voipnotifymsg
      * 53 webwxvoipnotifymsg, 9999 sysnotice
     '''
-    rl = []
-    srl = [40, 43, 50, 52, 53, 9999]
+    myUserName = core.storageClass.userName
+    if not any('Useless' in fns for fns in core.functionDict.values()):
+        # nobody replies useless messages, drop them before any work
+        msgList = [m for m in msgList if m['MsgType'] not in USELESS_MSG_TYPES]
+    # produce basic messages, chatroom members may be fetched here
+    opposites = []
     for m in msgList:
-        # get actual opposite
-        if m['FromUserName'] == core.storageClass.userName:
-            actualOpposite = m['ToUserName']
-        else:
-            actualOpposite = m['FromUserName']
-        # produce basic message
         if '@@' in m['FromUserName'] or '@@' in m['ToUserName']:
             produce_group_chat(core, m)
         else:
             utils.msg_formatter(m, 'Content')
-        # set user of msg
-        if '@@' in actualOpposite:
-            m['User'] = core.search_chatrooms(userName=actualOpposite) or \
-                templates.Chatroom({'UserName': actualOpposite})
-            # we don't need to update chatroom here because we have
-            # updated once when producing basic message
+        opposites.append(m['ToUserName']
+            if m['FromUserName'] == myUserName else m['FromUserName'])
+    # set users of messages, looked up once for the whole batch
+    users = core.storageClass.search_users(set(opposites) - {'filehelper', 'fmessage'})
+    timestamp = time.strftime('%y%m%d-%H%M%S', time.localtime())
+    rl = []
+    for m, actualOpposite in zip(msgList, opposites):
+        if actualOpposite in users:
+            # every message gets its own copy, handlers may change it
+            m['User'] = copy.copy(users[actualOpposite])
+        elif '@@' in actualOpposite:
+            m['User'] = templates.Chatroom({'UserName': actualOpposite})
         elif actualOpposite in ('filehelper', 'fmessage'):
             m['User'] = templates.User({'UserName': actualOpposite})
         else:
-            m['User'] = core.search_mps(userName=actualOpposite) or \
-                core.search_friends(userName=actualOpposite) or \
-                templates.User(userName=actualOpposite)
             # by default we think there may be a user missing not a mp
-        m['User'].core = core
+            m['User'] = templates.User(userName=actualOpposite)
+        if m['User'].core is not core:
+            m['User'].core = core
         if m['MsgType'] == 1: # words
             if m['Url']:
-                regx = r'(.+?\(.+?\))'
-                data = re.search(regx, m['Content'])
+                data = mapRegex.search(m['Content'])
                 data = 'Map' if data is None else data.group(1)
                 msg = {
                     'Type': 'Map',
@@ -93,7 +103,7 @@ def produce_msg(core, msgList):
                 '%s/webwxgetmsgimg' % core.loginInfo['url'], m['NewMsgId'])
             msg = {
                 'Type'     : 'Picture',
-                'FileName' : '%s.%s' % (time.strftime('%y%m%d-%H%M%S', time.localtime()),
+                'FileName' : '%s.%s' % (timestamp,
                     'png' if m['MsgType'] == 3 else 'gif'),
                 'Text'     : download_fn, }
         elif m['MsgType'] == 34: # voice
@@ -101,7 +111,7 @@ def produce_msg(core, msgList):
                 '%s/webwxgetvoice' % core.loginInfo['url'], m['NewMsgId'])
             msg = {
                 'Type': 'Recording',
-                'FileName' : '%s.mp3' % time.strftime('%y%m%d-%H%M%S', time.localtime()),
+                'FileName' : '%s.mp3' % timestamp,
                 'Text': download_fn,}
         elif m['MsgType'] == 37: # friends
             m['User']['UserName'] = m['RecommendInfo']['UserName']
@@ -119,26 +129,22 @@ def produce_msg(core, msgList):
                 'Text': m['RecommendInfo'], }
         elif m['MsgType'] in (43, 62): # tiny video
             msgId = m['MsgId']
-            def download_video(videoDir=None):
+            def download_video(videoDir=None, memoryView=False):
                 url = '%s/webwxgetvideo' % core.loginInfo['url']
                 params = {
                     'msgid': msgId,
                     'skey': core.loginInfo['skey'],}
                 headers = {'Range': 'bytes=0-', 'User-Agent' : config.USER_AGENT }
                 r = core.s.get(url, params=params, headers=headers, stream=True)
-                tempStorage = io.BytesIO()
-                for block in r.iter_content(1024):
-                    tempStorage.write(block)
                 if videoDir is None:
-                    return tempStorage.getvalue()
-                with open(videoDir, 'wb') as f:
-                    f.write(tempStorage.getvalue())
+                    return utils.stream_download(r, memoryView=memoryView)
+                utils.stream_download(r, videoDir)
                 return ReturnValue({'BaseResponse': {
                     'ErrMsg': 'Successfully downloaded',
                     'Ret': 0, }})
             msg = {
                 'Type': 'Video',
-                'FileName' : '%s.mp4' % time.strftime('%y%m%d-%H%M%S', time.localtime()),
+                'FileName' : '%s.mp4' % timestamp,
                 'Text': download_video, }
         elif m['MsgType'] == 49: # sharing
             if m['AppMsgType'] == 0: # chat history
@@ -148,7 +154,7 @@ def produce_msg(core, msgList):
             elif m['AppMsgType'] == 6:
                 rawMsg = m
                 cookiesList = {name:data for name,data in core.s.cookies.items()}
-                def download_atta(attaDir=None):
+                def download_atta(attaDir=None, memoryView=False):
                     url = core.loginInfo['fileUrl'] + '/webwxgetmedia'
                     params = {
                         'sender': rawMsg['FromUserName'],
@@ -159,13 +165,9 @@ def produce_msg(core, msgList):
                         'webwx_data_ticket': cookiesList['webwx_data_ticket'],}
                     headers = { 'User-Agent' : config.USER_AGENT }
                     r = core.s.get(url, params=params, stream=True, headers=headers)
-                    tempStorage = io.BytesIO()
-                    for block in r.iter_content(1024):
-                        tempStorage.write(block)
                     if attaDir is None:
-                        return tempStorage.getvalue()
-                    with open(attaDir, 'wb') as f:
-                        f.write(tempStorage.getvalue())
+                        return utils.stream_download(r, memoryView=memoryView)
+                    utils.stream_download(r, attaDir)
                     return ReturnValue({'BaseResponse': {
                         'ErrMsg': 'Successfully downloaded',
                         'Ret': 0, }})
@@ -178,15 +180,14 @@ def produce_msg(core, msgList):
                 msg = {
                     'Type'     : 'Picture',
                     'FileName' : '%s.gif' % (
-                        time.strftime('%y%m%d-%H%M%S', time.localtime())),
+                        timestamp),
                     'Text'     : download_fn, }
             elif m['AppMsgType'] == 17:
                 msg = {
                     'Type': 'Note',
                     'Text': m['FileName'], }
             elif m['AppMsgType'] == 2000:
-                regx = r'\[CDATA\[(.+?)\][\s\S]+?\[CDATA\[(.+?)\]'
-                data = re.search(regx, m['Content'])
+                data = appNoteRegex.search(m['Content'])
                 if data:
                     data = data.group(2).split(u'\u3002')[0]
                 else:
@@ -205,13 +206,12 @@ def produce_msg(core, msgList):
                 'Type': 'Note',
                 'Text': m['Content'],}
         elif m['MsgType'] == 10002:
-            regx = r'\[CDATA\[(.+?)\]\]'
-            data = re.search(regx, m['Content'])
+            data = systemNoteRegex.search(m['Content'])
             data = 'System message' if data is None else data.group(1).replace('\\', '')
             msg = {
                 'Type': 'Note',
                 'Text': data, }
-        elif m['MsgType'] in srl:
+        elif m['MsgType'] in USELESS_MSG_TYPES:
             msg = {
                 'Type': 'Useless',
                 'Text': 'UselessMsg', }
@@ -220,12 +220,12 @@ def produce_msg(core, msgList):
             msg = {
                 'Type': 'Useless',
                 'Text': 'UselessMsg', }
-        m = dict(m, **msg)
+        m.update(msg) # messages are ours, no need to copy
         rl.append(m)
     return rl
 
 def produce_group_chat(core, msg):
-    r = re.match('(@[0-9a-z]*?):<br/>(.*)$', msg['Content'])
+    r = groupChatRegex.match(msg['Content'])
     if r:
         actualUserName, content = r.groups()
         chatroomUserName = msg['FromUserName']
@@ -243,9 +243,12 @@ def produce_group_chat(core, msg):
     member = utils.search_dict_list((chatroom or {}).get(
         'MemberList') or [], 'UserName', actualUserName)
     if member is None:
-        chatroom = core.update_chatroom(chatroomUserName)
+        # members unknown, fetch now or wait for the prefetch in flight
+        chatroom = core.chatroomPrefetcher.fetch(chatroomUserName)
         member = utils.search_dict_list((chatroom or {}).get(
             'MemberList') or [], 'UserName', actualUserName)
+    else:
+        core.chatroomPrefetcher.refresh(chatroomUserName)
     if member is None:
         logger.debug('chatroom member fetch failed with %s' % actualUserName)
         msg['ActualNickName'] = ''
@@ -283,11 +286,38 @@ def send_msg(self, msg='Test Message', toUserName=None):
     r = self.send_raw_msg(1, msg, toUserName)
     return r
 
+class _FileBuffer(object):
+    ''' read-only content of a file to upload
+        * files on disk are memory-mapped instead of being read into memory
+        * slicing returns the bytes of a chunk, so chunks can be read in parallel '''
+    def __init__(self, data):
+        self.data = data
+    def __len__(self):
+        return len(self.data)
+    def __getitem__(self, s):
+        return bytes(self.data[s])
+    def close(self):
+        if isinstance(self.data, memoryview):
+            self.data.release()
+        elif isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+def _map_file(f):
+    ''' map f from its start, the mapping is still valid after f is closed '''
+    try:
+        if f.tell() == 0 and os.fstat(f.fileno()).st_size:
+            return _FileBuffer(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        pass
+    return None
+
 def _prepare_file(fileDir, file_=None):
     fileDict = {}
     if file_:
-        if hasattr(file_, 'read'):
-            file_ = file_.read()
+        if isinstance(file_, io.BytesIO):
+            file_ = _FileBuffer(file_.getbuffer()[file_.tell():])
+        elif hasattr(file_, 'read'):
+            file_ = _map_file(file_) or _FileBuffer(file_.read())
         else:
             return ReturnValue({'BaseResponse': {
                 'ErrMsg': 'file_ param should be opened file',
@@ -298,14 +328,43 @@ def _prepare_file(fileDir, file_=None):
                 'ErrMsg': 'No file found in specific dir',
                 'Ret': -1002, }})
         with open(fileDir, 'rb') as f:
-            file_ = f.read()
+            file_ = _map_file(f) or _FileBuffer(f.read()) # empty file can not be mapped
+    fileMd5 = hashlib.md5()
+    for start in range(0, len(file_.data), config.UPLOAD_CHUNK_SIZE):
+        fileMd5.update(file_.data[start:start + config.UPLOAD_CHUNK_SIZE])
     fileDict['fileSize'] = len(file_)
-    fileDict['fileMd5'] = hashlib.md5(file_).hexdigest()
-    fileDict['file_'] = io.BytesIO(file_)
+    fileDict['fileMd5'] = fileMd5.hexdigest()
+    fileDict['file_'] = file_
     return fileDict
 
+def _get_cached_media(core, key):
+    with _mediaIdLock:
+        cached = core.mediaIdCache.get(key)
+        if cached is None:
+            return None
+        if cached[0] < time.time():
+            del core.mediaIdCache[key]
+            return None
+        return ReturnValue({
+            'BaseResponse': {'Ret': 0, 'ErrMsg': ''},
+            'MediaId': cached[1], })
+
+def _cache_media(core, key, r):
+    with _mediaIdLock:
+        now = time.time()
+        for k, v in list(core.mediaIdCache.items()):
+            if v[0] < now:
+                del core.mediaIdCache[k]
+        core.mediaIdCache[key] = (now + config.MEDIA_ID_TTL, r['MediaId'])
+
 def upload_file(self, fileDir, isPicture=False, isVideo=False,
         toUserName='filehelper', file_=None, preparedFile=None):
+    ''' upload file in chunks of config.UPLOAD_CHUNK_SIZE
+     * chunks except the last one are uploaded by up to config.UPLOAD_THREADS threads
+     * the last chunk is uploaded after all others, its response carries MediaId
+     * each chunk is retried for config.UPLOAD_RETRY times
+     * files with the same md5 are uploaded only once in config.MEDIA_ID_TTL
+    '''
     logger.debug('Request to upload a %s: %s' % (
         'picture' if isPicture else 'video' if isVideo else 'file', fileDir))
     if not preparedFile:
@@ -315,7 +374,13 @@ def upload_file(self, fileDir, isPicture=False, isVideo=False,
     fileSize, fileMd5, file_ = \
         preparedFile['fileSize'], preparedFile['fileMd5'], preparedFile['file_']
     fileSymbol = 'pic' if isPicture else 'video' if isVideo else'doc'
-    chunks = int((fileSize - 1) / 524288) + 1
+    cacheKey = (fileMd5, fileSize, fileSymbol)
+    r = _get_cached_media(self, cacheKey)
+    if r is not None:
+        file_.close()
+        logger.debug('Reuse uploaded media: %s' % r.get('MediaId'))
+        return r
+    chunks = int((fileSize - 1) / config.UPLOAD_CHUNK_SIZE) + 1
     clientMediaId = int(time.time() * 1e4)
     uploadMediaRequest = json.dumps(OrderedDict([
         ('UploadType', 2),
@@ -329,14 +394,22 @@ def upload_file(self, fileDir, isPicture=False, isVideo=False,
         ('ToUserName', toUserName),
         ('FileMd5', fileMd5)]
         ), separators = (',', ':'))
-    r = {'BaseResponse': {'Ret': -1005, 'ErrMsg': 'Empty file detected'}}
-    for chunk in range(chunks):
-        r = upload_chunk_file(self, fileDir, fileSymbol, fileSize,
+    def upload(chunk):
+        return upload_chunk_file(self, fileDir, fileSymbol, fileSize,
             file_, chunk, chunks, uploadMediaRequest)
-    file_.close()
-    if isinstance(r, dict):
-        return ReturnValue(r)
-    return ReturnValue(rawResponse=r)
+    try:
+        if 1 < chunks:
+            workers = min(config.UPLOAD_THREADS, chunks - 1)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for r in executor.map(upload, range(chunks - 1)):
+                    if not r:
+                        return r
+        r = upload(chunks - 1)
+    finally:
+        file_.close()
+    if r and r.get('MediaId'):
+        _cache_media(self, cacheKey, r)
+    return r
 
 def upload_chunk_file(core, fileDir, fileSymbol, fileSize,
         file_, chunk, chunks, uploadMediaRequest):
@@ -346,6 +419,7 @@ def upload_chunk_file(core, fileDir, fileSymbol, fileSize,
     cookiesList = {name:data for name,data in core.s.cookies.items()}
     fileType = mimetypes.guess_type(fileDir)[0] or 'application/octet-stream'
     fileName = utils.quote(os.path.basename(fileDir))
+    start = chunk * config.UPLOAD_CHUNK_SIZE
     files = OrderedDict([
         ('id', (None, 'WU_FILE_0')),
         ('name', (None, fileName)),
@@ -358,13 +432,26 @@ def upload_chunk_file(core, fileDir, fileSymbol, fileSize,
         ('uploadmediarequest', (None, uploadMediaRequest)),
         ('webwx_data_ticket', (None, cookiesList['webwx_data_ticket'])),
         ('pass_ticket', (None, core.loginInfo['pass_ticket'])),
-        ('filename' , (fileName, file_.read(524288), 'application/octet-stream'))])
+        ('filename' , (fileName, file_[start:start + config.UPLOAD_CHUNK_SIZE],
+            'application/octet-stream'))])
     if chunks == 1:
         del files['chunk']; del files['chunks']
     else:
         files['chunk'], files['chunks'] = (None, str(chunk)), (None, str(chunks))
     headers = { 'User-Agent' : config.USER_AGENT }
-    return core.s.post(url, files=files, headers=headers, timeout=config.TIMEOUT)
+    r = ReturnValue({'BaseResponse': {'Ret': -1005, 'ErrMsg': 'Empty file detected'}})
+    for retry in range(config.UPLOAD_RETRY):
+        if retry:
+            time.sleep(retry)
+            logger.debug('Retry uploading chunk %s/%s of %s' % (chunk + 1, chunks, fileDir))
+        try:
+            r = ReturnValue(rawResponse=core.s.post(url, files=files,
+                headers=headers, timeout=config.TIMEOUT))
+        except requests.RequestException as e:
+            r = ReturnValue({'BaseResponse': {'Ret': -1000, 'ErrMsg': str(e)}})
+        if r:
+            break
+    return r
 
 def send_file(self, fileDir, toUserName=None, mediaId=None, file_=None):
     logger.debug('Request to send a file(mediaId: %s) to %s: %s' % (
@@ -379,7 +466,9 @@ def send_file(self, fileDir, toUserName=None, mediaId=None, file_=None):
     if not preparedFile:
         return preparedFile
     fileSize = preparedFile['fileSize']
-    if mediaId is None:
+    if mediaId is not None:
+        preparedFile['file_'].close()
+    else:
         r = self.upload_file(fileDir, preparedFile=preparedFile)
         if r:
             mediaId = r['MediaId']
@@ -4,6 +4,8 @@ try:
 except ImportError:
     import queue as Queue
 
+from .. import config
+from ..dispatcher import MessageDispatcher
 from ..log import set_logging
 from ..utils import test_connect
 from ..storage import templates
@@ -59,12 +61,18 @@ def configured_reply(self):
         if replyFn is None:
             r = None
         else:
-            try:
+            def reply():
                 r = replyFn(msg)
                 if r is not None:
                     self.send(r, msg.get('FromUserName'))
-            except:
-                logger.warning(traceback.format_exc())
+            if self.dispatcher is None:
+                try:
+                    reply()
+                except:
+                    logger.warning(traceback.format_exc())
+            else:
+                # messages of the same conversation are replied in order
+                self.dispatcher.dispatch(msg['User'].get('UserName'), reply)
 
 def msg_register(self, msgType, isFriendChat=False, isGroupChat=False, isMpChat=False):
     ''' a decorator constructor
@@ -88,6 +96,8 @@ def run(self, debug=False, blockThread=True):
     logger.info('Start auto replying.')
     if debug:
         set_logging(loggingLevel=logging.DEBUG)
+    if self.dispatcher is None and 0 < config.DISPATCH_THREADS:
+        self.dispatcher = MessageDispatcher(config.DISPATCH_THREADS)
     def reply_fn():
         try:
             while self.alive:
@@ -98,6 +108,9 @@ def run(self, debug=False, blockThread=True):
             self.alive = False
             logger.debug('itchat received an ^C and exit.')
             logger.info('Bye~')
+        if self.dispatcher is not None:
+            self.dispatcher.shutdown(wait=False)
+            self.dispatcher = None
     if blockThread:
         reply_fn()
     else:
@@ -10,6 +10,26 @@ OS = platform.system() # Windows, Linux, Darwin
 DIR = os.getcwd()
 DEFAULT_QR = 'QR.png'
 TIMEOUT = (10, 60)
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+UPLOAD_CHUNK_SIZE = 512 * 1024
+UPLOAD_THREADS = 4
+UPLOAD_RETRY = 3
+MEDIA_ID_TTL = 3600 # uploaded media with the same md5 is reused in this period
+CHECKPOINT_INTERVAL = 30 # seconds between hot reload checkpoints
+MESSAGE_QUEUE_SIZE = 1000 # the oldest message is dropped when more are waiting
+DISPATCH_THREADS = 4 # 0 to handle messages in the thread calling run
+HTTP_POOL_SIZE = 16
+SYNC_CHECK_TIMEOUT = (35, 90) # read timeout of sync check adapts between them
+RECONNECT_DELAY = (1, 30) # jittered exponential delay between receiving retries
+SEND_RATE = 2 # messages sent per second in average, 0 for no pacing
+SEND_BURST = 5 # messages can be sent at once after idle
+SEND_THREADS = 2 # 0 to send in the thread putting messages
+SEND_RETRY = 3
+SEND_RETRY_DELAY = (2, 30) # jittered exponential delay between sending retries
+SEND_FLUSH_TIMEOUT = 10 # seconds to wait for queued messages to be sent when exiting
+PREFETCH_BATCH_SIZE = 50 # chatrooms fetched in one batch contact request
+PREFETCH_THREADS = 2
+CHATROOM_TTL = 3600 # members of a chatroom are refreshed in background after it
 
 USER_AGENT = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/54.0.2840.71 Safari/537.36'
 
@@ -1,6 +1,8 @@
 import requests
 
 from . import storage
+from .receiving import ReceivingStats, tune_session
+from .prefetch import ChatroomPrefetcher
 
 class Core(object):
     def __init__(self):
@@ -13,6 +15,17 @@ class Core(object):
             receivingRetryCount is for receiving loop retry
                 - it's 5 now, but actually even 1 is enough
                 - failing is failing
+            receivingRetryTimeout limits seconds of continuous failure
+                - retries are delayed with growing backoff, so count alone
+                  does not bound how long reconnecting lasts
+                - None means only receivingRetryCount is checked
+            dispatcher runs reply functions in parallel after run is called
+                - messages of the same conversation are still replied in order
+            receivingStats measures latency and messages of the receiving loop
+            chatroomPrefetcher fetches chatroom members in background
+                - members are prefetched after login and refreshed when stale
+            mediaIdCache keeps mediaIds of uploaded files by md5
+                - identical files are not uploaded again in config.MEDIA_ID_TTL
         '''
         self.alive, self.isLogging = False, False
         self.storageClass = storage.Storage(self)
@@ -21,11 +34,16 @@ class Core(object):
         self.chatroomList = self.storageClass.chatroomList
         self.msgList = self.storageClass.msgList
         self.loginInfo = {}
-        self.s = requests.Session()
+        self.s = tune_session(requests.Session())
         self.uuid = None
         self.functionDict = {'FriendChat': {}, 'GroupChat': {}, 'MpChat': {}}
         self.useHotReload, self.hotReloadDir = False, 'itchat.pkl'
         self.receivingRetryCount = 5
+        self.receivingRetryTimeout = None
+        self.mediaIdCache = {}
+        self.dispatcher = None
+        self.receivingStats = ReceivingStats()
+        self.chatroomPrefetcher = ChatroomPrefetcher(self)
     def login(self, enableCmdQR=False, picDir=None, qrCallback=None,
             loginCallback=None, exitCallback=None):
         ''' log in like web wechat does
@@ -379,6 +397,9 @@ class Core(object):
         ''' dump login status to a specific file
             for option
                 - fileDir: dir for dumping login status
+            contacts are dumped to fileDir + '.contacts'
+                - only changed contacts are written after the first dump
+                - it is called every config.CHECKPOINT_INTERVAL seconds with hot reload
             it is defined in components/hotreload.py
         '''
         raise NotImplementedError()
@@ -0,0 +1,123 @@
+import asyncio, logging, threading, traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('itchat')
+
+class MessageDispatcher(object):
+    ''' run message handlers on a small thread pool
+        * messages of the same conversation are handled one by one in order
+        * different conversations are handled in parallel
+        * with 0 workers handlers are run in the calling thread
+    '''
+    def __init__(self, workers=4):
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+            thread_name_prefix='itchat-dispatch') if 0 < workers else None
+        self.lock = threading.Lock()
+        self.pending = {} # conversation -> deque of handlers waiting
+        self.pendingCount = 0
+        self.maxPendingCount = 0
+        self.handledCount = 0
+        self.failedCount = 0
+    def dispatch(self, conversation, fn):
+        if self.executor is None:
+            self._run(fn)
+            return
+        with self.lock:
+            self.pendingCount += 1
+            self.maxPendingCount = max(self.maxPendingCount, self.pendingCount)
+            if conversation in self.pending:
+                # a worker is handling this conversation, it will pick fn up
+                self.pending[conversation].append(fn)
+                return
+            self.pending[conversation] = deque([fn])
+        self.executor.submit(self._drain, conversation)
+    def _drain(self, conversation):
+        while True:
+            with self.lock:
+                handlers = self.pending[conversation]
+                if not handlers:
+                    del self.pending[conversation]
+                    return
+                fn = handlers.popleft()
+                self.pendingCount -= 1
+            self._run(fn)
+    def _run(self, fn):
+        failed = False
+        try:
+            fn()
+        except:
+            failed = True
+            logger.warning(traceback.format_exc())
+        with self.lock:
+            self.handledCount += 1
+            self.failedCount += failed
+    def stats(self):
+        with self.lock:
+            return {
+                'workers'         : self.workers,
+                'conversations'   : len(self.pending),
+                'pending'         : self.pendingCount,
+                'maxPending'      : self.maxPendingCount,
+                'handled'         : self.handledCount,
+                'failed'          : self.failedCount, }
+    def shutdown(self, wait=True):
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait)
+
+class AsyncMessageDispatcher(object):
+    ''' run coroutine handlers as tasks of the running event loop
+        * messages of the same conversation are handled one by one in order
+        * different conversations are handled concurrently
+        * must be used in the thread of the event loop
+    '''
+    def __init__(self):
+        self.pending = {} # conversation -> deque of handlers waiting
+        self.tasks = set()
+        self.pendingCount = 0
+        self.maxPendingCount = 0
+        self.handledCount = 0
+        self.failedCount = 0
+    def dispatch(self, conversation, fn):
+        ''' fn returns a coroutine '''
+        self.pendingCount += 1
+        self.maxPendingCount = max(self.maxPendingCount, self.pendingCount)
+        if conversation in self.pending:
+            self.pending[conversation].append(fn)
+            return
+        self.pending[conversation] = deque([fn])
+        task = asyncio.ensure_future(self._drain(conversation))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+    async def _drain(self, conversation):
+        handlers = self.pending[conversation]
+        try:
+            while handlers:
+                fn = handlers.popleft()
+                self.pendingCount -= 1
+                try:
+                    await fn()
+                except asyncio.CancelledError:
+                    raise
+                except:
+                    self.failedCount += 1
+                    logger.warning(traceback.format_exc())
+                self.handledCount += 1
+        finally:
+            self.pendingCount -= len(handlers)
+            del self.pending[conversation]
+    def stats(self):
+        return {
+            'conversations'   : len(self.pending),
+            'pending'         : self.pendingCount,
+            'maxPending'      : self.maxPendingCount,
+            'handled'         : self.handledCount,
+            'failed'          : self.failedCount, }
+    async def shutdown(self, wait=True):
+        if wait:
+            if self.tasks:
+                await asyncio.gather(*self.tasks, return_exceptions=True)
+        else:
+            for task in self.tasks:
+                task.cancel()
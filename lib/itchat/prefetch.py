@@ -0,0 +1,118 @@
+import time, threading, traceback
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from . import config
+
+logger = logging.getLogger('itchat')
+
+class ChatroomPrefetcher(object):
+    ''' fetch chatrooms and their members with the batch contact api
+        * prefetch: chatrooms without members are fetched in background after login
+        * fetch: members are needed now, fetched in the calling thread
+        * refresh: members older than ttl are fetched again in background
+        a chatroom is never fetched twice at once, later callers wait for the first
+    '''
+    def __init__(self, core, batchSize=config.PREFETCH_BATCH_SIZE,
+            workers=config.PREFETCH_THREADS, ttl=config.CHATROOM_TTL):
+        self.core = core
+        self.batchSize = batchSize
+        self.workers = workers
+        self.ttl = ttl
+        self.executor = None
+        self.lock = threading.Lock()
+        self.fetchTime = {} # chatroom userName -> time its members were fetched
+        self.inflight = {} # chatroom userName -> Future of the fetch
+        self.generation = 0 # increased when logged out, fetches of old sessions are dropped
+        self.fetchCount = 0
+        self.failedCount = 0
+        self.waitedCount = 0
+    def _submit(self, fn, *args):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers,
+                    thread_name_prefix='itchat-prefetch')
+            return self.executor.submit(fn, *args)
+    def is_stale(self, userName):
+        fetchTime = self.fetchTime.get(userName)
+        return fetchTime is None or self.ttl < time.time() - fetchTime
+    def prefetch(self, userNames=None):
+        ''' fetch chatrooms in batches in background
+            * userNames: chatrooms without members by default '''
+        if userNames is None:
+            userNames = [c['UserName'] for c in self.core.chatroomList
+                if not c.get('MemberList')]
+        generation = self.generation
+        for i in range(0, len(userNames), self.batchSize):
+            self._submit(self._prefetch_batch, userNames[i:i + self.batchSize], generation)
+        if userNames:
+            logger.debug('Prefetching %s chatrooms.' % len(userNames))
+    def _prefetch_batch(self, userNames, generation):
+        if generation != self.generation:
+            return
+        # chatrooms fetched meanwhile (by fetch or refresh) are skipped
+        future = Future()
+        with self.lock:
+            userNames = [u for u in userNames
+                if u not in self.inflight and self.is_stale(u)]
+            for u in userNames:
+                self.inflight[u] = future
+        if userNames:
+            self._fetch(userNames, future, generation)
+    def fetch(self, userName, timeout=None):
+        ''' fetch a chatroom now, or wait for the fetch in flight
+            return the chatroom in storage '''
+        with self.lock:
+            future = self.inflight.get(userName)
+            if future is None:
+                future = self.inflight[userName] = Future()
+                owner = True
+            else:
+                owner = False
+                self.waitedCount += 1
+        if owner:
+            self._fetch([userName], future, self.generation)
+        else:
+            try:
+                future.result(timeout)
+            except Exception:
+                pass
+        return self.core.storageClass.search_chatrooms(userName=userName)
+    def refresh(self, userName):
+        ''' fetch a chatroom in background if its members are stale '''
+        with self.lock:
+            if userName in self.inflight or not self.is_stale(userName):
+                return
+            future = self.inflight[userName] = Future()
+        self._submit(self._fetch, [userName], future, self.generation)
+    def _fetch(self, userNames, future, generation):
+        try:
+            if generation == self.generation:
+                self.core.update_chatroom(userNames)
+                now = time.time()
+                with self.lock:
+                    self.fetchCount += len(userNames)
+                    for u in userNames:
+                        self.fetchTime[u] = now
+        except Exception:
+            with self.lock:
+                self.failedCount += len(userNames)
+            logger.warning('Fetching chatrooms failed:\n%s' % traceback.format_exc())
+        finally:
+            with self.lock:
+                for u in userNames:
+                    if self.inflight.get(u) is future:
+                        del self.inflight[u]
+            future.set_result(None)
+    def stats(self):
+        with self.lock:
+            return {
+                'fetched'  : self.fetchCount,
+                'failed'   : self.failedCount,
+                'waited'   : self.waitedCount,
+                'inflight' : len(self.inflight),
+                'known'    : len(self.fetchTime), }
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.fetchTime.clear()
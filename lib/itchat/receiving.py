@@ -0,0 +1,100 @@
+import time, random, socket, threading
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+
+from . import config
+
+class KeepAliveAdapter(HTTPAdapter):
+    ''' reuse connections and turn on tcp keep-alive
+        so idle connections of long polling are not dropped silently '''
+    def init_poolmanager(self, *args, **kwargs):
+        socketOptions = HTTPConnection.default_socket_options + [
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            socketOptions += [
+                (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30),
+                (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10),
+                (socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)]
+        kwargs['socket_options'] = socketOptions
+        super(KeepAliveAdapter, self).init_poolmanager(*args, **kwargs)
+
+def tune_session(session):
+    adapter = KeepAliveAdapter(pool_connections=4, pool_maxsize=config.HTTP_POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Connection'] = 'keep-alive'
+    return session
+
+class ReceivingStats(object):
+    ''' measure the receiving loop
+        * rtt: round-trip seconds of sync check, server holds it until messages come
+        * lag: seconds from a message created on server to it received
+        * read timeout of sync check adapts to recent rtt
+        * reconnecting delay grows exponentially with jitter
+        rtt, lag and messagesPerSync are exponential moving averages
+    '''
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+        self.lock = threading.Lock()
+        self.syncCheckCount = 0
+        self.syncCount = 0
+        self.messageCount = 0
+        self.timeoutCount = 0
+        self.failureCount = 0
+        self.rtt = None
+        self.maxRtt = 0
+        self.lag = None
+        self.messagesPerSync = 0
+        self.lastSyncTime = None
+    def _average(self, average, value):
+        if average is None:
+            return value
+        return average + self.alpha * (value - average)
+    def sync_checked(self, rtt):
+        with self.lock:
+            self.syncCheckCount += 1
+            self.rtt = self._average(self.rtt, rtt)
+            self.maxRtt = max(self.maxRtt, rtt)
+    def synced(self, msgList):
+        now = time.time()
+        msgList = msgList or []
+        with self.lock:
+            self.syncCount += 1
+            self.messageCount += len(msgList)
+            self.messagesPerSync = self._average(self.messagesPerSync, len(msgList))
+            for m in msgList:
+                if m.get('CreateTime'):
+                    self.lag = self._average(self.lag, max(0, now - m['CreateTime']))
+            self.lastSyncTime = now
+    def timed_out(self):
+        ''' server held sync check longer than we waited, wait longer next time '''
+        with self.lock:
+            self.timeoutCount += 1
+            self.rtt = self.read_timeout()
+    def failed(self):
+        with self.lock:
+            self.failureCount += 1
+    def read_timeout(self):
+        minTimeout, maxTimeout = config.SYNC_CHECK_TIMEOUT
+        if self.rtt is None:
+            return minTimeout
+        return min(max(self.rtt * 1.5 + 5, minTimeout), maxTimeout)
+    def backoff(self, retryCount):
+        minDelay, maxDelay = config.RECONNECT_DELAY
+        delay = min(maxDelay, minDelay * 2 ** min(retryCount - 1, 16))
+        return random.uniform(delay / 2, delay)
+    def stats(self):
+        with self.lock:
+            return {
+                'syncChecks'      : self.syncCheckCount,
+                'syncs'           : self.syncCount,
+                'messages'        : self.messageCount,
+                'timeouts'        : self.timeoutCount,
+                'failures'        : self.failureCount,
+                'rtt'             : self.rtt,
+                'maxRtt'          : self.maxRtt,
+                'lag'             : self.lag,
+                'messagesPerSync' : self.messagesPerSync,
+                'readTimeout'     : self.read_timeout(),
+                'lastSyncTime'    : self.lastSyncTime, }
@@ -0,0 +1,185 @@
+import time, random, threading, traceback
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from . import config
+
+logger = logging.getLogger('itchat')
+
+class TokenBucket(object):
+    ''' pace actions to rate per second in average
+        * at most burst actions are allowed at once after idle
+        * rate <= 0 means no pacing
+    '''
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.lastTime = time.monotonic()
+        self.lock = threading.Lock()
+    def acquire(self):
+        ''' take a token, wait until one is available
+            return seconds waited '''
+        if self.rate <= 0:
+            return 0
+        waited = 0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst,
+                    self.tokens + (now - self.lastTime) * self.rate)
+                self.lastTime = now
+                if 1 <= self.tokens:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+class SendQueue(object):
+    ''' send messages in background so callers return at once
+        * messages to the same receiver are sent one by one in order
+        * all sending is paced by a token bucket to avoid being throttled
+        * failed sending (exception or falsy ReturnValue) is retried with backoff
+        * a receiver waiting for retry holds no worker, so messages to
+          other receivers are not blocked by it
+        * flush sends queued messages at once before exiting
+        latency is seconds from put to sent, an exponential moving average
+    '''
+    def __init__(self, rate=config.SEND_RATE, burst=config.SEND_BURST,
+            workers=config.SEND_THREADS, retry=config.SEND_RETRY, alpha=0.2):
+        self.bucket = TokenBucket(rate, burst)
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+            thread_name_prefix='itchat-send') if 0 < workers else None
+        self.retry = retry
+        self.alpha = alpha
+        self.lock = threading.Condition()
+        self.pending = {} # toUserName -> deque of [fn, description, putTime, tries]
+        self.timers = {} # toUserName -> Timer of the next retry
+        self.flushing = False
+        self.depth = 0
+        self.maxDepth = 0
+        self.sentCount = 0
+        self.failedCount = 0
+        self.retryCount = 0
+        self.latency = None
+        self.maxLatency = 0
+        self.pacingDelay = 0
+    def put(self, toUserName, fn, description=None):
+        ''' fn sends a message and returns a ReturnValue
+            description is used in logs '''
+        message = [fn, description, time.time(), 0]
+        with self.lock:
+            self.depth += 1
+            self.maxDepth = max(self.maxDepth, self.depth)
+            if toUserName in self.pending:
+                # being sent or waiting for retry, message will be picked up
+                self.pending[toUserName].append(message)
+                return
+            self.pending[toUserName] = deque([message])
+        self._submit(toUserName)
+    def _submit(self, toUserName):
+        if self.executor is None:
+            self._drain(toUserName)
+        else:
+            self.executor.submit(self._drain, toUserName)
+    def _drain(self, toUserName):
+        while True:
+            with self.lock:
+                messages = self.pending[toUserName]
+                if not messages:
+                    del self.pending[toUserName]
+                    self.lock.notify_all()
+                    return
+                message = messages[0]
+            fn, description, putTime, tries = message
+            waited = self.bucket.acquire()
+            if self._try_send(toUserName, fn, description):
+                self._sent(toUserName, description, time.time() - putTime, waited)
+            elif tries < self.retry:
+                message[3] = tries + 1
+                with self.lock:
+                    self.retryCount += 1
+                    if not self.flushing:
+                        # later messages to toUserName wait in pending to keep order
+                        timer = threading.Timer(self._backoff(tries + 1),
+                            self._retry, (toUserName,))
+                        timer.setDaemon(True)
+                        self.timers[toUserName] = timer
+                        timer.start()
+                        return
+                continue
+            else:
+                logger.error('Gave up sending %s to %s after %s retries' % (
+                    description, toUserName, self.retry))
+                with self.lock:
+                    self.failedCount += 1
+            with self.lock:
+                messages.popleft()
+                self.depth -= 1
+    def _retry(self, toUserName):
+        with self.lock:
+            if self.timers.pop(toUserName, None) is None:
+                return # already resubmitted by flush
+        self._submit(toUserName)
+    def _try_send(self, toUserName, fn, description):
+        try:
+            r = fn()
+        except Exception:
+            logger.warning('Sending %s to %s failed:\n%s' % (
+                description, toUserName, traceback.format_exc()))
+            return False
+        if r is None or r:
+            return True
+        logger.warning('Sending %s to %s failed: %s' % (
+            description, toUserName, r.get('BaseResponse')))
+        return False
+    def _sent(self, toUserName, description, latency, waited):
+        logger.info('Sent %s to %s in %.2fs' % (description, toUserName, latency))
+        with self.lock:
+            self.sentCount += 1
+            self.latency = latency if self.latency is None else \
+                self.latency + self.alpha * (latency - self.latency)
+            self.maxLatency = max(self.maxLatency, latency)
+            self.pacingDelay += waited
+    def _backoff(self, retryCount):
+        minDelay, maxDelay = config.SEND_RETRY_DELAY
+        delay = min(maxDelay, minDelay * 2 ** (retryCount - 1))
+        return random.uniform(delay / 2, delay)
+    def flush(self, timeout=config.SEND_FLUSH_TIMEOUT):
+        ''' send queued messages and wait until all are handled or timeout
+            retries are no longer delayed after flush is called
+            return whether the queue is empty '''
+        with self.lock:
+            self.flushing = True
+            timers, self.timers = self.timers, {}
+        for toUserName, timer in timers.items():
+            timer.cancel()
+            self._submit(toUserName)
+        deadline = None if timeout is None else time.time() + timeout
+        with self.lock:
+            while self.pending:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self.lock.wait(remaining)
+            return not self.pending
+    def stats(self):
+        with self.lock:
+            return {
+                'depth'       : self.depth,
+                'maxDepth'    : self.maxDepth,
+                'receivers'   : len(self.pending),
+                'retrying'    : len(self.timers),
+                'sent'        : self.sentCount,
+                'failed'      : self.failedCount,
+                'retries'     : self.retryCount,
+                'latency'     : self.latency,
+                'maxLatency'  : self.maxLatency,
+                'pacingDelay' : self.pacingDelay, }
+    def shutdown(self, wait=True, timeout=config.SEND_FLUSH_TIMEOUT):
+        if wait:
+            self.flush(timeout)
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait)
@@ -1,15 +1,23 @@
-import os, time, copy
-from threading import Lock
+import os, time, copy, pickle
+import logging
+from threading import Lock, Thread, current_thread
 
+from .. import config
 from .messagequeue import Queue
 from .templates import (
     ContactList, AbstractUserDict, User,
     MassivePlatform, Chatroom, ChatroomMember)
+from .checkpoint import CONTACT_KINDS, contact_dict
+
+logger = logging.getLogger('itchat')
 
 def contact_change(fn):
     def _contact_change(core, *args, **kwargs):
         with core.storageClass.updateLock:
-            return fn(core, *args, **kwargs)
+            try:
+                return fn(core, *args, **kwargs)
+            finally:
+                core.storageClass.reset_name_index()
     return _contact_change
 
 class Storage(object):
@@ -20,7 +28,7 @@ class Storage(object):
         self.memberList        = ContactList()
         self.mpList            = ContactList()
         self.chatroomList      = ContactList()
-        self.msgList           = Queue(-1)
+        self.msgList           = Queue(config.MESSAGE_QUEUE_SIZE)
         self.lastInputUserName = None
         self.memberList.set_default_value(contactClass=User)
         self.memberList.core = core
@@ -28,6 +36,12 @@ class Storage(object):
         self.mpList.core = core
         self.chatroomList.set_default_value(contactClass=Chatroom)
         self.chatroomList.core = core
+        self.checkpoint        = None # ContactCheckpoint in sync with contacts
+        self.checkpointSeq     = 0
+        self.dirtyContacts     = set() # UserNames changed or removed since last checkpoint
+        self.lazyThread        = None
+        for contactList in (self.memberList, self.mpList, self.chatroomList):
+            contactList.removeCallback = self.mark_dirty
     def dumps(self):
         return {
             'userName'          : self.userName,
@@ -39,13 +53,11 @@ class Storage(object):
     def loads(self, j):
         self.userName = j.get('userName', None)
         self.nickName = j.get('nickName', None)
-        del self.memberList[:]
+        self.clear()
         for i in j.get('memberList', []):
             self.memberList.append(i)
-        del self.mpList[:]
         for i in j.get('mpList', []):
             self.mpList.append(i)
-        del self.chatroomList[:]
         for i in j.get('chatroomList', []):
             self.chatroomList.append(i)
         # I tried to solve everything in pickle
@@ -59,15 +71,109 @@ class Storage(object):
                 chatroom['Self'].core = chatroom.core
                 chatroom['Self'].chatroom = chatroom
         self.lastInputUserName = j.get('lastInputUserName', None)
+    def clear(self):
+        with self.updateLock:
+            self.checkpoint = None
+            self.chatroomList.lazyLoader = None
+            del self.chatroomList[:]
+            del self.memberList[:]
+            del self.mpList[:]
+            self.dirtyContacts.clear()
+    def mark_dirty(self, userName):
+        self.dirtyContacts.add(userName)
+    def restore(self, j, checkpoint):
+        ''' restore from status dumped with a ContactCheckpoint
+            friends and mps are loaded at once, chatrooms are loaded in background
+            and a chatroom searched before that is loaded on demand '''
+        self.clear()
+        self.userName = j.get('userName', None)
+        self.nickName = j.get('nickName', None)
+        self.lastInputUserName = j.get('lastInputUserName', None)
+        with self.updateLock:
+            for kind in ('memberList', 'mpList'):
+                for d in checkpoint.load_kind(kind):
+                    self._restore_contact(kind, d)
+            self.checkpoint = checkpoint
+            self.checkpointSeq = checkpoint.next_seq()
+            self.chatroomList.lazyLoader = self._load_chatroom
+        self.lazyThread = Thread(target=self._load_chatrooms, args=(checkpoint,))
+        self.lazyThread.setDaemon(True)
+        self.lazyThread.start()
+    def _restore_contact(self, kind, d):
+        contactList = getattr(self, kind)
+        contactList.append(d)
+        contact = contactList[-1]
+        if kind == 'chatroomList':
+            selfMember = contact['MemberList'].search_user_name(self.userName)
+            if selfMember is None:
+                selfMember = User(d.get('Self') or {})
+                selfMember.core = contactList.core
+            contact['Self'] = selfMember
+        return contact
+    def _load_chatroom(self, userName):
+        ''' lazyLoader of chatroomList, called with updateLock held '''
+        d = self.checkpoint.load_contact('chatroomList', userName)
+        if d is not None:
+            return self._restore_contact('chatroomList', d)
+    def _load_chatrooms(self, checkpoint):
+        chatroomList = checkpoint.load_kind('chatroomList')
+        for i in range(0, len(chatroomList), 50):
+            with self.updateLock:
+                if self.checkpoint is not checkpoint:
+                    return
+                for d in chatroomList[i:i + 50]:
+                    if d.get('UserName') not in self.chatroomList.userNameIndex:
+                        self._restore_contact('chatroomList', d)
+        with self.updateLock:
+            if self.checkpoint is checkpoint:
+                self.chatroomList.lazyLoader = None
+        logger.debug('%s chatrooms loaded from checkpoint.' % len(chatroomList))
+    def wait_lazy_loading(self):
+        lazyThread = self.lazyThread
+        if lazyThread is not None and lazyThread is not current_thread():
+            lazyThread.join()
+    def checkpoint_rows(self, incremental=True):
+        ''' rows of contacts for ContactCheckpoint.save
+            only contacts changed since last checkpoint if incremental
+            contacts removed since last checkpoint are rows of (userName, None, None, None) '''
+        with self.updateLock:
+            rows = []
+            if incremental:
+                contacts = []
+                for userName in self.dirtyContacts:
+                    for kind in CONTACT_KINDS:
+                        contact = getattr(self, kind).userNameIndex.get(userName)
+                        if contact is not None:
+                            contacts.append((kind, contact))
+                            break
+                    else:
+                        rows.append((userName, None, None, None))
+            else:
+                self.checkpointSeq = 0
+                contacts = [(kind, contact) for kind in CONTACT_KINDS
+                    for contact in getattr(self, kind)]
+            for kind, contact in contacts:
+                rows.append((contact.get('UserName'), kind, self.checkpointSeq,
+                    pickle.dumps(contact_dict(contact))))
+                self.checkpointSeq += 1
+            self.dirtyContacts.clear()
+            return rows
+    def reset_name_index(self):
+        ''' names may be changed in place, name indexes are rebuilt when needed '''
+        self.memberList.reset_name_index()
+        self.mpList.reset_name_index()
+        self.chatroomList.reset_name_index()
     def search_friends(self, name=None, userName=None, remarkName=None, nickName=None,
             wechatAccount=None):
+        ''' contacts are looked up by index and returned as shallow copies
+            MemberList and other values are shared with storage, do not modify them '''
         with self.updateLock:
             if (name or userName or remarkName or nickName or wechatAccount) is None:
-                return copy.deepcopy(self.memberList[0]) # my own account
+                return copy.copy(self.memberList[0]) # my own account
             elif userName: # return the only userName match
-                for m in self.memberList:
-                    if m['UserName'] == userName:
-                        return copy.deepcopy(m)
+                m = self.memberList.search_user_name(userName)
+                if m is not None:
+                    return copy.copy(m)
             else:
                 matchDict = {
                     'RemarkName' : remarkName,
@@ -77,10 +183,18 @@ class Storage(object):
                     if matchDict[k] is None:
                         del matchDict[k]
                 if name: # select based on name
-                    contact = []
-                    for m in self.memberList:
-                        if any([m.get(k) == name for k in ('RemarkName', 'NickName', 'Alias')]):
-                            contact.append(m)
+                    contact, ids = [], set()
+                    for k in ('RemarkName', 'NickName', 'Alias'):
+                        for m in self.memberList.search_name(k, name):
+                            if id(m) not in ids:
+                                ids.add(id(m))
+                                contact.append(m)
+                    if 1 < len(contact): # keep the order of memberList
+                        order = {id(m): i for i, m in enumerate(self.memberList)}
+                        contact.sort(key=lambda m: order[id(m)])
+                elif matchDict:
+                    k, v = next(iter(matchDict.items()))
+                    contact = self.memberList.search_name(k, v)
                 else:
                     contact = self.memberList[:]
                 if matchDict: # select again based on matchDict
@@ -88,30 +202,44 @@ class Storage(object):
                     for m in contact:
                         if all([m.get(k) == v for k, v in matchDict.items()]):
                             friendList.append(m)
-                    return copy.deepcopy(friendList)
+                    return [copy.copy(m) for m in friendList]
+                else:
+                    return [copy.copy(m) for m in contact]
+    def search_users(self, userNames):
+        ''' look up chatrooms, mps and friends of userNames under one lock
+            return a dict of userName -> shallow copy, unknown ones are left out '''
+        r = {}
+        with self.updateLock:
+            for userName in userNames:
+                if '@@' in userName:
+                    m = self.chatroomList.search_user_name(userName)
                 else:
-                    return copy.deepcopy(contact)
+                    m = self.mpList.search_user_name(userName) or \
+                        self.memberList.search_user_name(userName)
+                if m is not None:
+                    r[userName] = copy.copy(m)
+        return r
     def search_chatrooms(self, name=None, userName=None):
         with self.updateLock:
             if userName is not None:
-                for m in self.chatroomList:
-                    if m['UserName'] == userName:
-                        return copy.deepcopy(m)
+                m = self.chatroomList.search_user_name(userName)
+                if m is not None:
+                    return copy.copy(m)
             elif name is not None:
                 matchList = []
                 for m in self.chatroomList:
                     if name in m['NickName']:
-                        matchList.append(copy.deepcopy(m))
+                        matchList.append(copy.copy(m))
                 return matchList
     def search_mps(self, name=None, userName=None):
         with self.updateLock:
             if userName is not None:
-                for m in self.mpList:
-                    if m['UserName'] == userName:
-                        return copy.deepcopy(m)
+                m = self.mpList.search_user_name(userName)
+                if m is not None:
+                    return copy.copy(m)
             elif name is not None:
                 matchList = []
                 for m in self.mpList:
                     if name in m['NickName']:
-                        matchList.append(copy.deepcopy(m))
+                        matchList.append(copy.copy(m))
                 return matchList
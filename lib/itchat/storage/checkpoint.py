@@ -0,0 +1,74 @@
+import os, pickle, sqlite3, threading
+import logging
+
+logger = logging.getLogger('itchat')
+
+CONTACT_KINDS = ('memberList', 'mpList', 'chatroomList')
+
+def contact_dict(contact):
+    ''' turn a contact into plain dicts for storing '''
+    d = dict(contact)
+    if 'MemberList' in d:
+        d['MemberList'] = [dict(m) for m in d['MemberList']]
+    if isinstance(d.get('Self'), dict):
+        d['Self'] = dict(d['Self'])
+    return d
+
+def write_atomic(fileDir, obj):
+    ''' pickle obj to a temporary file and move it to fileDir
+        so fileDir always contains a complete status even if we crash '''
+    tmpDir = fileDir + '.tmp'
+    with open(tmpDir, 'wb') as f:
+        pickle.dump(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmpDir, fileDir)
+
+class ContactCheckpoint(object):
+    ''' contacts saved in sqlite, one row for each contact keyed by UserName
+        * kind is the name of the list in storage the contact belongs to
+        * seq keeps the order of contacts in their lists '''
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS contacts (' +
+            'userName TEXT PRIMARY KEY, kind TEXT NOT NULL, ' +
+            'seq INTEGER NOT NULL, data BLOB NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_contacts_kind ON contacts (kind, seq)')
+    def save(self, rows, full=False):
+        ''' rows: (userName, kind, seq, pickled contact)
+            * kind of None means the contact is removed, its row is deleted
+            * full: rows are all the contacts, others are deleted
+            * otherwise existing contacts keep their seq '''
+        removed = [(row[0],) for row in rows if row[1] is None]
+        rows = [row for row in rows if row[1] is not None]
+        with self.lock:
+            try:
+                self.conn.execute('BEGIN')
+                if full:
+                    self.conn.execute('DELETE FROM contacts')
+                self.conn.executemany('DELETE FROM contacts WHERE userName = ?', removed)
+                self.conn.executemany('INSERT INTO contacts (userName, kind, seq, data) ' +
+                    'VALUES (?, ?, ?, ?) ON CONFLICT(userName) DO UPDATE SET ' +
+                    'kind = excluded.kind, data = excluded.data', rows)
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+    def load_kind(self, kind):
+        with self.lock:
+            rows = self.conn.execute('SELECT data FROM contacts WHERE kind = ? ORDER BY seq',
+                (kind,)).fetchall()
+        return [pickle.loads(row[0]) for row in rows]
+    def load_contact(self, kind, userName):
+        with self.lock:
+            row = self.conn.execute('SELECT data FROM contacts WHERE kind = ? AND userName = ?',
+                (kind, userName)).fetchone()
+        return None if row is None else pickle.loads(row[0])
+    def next_seq(self):
+        with self.lock:
+            return (self.conn.execute('SELECT MAX(seq) FROM contacts').fetchone()[0] or 0) + 1
+    def close(self):
+        with self.lock:
+            self.conn.close()
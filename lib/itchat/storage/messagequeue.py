@@ -9,12 +9,43 @@ from .templates import AttributeDict
 logger = logging.getLogger('itchat')
 
 class Queue(queue.Queue):
+    ''' when the queue is full, the oldest message is dropped for the new one '''
+    def __init__(self, maxsize=0):
+        queue.Queue.__init__(self, maxsize)
+        self.putCount = 0
+        self.droppedCount = 0
+        self.maxQsize = 0
     def put(self, message):
-        queue.Queue.put(self, Message(message))
+        message = Message(message)
+        while True:
+            try:
+                queue.Queue.put(self, message, block=False)
+                break
+            except queue.Full:
+                try:
+                    self.get_nowait()
+                except queue.Empty:
+                    continue
+                self.droppedCount += 1
+                logger.warning('Message queue is full (%s), the oldest message is dropped, %s dropped in total.' % (
+                    self.maxsize, self.droppedCount))
+        self.putCount += 1
+        self.maxQsize = max(self.maxQsize, self.qsize())
+    def stats(self):
+        return {
+            'size'      : self.qsize(),
+            'maxSize'   : self.maxQsize,
+            'capacity'  : self.maxsize,
+            'put'       : self.putCount,
+            'dropped'   : self.droppedCount, }
 
 class Message(AttributeDict):
-    def download(self, fileName):
+    def download(self, fileName, memoryView=False):
+        ''' save the media to fileName, or return its content if fileName is None
+            * memoryView: return a memoryview of the content instead of a copy '''
         if hasattr(self.text, '__call__'):
+            if memoryView:
+                return self.text(fileName, memoryView=True)
             return self.text(fileName)
         else:
             return b''
@@ -27,7 +27,12 @@ class UnInitializedItchat(object):
         return self._raise_error
 
 class ContactList(list):
-    ''' when a dict is append, init function will be called to format that dict '''
+    ''' when a dict is append, init function will be called to format that dict
+        contacts are indexed by UserName, and by RemarkName, NickName and Alias
+        - the UserName index is kept in sync with every change of the list
+        - the name index is built when needed, call reset_name_index after
+          names of the contacts are changed in place
+        - removeCallback(userName) is called for contacts removed from the list '''
     def __init__(self, *args, **kwargs):
         super(ContactList, self).__init__(*args, **kwargs)
         self.__setstate__(None)
@@ -48,8 +53,66 @@ class ContactList(list):
         if self.contactInitFn is not None:
             contact = self.contactInitFn(self, contact) or contact
         super(ContactList, self).append(contact)
+        self.userNameIndex.setdefault(contact.get('UserName'), contact)
+        self.nameIndex = None
+    def rebuild_index(self):
+        oldIndex = getattr(self, 'userNameIndex', {})
+        self.userNameIndex = {}
+        for contact in self:
+            self.userNameIndex.setdefault(contact.get('UserName'), contact)
+        self.nameIndex = None
+        if self.removeCallback is not None:
+            for userName in oldIndex:
+                if userName not in self.userNameIndex:
+                    self.removeCallback(userName)
+    def reset_name_index(self):
+        self.nameIndex = None
+    def search_user_name(self, userName):
+        ''' return the first contact with specific UserName or None
+            contacts not loaded yet are loaded by lazyLoader if it is set '''
+        contact = self.userNameIndex.get(userName)
+        if contact is None and self.lazyLoader is not None:
+            contact = self.lazyLoader(userName)
+        return contact
+    def search_name(self, key, value):
+        ''' return contacts whose key (RemarkName, NickName or Alias) equals value '''
+        if self.nameIndex is None:
+            nameIndex = {'RemarkName': {}, 'NickName': {}, 'Alias': {}}
+            for contact in self:
+                for k, index in nameIndex.items():
+                    v = contact.get(k)
+                    if v is not None:
+                        index.setdefault(v, []).append(contact)
+            self.nameIndex = nameIndex
+        return self.nameIndex[key].get(value, [])
+    def extend(self, values):
+        super(ContactList, self).extend(values)
+        self.rebuild_index()
+    def insert(self, i, value):
+        super(ContactList, self).insert(i, value)
+        self.rebuild_index()
+    def remove(self, value):
+        super(ContactList, self).remove(value)
+        self.rebuild_index()
+    def pop(self, *args):
+        r = super(ContactList, self).pop(*args)
+        self.rebuild_index()
+        return r
+    def clear(self):
+        super(ContactList, self).clear()
+        self.rebuild_index()
+    def __setitem__(self, i, value):
+        super(ContactList, self).__setitem__(i, value)
+        self.rebuild_index()
+    def __delitem__(self, i):
+        super(ContactList, self).__delitem__(i)
+        self.rebuild_index()
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
     def __deepcopy__(self, memo):
         r = self.__class__([copy.deepcopy(v) for v in self])
+        r.rebuild_index()
         r.contactInitFn = self.contactInitFn
         r.contactClass = self.contactClass
         r.core = self.core
@@ -59,6 +122,9 @@ class ContactList(list):
     def __setstate__(self, state):
         self.contactInitFn = None
         self.contactClass = User
+        self.lazyLoader = None
+        self.removeCallback = None
+        self.rebuild_index()
     def __str__(self):
         return '[%s]' % ', '.join([repr(v) for v in self])
     def __repr__(self):
@@ -130,6 +196,12 @@ class AbstractUserDict(AttributeDict):
             r[copy.deepcopy(k)] = copy.deepcopy(v)
         r.core = self.core
         return r
+    def __copy__(self):
+        ''' shallow snapshot, values like MemberList are shared with the origin '''
+        r = self.__class__.__new__(self.__class__)
+        dict.update(r, self)
+        r.__dict__.update(self.__dict__)
+        return r
     def __str__(self):
         return '{%s}' % ', '.join(
             ['%s: %s' % (repr(k),repr(v)) for k,v in self.items()])
@@ -48,6 +48,8 @@ def emoji_formatter(d, k):
     ''' _emoji_deebugger is for bugs about emoji match caused by wechat backstage
     like :face with tears of joy: will be replaced with :cat face with tears of joy:
     '''
+    if '<span class="emoji' not in d[k]: # most messages have no emoji
+        return
     def _emoji_debugger(d, k):
         s = d[k].replace('<span class="emoji emoji1f450"></span',
             '<span class="emoji emoji1f450"></span>') # fix missing bug
@@ -113,7 +115,10 @@ def struct_friend_info(knownInfo):
 
 def search_dict_list(l, key, value):
     ''' Search a list of dict
-        * return dict with specific value & key '''
+        * return dict with specific value & key
+        * ContactList is searched by its UserName index '''
+    if key == 'UserName' and hasattr(l, 'search_user_name'):
+        return l.search_user_name(value)
     for i in l:
         if i.get(key) == value:
             return i
@@ -142,6 +147,24 @@ def contact_deep_copy(core, contact):
     with core.storageClass.updateLock:
         return copy.deepcopy(contact)
 
+def stream_download(r, fileDir=None, memoryView=False):
+    ''' read a streamed response in large chunks without extra copies
+        * fileDir is None: return content as bytes, or memoryview if memoryView
+        * otherwise write chunks to fileDir directly, return first 20 bytes
+          of the content for get_image_postfix '''
+    if fileDir is None:
+        content = bytearray()
+        for block in r.iter_content(config.DOWNLOAD_CHUNK_SIZE):
+            content += block
+        return memoryview(content) if memoryView else bytes(content)
+    head = b''
+    with open(fileDir, 'wb') as f:
+        for block in r.iter_content(config.DOWNLOAD_CHUNK_SIZE):
+            if len(head) < 20:
+                head += block[:20 - len(head)]
+            f.write(block)
+    return head
+
 def get_image_postfix(data):
     data = data[:20]
     if b'GIF' in data:
@@ -14,7 +14,8 @@ from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common import const
 from common.log import logger
-from config import conf, load_config
+from common.warrant_store import WarrantStore
+from config import conf, reload_config
 from plugins import *
 
 # 定义指令集
@@ -116,11 +117,24 @@ ADMIN_COMMANDS = {
         "alias": ["debug", "调试模式", "DEBUG"],
         "desc": "开启机器调试日志",
     },
+    "memory": {
+        "alias": ["memory", "会话内存"],
+        "desc": "统计会话内存占用",
+    },
     "warrant": {
         "alias": ["warrant", "生成授权码"],
         "args": ["授权码"],
         "desc": "生成授权码",
     },
+    "warrant-batch": {
+        "alias": ["warrant-batch", "批量生成授权码"],
+        "args": ["有效天数", "数量"],
+        "desc": "批量生成授权码并导出为csv文件",
+    },
+    "warrant-stats": {
+        "alias": ["warrant-stats", "授权码统计"],
+        "desc": "统计授权码使用情况",
+    },
     "delete-warrant": {
         "alias": ["delete-warrant", "删除用户授权码"],
         "args": ["授权码"],
@@ -299,8 +313,10 @@ class Godcmd(Plugin):
                             self.isrunning = True
                             ok, result = True, "服务已恢复"
                         elif cmd == "reconf":
-                            load_config()
-                            ok, result = True, "配置已重载"
+                            if reload_config():
+                                ok, result = True, "配置已重载"
+                            else:
+                                ok, result = False, "配置有误，未重载"
                         elif cmd == "resetall":
                             if bottype in [const.OPEN_AI, const.CHATGPT, const.CHATGPTONAZURE]:
                                 channel.cancel_all_session()
@@ -315,6 +331,15 @@ class Godcmd(Plugin):
                             else:
                                 logger.setLevel(logging.DEBUG)
                                 ok, result = True, "DEBUG模式已开启"
+                        elif cmd == "memory":
+                            if bottype in [const.OPEN_AI, const.CHATGPT, const.CHATGPTONAZURE]:
+                                report = bot.sessions.memory_report()
+                                ok = True
+                                result = "会话数：{}\n休眠会话数：{}\n消息数：{}\n会话内存：{:.1f}KB\n共享prompt：{}个，{:.1f}KB".format(
+                                    report["sessions"], report["hibernated_sessions"], report["messages"], report["bytes"] / 1024, report["shared_system_prompts"], report["shared_bytes"] / 1024
+                                )
+                            else:
+                                ok, result = False, "当前对话机器人不支持统计会话"
                         elif cmd == "plist":
                             plugins = PluginManager().list_plugins()
                             ok = True
@@ -388,61 +413,46 @@ class Godcmd(Plugin):
                                 except ValueError:
                                     ok, result = False, "请输入正确的有效天数"
                                 else:
-                                    # Ensure log directory exists
-                                    log_directory = 'log'
-                                    if not os.path.exists(log_directory):
-                                        os.makedirs(log_directory)
-                                    filename = os.path.join(log_directory, 'warrant.json')
-                                    warrants = {}
-                                    if os.path.exists(filename):
-                                        with open(filename, 'r') as file:
-                                            warrants = json.load(file)
-                                    warrant_key = ''.join(
-                                        random.choices(string.ascii_letters + string.digits, k=15))
-                                    while warrant_key in warrants:
-                                        warrant_key = ''.join(
-                                            random.choices(string.ascii_letters + string.digits, k=15))
-
-                                    # Add new warrant to dictionary and save to file
-                                    # The warrant value is now a dictionary containing the user-provided value and a status
-                                    warrants[warrant_key] = {"value": warrant_value, "status": "未使用"}
-                                    with open(filename, 'w') as file:
-                                        json.dump(warrants, file, indent=4)
-
+                                    warrant_key = WarrantStore().create_warrant(warrant_value)
                                     # Add a '#' to the warrant key and assign it to 'result'
                                     ok, result = True, '#' + warrant_key
                             else:
                                 ok, result = False, "请在命令后面添加有效天数"
+                        elif cmd == "warrant-batch":
+                            if len(args) != 2:
+                                ok, result = False, "请提供有效天数和数量"
+                            else:
+                                try:
+                                    warrant_value, warrant_count = int(args[0]), int(args[1])
+                                except ValueError:
+                                    ok, result = False, "请输入正确的有效天数和数量"
+                                else:
+                                    if not 0 < warrant_count <= 100000:
+                                        ok, result = False, "数量需要在1到100000之间"
+                                    else:
+                                        store = WarrantStore()
+                                        codes = store.create_warrants(warrant_value, warrant_count)
+                                        path = store.export_warrants(codes, warrant_value)
+                                        if ReplyType.FILE in channel.NOT_SUPPORT_REPLYTYPE:
+                                            ok, result = True, "已生成{}个授权码，文件：{}".format(len(codes), path)
+                                        else:
+                                            e_context["reply"] = Reply(ReplyType.FILE, path)
+                                            e_context.action = EventAction.BREAK_PASS
+                                            logger.debug("[Godcmd] admin command: %s by %s" % (cmd, user))
+                                            return
+                        elif cmd == "warrant-stats":
+                            stats = WarrantStore().warrant_stats()
+                            ok = True
+                            result = "授权码总数：{}\n已使用：{}\n未使用：{}\n用户数：{}\n已激活用户：{}".format(
+                                stats["total"], stats["used"], stats["unused"], stats["users"], stats["activated_users"]
+                            )
                         elif cmd == "delete-warrant":
                             if len(args) != 1:
                                 ok, result = False, "请提供要删除的授权码"
+                            elif WarrantStore().delete_user_warrant(args[0]):
+                                ok, result = True, "授权码删除成功"
                             else:
-                                log_directory = 'log'
-                                if not os.path.exists(log_directory):
-                                    os.makedirs(log_directory)
-                                filename = os.path.join(log_directory, 'user.json')
-                                if os.path.exists(filename):
-                                    with open(filename, 'r') as file:
-                                        users = json.load(file)
-
-                                    # Find the user with the warrant and clear the warrant_code
-                                    warrant_cleared = False
-                                    for user in users:
-                                        if 'warrant_code' in user and user['warrant_code'] == args[0]:
-                                            user['warrant_code'] = ""  # clear the value
-                                            warrant_cleared = True
-                                            break
-
-                                    # Check if a warrant_code was cleared
-                                    if warrant_cleared:
-                                        ok, result = True, "授权码删除成功"
-                                        # Write back to file
-                                        with open(filename, 'w') as file:
-                                            json.dump(users, file, indent=4)
-                                    else:
-                                        ok, result = False, "无此授权码或输入错误"
-                                else:
-                                    ok, result = False, "无法找到 user.json 文件"
+                                ok, result = False, "无此授权码或输入错误"
 
                         logger.debug("[Godcmd] admin command: %s by %s" % (cmd, user))
 
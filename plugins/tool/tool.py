@@ -96,7 +96,7 @@ class Tool(Plugin):
 
                 # Don't modify bot name
                 all_sessions = Bridge().get_bot("chat").sessions
-                user_session = all_sessions.session_query(query, e_context["context"]["session_id"]).messages
+                user_session = all_sessions.session_query(query, e_context["context"]["session_id"]).to_openai_messages()
 
                 # chatgpt-tool-hub will reply you with many tools
                 logger.debug("[tool]: just-go")
@@ -0,0 +1,117 @@
+# encoding:utf-8
+
+"""
+对比群成员合并(lib/itchat/components/contact.py中的update_local_chatrooms)优化前后的耗时
+构造指定人数的群，先全量加载一次，再连续更新若干次，每次有部分成员退群、部分新成员入群
+
+用法: python scripts/bench_chatroom_merge.py [人数 ...]，默认500和2000
+"""
+
+import copy
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+
+from itchat import utils  # noqa: E402
+from itchat.components.contact import update_local_chatrooms  # noqa: E402
+from itchat.storage import Storage, contact_change  # noqa: E402
+from itchat.utils import update_info_dict  # noqa: E402
+
+ROUNDS = 5  # 每个群连续更新的次数
+CHURN = 10  # 每次更新退群和入群的人数
+REPEAT = 5  # 重复测量取最好结果
+
+
+@contact_change
+def legacy_update_local_chatrooms(core, l):
+    """优化前的实现，按列表线性查找群和成员，退群成员逐个按下标删除"""
+    for chatroom in l:
+        utils.emoji_formatter(chatroom, "NickName")
+        for member in chatroom["MemberList"]:
+            if "NickName" in member:
+                utils.emoji_formatter(member, "NickName")
+            if "DisplayName" in member:
+                utils.emoji_formatter(member, "DisplayName")
+            if "RemarkName" in member:
+                utils.emoji_formatter(member, "RemarkName")
+        oldChatroom = utils.search_dict_list(core.chatroomList, "UserName", chatroom["UserName"])
+        if oldChatroom:
+            update_info_dict(oldChatroom, chatroom)
+            memberList = chatroom.get("MemberList", [])
+            oldMemberList = oldChatroom["MemberList"]
+            if memberList:
+                for member in memberList:
+                    oldMember = utils.search_dict_list(oldMemberList, "UserName", member["UserName"])
+                    if oldMember:
+                        update_info_dict(oldMember, member)
+                    else:
+                        oldMemberList.append(member)
+        else:
+            core.chatroomList.append(chatroom)
+            oldChatroom = utils.search_dict_list(core.chatroomList, "UserName", chatroom["UserName"])
+        if len(chatroom["MemberList"]) != len(oldChatroom["MemberList"]) and chatroom["MemberList"]:
+            existsUserNames = [member["UserName"] for member in chatroom["MemberList"]]
+            delList = []
+            for i, member in enumerate(oldChatroom["MemberList"]):
+                if member["UserName"] not in existsUserNames:
+                    delList.append(i)
+            delList.sort(reverse=True)
+            for i in delList:
+                del oldChatroom["MemberList"][i]
+        if oldChatroom.get("ChatRoomOwner") and oldChatroom.get("MemberList"):
+            owner = utils.search_dict_list(oldChatroom["MemberList"], "UserName", oldChatroom["ChatRoomOwner"])
+            oldChatroom["OwnerUin"] = (owner or {}).get("Uin", 0)
+        if "OwnerUin" in oldChatroom and oldChatroom["OwnerUin"] != 0:
+            oldChatroom["IsAdmin"] = oldChatroom["OwnerUin"] == int(core.loginInfo["wxuin"])
+        else:
+            oldChatroom["IsAdmin"] = None
+        newSelf = utils.search_dict_list(oldChatroom["MemberList"], "UserName", core.storageClass.userName)
+        oldChatroom["Self"] = newSelf or copy.deepcopy(core.loginInfo["User"])
+
+
+class FakeCore(object):
+    def __init__(self):
+        self.loginInfo = {"wxuin": "1", "User": {"UserName": "@self", "NickName": "self"}}
+        self.storageClass = Storage(self)
+        self.storageClass.userName = "@self"
+        self.chatroomList = self.storageClass.chatroomList
+
+
+def build_chatroom(start, size):
+    members = [{"UserName": "@member{}".format(i), "NickName": "member{}".format(i), "DisplayName": "", "Uin": i + 2} for i in range(start, start + size)]
+    return {"UserName": "@@chatroom", "NickName": "chatroom", "ChatRoomOwner": members[-1]["UserName"], "MemberList": members}
+
+
+def run(merge, size):
+    """返回(全量加载耗时, 平均每次更新耗时, 最终成员数)，单位秒"""
+    core = FakeCore()
+    start = time.perf_counter()
+    merge(core, [build_chatroom(0, size)])
+    load = time.perf_counter() - start
+    updates = []
+    for i in range(1, ROUNDS + 1):
+        chatroom = build_chatroom(i * CHURN, size)  # 构造数据不计入耗时
+        start = time.perf_counter()
+        merge(core, [chatroom])
+        updates.append(time.perf_counter() - start)
+    return load, sum(updates) / len(updates), len(core.chatroomList[0]["MemberList"])
+
+
+def main(sizes):
+    print("{:>8} {:>10} {:>12} {:>12} {:>8}".format("members", "impl", "load(ms)", "update(ms)", "speedup"))
+    for size in sizes:
+        results = {}
+        for name, merge in (("legacy", legacy_update_local_chatrooms), ("indexed", update_local_chatrooms)):
+            runs = [run(merge, size) for _ in range(REPEAT)]
+            load = min(r[0] for r in runs)
+            update = min(r[1] for r in runs)
+            assert all(r[2] == size for r in runs), "unexpected member count"
+            results[name] = update
+            speedup = "" if name == "legacy" else "{:.1f}x".format(results["legacy"] / update)
+            print("{:>8} {:>10} {:>12.2f} {:>12.2f} {:>8}".format(size, name, load * 1000, update * 1000, speedup))
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [500, 2000])
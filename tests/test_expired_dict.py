@@ -0,0 +1,158 @@
+import pytest
+
+from common import expired_dict
+from common.expired_dict import ExpiredDict
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(expired_dict, "monotonic", clock)
+    return clock
+
+
+def test_item_expires_after_ttl(clock):
+    d = ExpiredDict(10)
+    d["a"] = 1
+    clock.advance(9)
+    assert d.get("a") == 1
+    clock.advance(11)
+    assert "a" not in d
+    assert d.get("a") is None
+    with pytest.raises(KeyError):
+        d["a"]
+
+
+def test_get_refreshes_expiry_but_in_and_peek_do_not(clock):
+    d = ExpiredDict(10)
+    d["a"] = 1
+    d["b"] = 2
+    clock.advance(8)
+    assert d["a"] == 1
+    assert "b" in d
+    assert d.peek("b") == 2
+    clock.advance(8)
+    assert d.get("a") == 1
+    assert "b" not in d
+    assert d.peek("b") is None
+
+
+def test_len_and_items_skip_expired(clock):
+    d = ExpiredDict(10)
+    d["a"] = 1
+    clock.advance(5)
+    d["b"] = 2
+    clock.advance(6)
+    assert d.items() == [("b", 2)]
+    assert d.keys() == ["b"]
+    assert len(d) == 1
+
+
+def test_max_size_evicts_least_recently_used(clock):
+    evicted = []
+    d = ExpiredDict(10, max_size=2, on_expire=lambda k, v: evicted.append((k, v)))
+    d["a"] = 1
+    d["b"] = 2
+    d.get("a")
+    d["c"] = 3
+    assert evicted == [("b", 2)]
+    assert sorted(d.keys()) == ["a", "c"]
+
+
+def test_on_expire_called_once_by_sweep(clock):
+    evicted = []
+    d = ExpiredDict(10, on_expire=lambda k, v: evicted.append(k))
+    d["a"] = 1
+    clock.advance(11)
+    d.expire()
+    d.expire()
+    assert evicted == ["a"]
+
+
+def test_on_expire_called_by_getitem(clock):
+    evicted = []
+    d = ExpiredDict(10, on_expire=lambda k, v: evicted.append(k))
+    d["a"] = 1
+    clock.advance(11)
+    assert d.get("a") is None
+    d.expire()
+    assert evicted == ["a"]
+
+
+def test_on_expire_called_by_pop_of_expired_item(clock):
+    evicted = []
+    d = ExpiredDict(10, on_expire=lambda k, v: evicted.append((k, v)))
+    d["a"] = 1
+    clock.advance(11)
+    assert d.pop("a", None) is None
+    with pytest.raises(KeyError):
+        d.pop("a")
+    assert evicted == [("a", 1)]
+
+
+def test_explicit_removal_does_not_call_on_expire(clock):
+    evicted = []
+    d = ExpiredDict(10, on_expire=lambda k, v: evicted.append(k))
+    d["a"] = 1
+    d["b"] = 2
+    d["c"] = 3
+    assert d.pop("a") == 1
+    del d["b"]
+    d.clear()
+    d.expire()
+    assert evicted == []
+
+
+def test_on_expire_error_does_not_break_sweep(clock):
+    evicted = []
+
+    def on_expire(key, value):
+        evicted.append(key)
+        raise ValueError(key)
+
+    d = ExpiredDict(10, on_expire=on_expire)
+    d["a"] = 1
+    d["b"] = 2
+    clock.advance(11)
+    d.expire()
+    assert evicted == ["a", "b"]
+    assert len(d) == 0
+
+
+def test_set_expires_in_recomputes_existing_items(clock):
+    evicted = []
+    d = ExpiredDict(100, on_expire=lambda k, v: evicted.append(k))
+    d["a"] = 1
+    clock.advance(70)
+    d["b"] = 2
+    d.set_expires_in(60)
+    assert evicted == ["a"]
+    clock.advance(20)
+    d["c"] = 3
+    clock.advance(45)
+    d.expire()
+    assert evicted == ["a", "b"]
+    assert d.keys() == ["c"]
+
+
+def test_set_expires_in_keeps_sweep_order(clock):
+    d = ExpiredDict(100)
+    d["a"] = 1
+    clock.advance(1)
+    d.set_expires_in(10)
+    d["b"] = 2
+    clock.advance(11)
+    d["c"] = 3
+    assert len(d) == 1
+    assert d.keys() == ["c"]